@@ -6,6 +6,11 @@ const { spawn } = require('child_process');
 let store; // Declare store, will be initialized asynchronously
 let mainWindow;
 
+// The backend writes JSON-lines events to this extra pipe (see backend/event_channel.py)
+const EVENTS_FD = 3;
+// Events are forwarded to the renderer in batches at most this often
+const EVENT_BATCH_MS = 100;
+
 // Determine if the app is packaged
 const isDev = process.env.NODE_ENV !== 'production'; // This might be more reliable
 const isPackaged = app.isPackaged;
@@ -208,7 +213,10 @@ ipcMain.on('process-csv', async (event, csvPath) => { // Added async here
     const scriptArgs = [
         mainPyScript,
         '--input', csvPath,
-        '--output_dir', outputBaseDir
+        '--output_dir', outputBaseDir,
+        '--events-fd', String(EVENTS_FD),
+        '--verbosity', 'info',
+        '--no-human-logs'
     ];
 
     // Retrieve API key and add to args if it exists
@@ -224,7 +232,10 @@ ipcMain.on('process-csv', async (event, csvPath) => { // Added async here
 
     const pythonProcess = spawn(pythonExecutable, scriptArgs, {
         cwd: backendDir, // Correct working directory for the main python script
-        env: { ...process.env } // Ensure the child process inherits the environment
+        // Inherit the environment; unbuffered stdout so PROGRESS events arrive as soon as they are printed
+        env: { ...process.env, PYTHONUNBUFFERED: '1' },
+        // stdin, stdout, stderr and the event pipe
+        stdio: ['pipe', 'pipe', 'pipe', 'pipe']
     });
     
     // Store process ID and notify renderer
@@ -238,6 +249,42 @@ ipcMain.on('process-csv', async (event, csvPath) => { // Added async here
     global.runningProcesses.set(processId, pythonProcess);
 
     let fullOutput = "";
+    let jsonOutputPath = null;
+    let eventBuffer = "";
+    let pendingEvents = [];
+    let eventFlushTimer = null;
+
+    const flushEvents = () => {
+        eventFlushTimer = null;
+        if (pendingEvents.length && event && event.sender) {
+            event.sender.send('processing-events', pendingEvents);
+        }
+        pendingEvents = [];
+    };
+
+    pythonProcess.stdio[EVENTS_FD].on('data', (data) => {
+        eventBuffer += data.toString();
+        const lines = eventBuffer.split('\n');
+        eventBuffer = lines.pop(); // Keep a partial last line for the next chunk
+        for (const line of lines) {
+            if (!line.trim()) {
+                continue;
+            }
+            try {
+                const backendEvent = JSON.parse(line);
+                if (backendEvent.type === 'output') {
+                    jsonOutputPath = backendEvent.path;
+                }
+                pendingEvents.push(backendEvent);
+            } catch (err) {
+                console.error('Could not parse backend event:', line);
+            }
+        }
+        if (pendingEvents.length && !eventFlushTimer) {
+            eventFlushTimer = setTimeout(flushEvents, EVENT_BATCH_MS);
+        }
+    });
+
     pythonProcess.stdout.on('data', (data) => {
         const output = data.toString();
         console.log(`Python stdout: ${output}`);
@@ -261,6 +308,12 @@ ipcMain.on('process-csv', async (event, csvPath) => { // Added async here
 
     pythonProcess.on('close', (code) => {
         console.log(`Python script exited with code ${code}`);
+
+        // Deliver the last events before the completion message
+        if (eventFlushTimer) {
+            clearTimeout(eventFlushTimer);
+        }
+        flushEvents();
         
         // Remove process from the map
         if (global.runningProcesses && processId) {
@@ -268,10 +321,10 @@ ipcMain.on('process-csv', async (event, csvPath) => { // Added async here
         }
         
         if (code === 0) {
-            // Look for the JSON_OUTPUT_PATH marker
+            // The output event carries the path; the JSON_OUTPUT_PATH marker is the stdout fallback
             const pathMatch = fullOutput.match(/JSON_OUTPUT_PATH:(.*?)(\r|\n|$)/);
-            if (pathMatch && pathMatch[1]) {
-                const jsonPath = pathMatch[1].trim();
+            const jsonPath = jsonOutputPath || (pathMatch && pathMatch[1] ? pathMatch[1].trim() : null);
+            if (jsonPath) {
                 console.log(`Found JSON output path: ${jsonPath}`);
                 
                 // Read the JSON file to include its content
@@ -12,6 +12,7 @@ contextBridge.exposeInMainWorld('electronAPI', {
     },
     cancelProcessing: (processId) => ipcRenderer.send('cancel-processing', processId),
     onProcessingLog: (callback) => ipcRenderer.on('processing-log', (_event, log) => callback(log)),
+    onProcessingEvents: (callback) => ipcRenderer.on('processing-events', (_event, events) => callback(events)),
     onProcessingComplete: (callback) => ipcRenderer.on('processing-complete', (_event, outputPath) => callback(outputPath)),
     onProcessingError: (callback) => ipcRenderer.on('processing-error', (_event, errorMsg) => callback(errorMsg)),
     openFileDialog: () => ipcRenderer.invoke('dialog:openFile'),
@@ -19,6 +20,7 @@ contextBridge.exposeInMainWorld('electronAPI', {
     openExternalLink: (url) => ipcRenderer.send('open-external-link', url),
     removeAllProcessingListeners: () => {
         ipcRenderer.removeAllListeners('processing-log');
+        ipcRenderer.removeAllListeners('processing-events');
         ipcRenderer.removeAllListeners('processing-complete');
         ipcRenderer.removeAllListeners('processing-error');
     },
@@ -184,6 +184,30 @@ window.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // Structured events (see backend/event_channel.py), delivered by the main process in batches
+    window.electronAPI.onProcessingEvents((backendEvents) => {
+        const logLines = document.createDocumentFragment();
+        for (const backendEvent of backendEvents) {
+            if (backendEvent.type === 'log') {
+                const formattedLog = formatLogMessage(`[${backendEvent.level}] ${backendEvent.message}`);
+                if (formattedLog) {
+                    const logLine = document.createElement('div');
+                    logLine.innerHTML = formattedLog;
+                    logLines.appendChild(logLine);
+                }
+            } else {
+                // Keep log lines in order with the section headers progress events add
+                logsElement.appendChild(logLines);
+                handleBackendEvent(backendEvent);
+            }
+        }
+        logsElement.appendChild(logLines);
+        // Scroll once per batch rather than once per line
+        if (shouldAutoScroll) {
+            logsElement.scrollTop = logsElement.scrollHeight;
+        }
+    });
+
     window.electronAPI.onProcessingComplete((outputData) => {
         logsElement.textContent += '\nAnalysis finished successfully!\n';
         updateProgress(100, "Analysis complete!");
@@ -243,16 +267,23 @@ window.addEventListener('DOMContentLoaded', () => {
         cancelButtonContainer.style.display = 'none';
     });
 
-    function updateProgress(percentage, text) {
+    function updateProgress(percentage, text, appendToLogs = true) {
         // Update the progress bar width and text
         progressBar.style.width = `${percentage}%`;
         progressBar.textContent = `${percentage}%`;
         statusText.textContent = text;
         
         // Add progress info to logs with highlighting - simplified for better user experience
-        const progressInfo = text;
-        logsElement.innerHTML += `<div class="progress-highlight">${progressInfo}</div>`;
-        logsElement.scrollTop = logsElement.scrollHeight;
+        // (frequent streaming updates only refresh the status line)
+        if (appendToLogs) {
+            const progressInfo = document.createElement('div');
+            progressInfo.className = 'progress-highlight';
+            progressInfo.textContent = text;
+            logsElement.appendChild(progressInfo);
+            if (shouldAutoScroll) {
+                logsElement.scrollTop = logsElement.scrollHeight;
+            }
+        }
         
         // Change color when complete
         if (percentage === 100) {
@@ -295,6 +326,15 @@ window.addEventListener('DOMContentLoaded', () => {
                         `Comparing ${current} of ${total} invoice pairs...`);
                 }
                 break;
+            case "SBERT_STAGE":
+                // Payload is JSON and may itself contain colons, so parse everything after the marker
+                try {
+                    const stageEvent = JSON.parse(message.slice("PROGRESS:SBERT_STAGE:".length));
+                    handleSbertStage(stageEvent);
+                } catch (e) {
+                    console.error("Error parsing SBERT stage event:", e);
+                }
+                break;
             case "SBERT_END":
                 updateProgress(30, "Initial comparison complete. Starting detailed analysis...");
                 break;
@@ -309,30 +349,13 @@ window.addEventListener('DOMContentLoaded', () => {
                 break;
             case "LLM_TOTAL_ITEMS":
                 if (parts.length >= 3) {
-                    const totalItems = parseInt(parts[2], 10);
-                    // Store total items for later percentage calculations
-                    window.llmTotalItems = totalItems;
-                    updateProgress(35, `Preparing to examine ${totalItems} potential matches...`);
+                    onLlmTotalItems(parseInt(parts[2], 10));
                 }
                 break;
             case "LLM_BATCH_START":
                 if (parts.length >= 6) {
-                    const currentBatch = parseInt(parts[2], 10);
-                    const totalBatches = parseInt(parts[3], 10);
-                    const startItem = parseInt(parts[4], 10);
-                    const endItem = parseInt(parts[5], 10);
-                    const totalItems = parseInt(parts[6], 10);
-                    
-                    // Calculate progress: LLM part is 35% to 90% (55% range)
-                    const batchProgress = totalBatches > 0 ? ((currentBatch - 1) / totalBatches) * 55 : 0;
-                    const overallProgress = 35 + batchProgress;
-                    
-                    console.log(`LLM Batch progress: ${currentBatch}/${totalBatches}, items ${startItem}-${endItem}/${totalItems}, overall: ${Math.round(overallProgress)}%`);
-                    updateProgress(Math.round(overallProgress), 
-                        `Processing batch ${currentBatch} of ${totalBatches}...`);
-                    
-                    // Create or update batch progress element
-                    updateBatchProgress(currentBatch, totalBatches, startItem, endItem, totalItems);
+                    onLlmBatchStart(parseInt(parts[2], 10), parseInt(parts[3], 10), parseInt(parts[4], 10),
+                        parseInt(parts[5], 10), parseInt(parts[6], 10));
                 } else if (parts.length >= 4) {
                     // Fallback to the old format for backward compatibility
                     const currentBatch = parseInt(parts[2], 10);
@@ -348,59 +371,22 @@ window.addEventListener('DOMContentLoaded', () => {
                 break;
             case "LLM_ITEM_START":
                 if (parts.length >= 4) {
-                    const currentItem = parseInt(parts[2], 10);
-                    const totalItems = parseInt(parts[3], 10);
-                    
-                    // Update item progress indicator
-                    updateItemProgress(currentItem, totalItems, "processing");
+                    onLlmItem(parseInt(parts[2], 10), parseInt(parts[3], 10), "start");
                 }
                 break;
             case "LLM_ITEM_END":
                 if (parts.length >= 5) {
-                    const currentItem = parseInt(parts[2], 10);
-                    const totalItems = parseInt(parts[3], 10);
-                    const classification = parts[4];
-                    
-                    // Calculate progress: LLM part is 35% to 90% (55% range)
-                    // Each item contributes to the progress
-                    const itemProgress = totalItems > 0 ? (currentItem / totalItems) * 55 : 0;
-                    const overallProgress = 35 + itemProgress;
-                    
-                    // Only update overall progress on item completion if we're not showing batch progress
-                    if (!document.getElementById('batch-progress-container')) {
-                        updateProgress(Math.round(overallProgress), 
-                            `Completed item ${currentItem}/${totalItems} (${classification})`);
-                    }
-                    
-                    // Update item progress indicator with result
-                    updateItemProgress(currentItem, totalItems, "complete", classification);
+                    onLlmItem(parseInt(parts[2], 10), parseInt(parts[3], 10), "end", parts[4]);
                 }
                 break;
             case "LLM_ITEM_ERROR":
                 if (parts.length >= 4) {
-                    const currentItem = parseInt(parts[2], 10);
-                    const totalItems = parseInt(parts[3], 10);
-                    
-                    // Update item progress indicator with error
-                    updateItemProgress(currentItem, totalItems, "error");
+                    onLlmItem(parseInt(parts[2], 10), parseInt(parts[3], 10), "error");
                 }
                 break;
             case "LLM_BATCH_END":
                 if (parts.length >= 5) {
-                    const currentBatch = parseInt(parts[2], 10);
-                    const totalBatches = parseInt(parts[3], 10);
-                    const elapsedTime = parseFloat(parts[4]);
-                    
-                    // Calculate progress: LLM part is 35% to 90% (55% range)
-                    const batchProgress = totalBatches > 0 ? (currentBatch / totalBatches) * 55 : 0;
-                    const overallProgress = 35 + batchProgress;
-                    
-                    console.log(`LLM Batch completed: ${currentBatch}/${totalBatches}, time: ${elapsedTime}s, overall: ${Math.round(overallProgress)}%`);
-                    updateProgress(Math.round(overallProgress), 
-                        `Completed batch ${currentBatch} of ${totalBatches} in ${elapsedTime.toFixed(1)}s`);
-                    
-                    // Update batch progress
-                    updateBatchProgressCompletion(currentBatch, totalBatches);
+                    onLlmBatchEnd(parseInt(parts[2], 10), parseInt(parts[3], 10), parseFloat(parts[4]));
                 } else if (parts.length >= 4) {
                     // Fallback to old format
                     const currentBatch = parseInt(parts[2], 10);
@@ -414,33 +400,20 @@ window.addEventListener('DOMContentLoaded', () => {
                     updateProgress(Math.round(overallProgress), `Completed batch ${currentBatch} of ${totalBatches}`);
                 }
                 break;
+            case "LLM_DEFERRED":
+                if (parts.length >= 3) {
+                    onLlmDeferred(parseInt(parts[2], 10));
+                }
+                break;
             case "LLM_CLASSIFICATION_END": // Overall LLM step end
                 updateProgress(90, "Analysis complete.");
                 break;
             case "LLM_END": // This is from llm_classifier.py
                 try {
-                    if (parts.length >= 3) {
-                        const resultStats = JSON.parse(parts[2]);
-                        const statsString = Object.entries(resultStats)
-                            .map(([key, value]) => `${key}: ${value}`)
-                            .join(', ');
-                        updateProgress(90, `Analysis finished. Results: ${statsString}`);
-                    } else {
-                        updateProgress(90, "Analysis finished.");
-                    }
+                    onLlmEnd(parts.length >= 3 ? JSON.parse(parts.slice(2).join(':')) : null);
                 } catch (e) {
                     console.error("Error parsing LLM results:", e);
-                    updateProgress(90, "Analysis finished.");
-                }
-                // Clear any item progress indicators
-                const itemProgressContainer = document.getElementById('item-progress-container');
-                if (itemProgressContainer) {
-                    itemProgressContainer.remove();
-                }
-                // Clear any batch progress indicators
-                const batchProgressContainer = document.getElementById('batch-progress-container');
-                if (batchProgressContainer) {
-                    batchProgressContainer.remove();
+                    onLlmEnd(null);
                 }
                 break;
             case "FORMATTING_START":
@@ -461,6 +434,163 @@ window.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Typed events from backend/event_channel.py; the PROGRESS: markers above are the stdout fallback
+    function handleBackendEvent(backendEvent) {
+        switch (backendEvent.type) {
+            case 'stage':
+                handleProgressMessage(`PROGRESS:${backendEvent.stage}`);
+                break;
+            case 'sbert_stage':
+                handleSbertStage(backendEvent);
+                break;
+            case 'llm_total':
+                onLlmTotalItems(backendEvent.items);
+                break;
+            case 'llm_batch_start':
+                onLlmBatchStart(backendEvent.batch, backendEvent.batches, backendEvent.first, backendEvent.last, backendEvent.items);
+                break;
+            case 'llm_item':
+                onLlmItem(backendEvent.item, backendEvent.items, backendEvent.status, backendEvent.classification);
+                break;
+            case 'llm_batch_end':
+                onLlmBatchEnd(backendEvent.batch, backendEvent.batches, backendEvent.seconds);
+                break;
+            case 'llm_deferred':
+                onLlmDeferred(backendEvent.pairs);
+                break;
+            case 'llm_end':
+                onLlmEnd(backendEvent.counts);
+                break;
+            case 'output':
+                // Read by the main process, which sends processing-complete
+                break;
+            default:
+                console.log("Unknown backend event:", backendEvent.type);
+                break;
+        }
+    }
+
+    function onLlmTotalItems(totalItems) {
+        // Store total items for later percentage calculations
+        window.llmTotalItems = totalItems;
+        updateProgress(35, `Preparing to examine ${totalItems} potential matches...`);
+    }
+
+    function onLlmBatchStart(currentBatch, totalBatches, startItem, endItem, totalItems) {
+        // Calculate progress: LLM part is 35% to 90% (55% range)
+        const batchProgress = totalBatches > 0 ? ((currentBatch - 1) / totalBatches) * 55 : 0;
+        const overallProgress = 35 + batchProgress;
+
+        updateProgress(Math.round(overallProgress), 
+            `Processing batch ${currentBatch} of ${totalBatches}...`);
+
+        // Create or update batch progress element
+        updateBatchProgress(currentBatch, totalBatches, startItem, endItem, totalItems);
+    }
+
+    function onLlmItem(currentItem, totalItems, status, classification = null) {
+        if (status === "start") {
+            updateItemProgress(currentItem, totalItems, "processing");
+        } else if (status === "end") {
+            // Calculate progress: LLM part is 35% to 90% (55% range)
+            // Each item contributes to the progress
+            const itemProgress = totalItems > 0 ? (currentItem / totalItems) * 55 : 0;
+            const overallProgress = 35 + itemProgress;
+
+            // Only update overall progress on item completion if we're not showing batch progress
+            if (!document.getElementById('batch-progress-container')) {
+                updateProgress(Math.round(overallProgress), 
+                    `Completed item ${currentItem}/${totalItems} (${classification})`);
+            }
+            updateItemProgress(currentItem, totalItems, "complete", classification);
+        } else {
+            updateItemProgress(currentItem, totalItems, "error");
+        }
+    }
+
+    function onLlmBatchEnd(currentBatch, totalBatches, elapsedTime) {
+        // Calculate progress: LLM part is 35% to 90% (55% range)
+        const batchProgress = totalBatches > 0 ? (currentBatch / totalBatches) * 55 : 0;
+        const overallProgress = 35 + batchProgress;
+
+        updateProgress(Math.round(overallProgress), 
+            `Completed batch ${currentBatch} of ${totalBatches} in ${elapsedTime.toFixed(1)}s`);
+        updateBatchProgressCompletion(currentBatch, totalBatches);
+    }
+
+    function onLlmDeferred(deferredItems) {
+        updateProgress(90, `LLM budget reached: ${deferredItems} lower-priority pairs deferred`);
+    }
+
+    function onLlmEnd(resultStats) {
+        if (resultStats) {
+            const statsString = Object.entries(resultStats)
+                .map(([key, value]) => `${key}: ${value}`)
+                .join(', ');
+            updateProgress(90, `Analysis finished. Results: ${statsString}`);
+        } else {
+            updateProgress(90, "Analysis finished.");
+        }
+        // Clear any item progress indicators
+        const itemProgressContainer = document.getElementById('item-progress-container');
+        if (itemProgressContainer) {
+            itemProgressContainer.remove();
+        }
+        // Clear any batch progress indicators
+        const batchProgressContainer = document.getElementById('batch-progress-container');
+        if (batchProgressContainer) {
+            batchProgressContainer.remove();
+        }
+    }
+
+    // SBERT is 5-30% overall; blocking, encoding and scoring take 10%, 50% and 40% of that range
+    const SBERT_STAGE_RANGES = {
+        blocking: [0.0, 0.1],
+        encoding: [0.1, 0.6],
+        scoring: [0.6, 1.0]
+    };
+
+    function formatEta(seconds) {
+        if (seconds === null || seconds === undefined) {
+            return '';
+        }
+        if (seconds >= 60) {
+            return `, ETA ${Math.floor(seconds / 60)}m ${Math.round(seconds % 60)}s`;
+        }
+        return `, ETA ${Math.round(seconds)}s`;
+    }
+
+    function handleSbertStage(stageEvent) {
+        const range = SBERT_STAGE_RANGES[stageEvent.stage];
+        if (!range) {
+            return;
+        }
+
+        let fraction;
+        let text;
+        const rate = Math.round(stageEvent.rate || 0).toLocaleString();
+        if (stageEvent.stage === 'blocking' && stageEvent.partitions) {
+            fraction = stageEvent.partition / stageEvent.partitions;
+            text = `Finding candidate pairs (partition ${stageEvent.partition}/${stageEvent.partitions}): ` +
+                `${stageEvent.done.toLocaleString()} pairs`;
+        } else if (stageEvent.stage === 'blocking') {
+            fraction = stageEvent.rules ? stageEvent.rule / stageEvent.rules : 0;
+            text = `Finding candidate pairs (rule ${stageEvent.rule}/${stageEvent.rules}): ` +
+                `${stageEvent.done.toLocaleString()} pairs (${rate}/s)`;
+        } else {
+            fraction = stageEvent.total ? stageEvent.done / stageEvent.total : 1;
+            const noun = stageEvent.stage === 'encoding' ? 'Encoding invoices' : 'Scoring pairs';
+            text = `${noun}: ${stageEvent.done.toLocaleString()} of ${(stageEvent.total || 0).toLocaleString()} ` +
+                `(${rate}/s${formatEta(stageEvent.eta)})`;
+            if (stageEvent.flagged !== undefined) {
+                text += `, ${stageEvent.flagged.toLocaleString()} flagged`;
+            }
+        }
+
+        const sbertFraction = range[0] + (range[1] - range[0]) * Math.min(fraction, 1);
+        updateProgress(Math.round(5 + sbertFraction * 25), text, false);
+    }
+
     function resetRunButton() {
         runBtn.disabled = false;
         runBtn.textContent = 'Process Invoices';
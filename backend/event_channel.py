@@ -0,0 +1,165 @@
+# filepath: backend/event_channel.py
+"""
+Machine-readable events from the backend to the UI.
+
+By default events are printed to stdout as the PROGRESS:... / JSON_OUTPUT_PATH: marker
+lines the UI used to regex-match, next to the human-readable log lines. When main.py is
+started with --events-fd, each event is instead written as one JSON object per line to
+that file descriptor:
+
+    {"type": "llm_item", "t": 1712345678.9, "item": 3, "items": 40, "status": "end", "classification": "Likely"}
+
+Progress events that only report the latest position (SBERT stages, LLM items) are
+coalesced: at most one per type is written per interval, intermediate updates are
+dropped and the latest held-back update is written once the interval has passed. Log
+lines that pass the verbosity level become "log" events, and are printed to stdout as
+well unless human logs are turned off.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime
+
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "PROGRESS": 20, "WARNING": 30, "ERROR": 40}
+VERBOSITY_LEVELS = ("debug", "info", "warning", "error")
+
+# Event types of which only the latest matters; written at most once per interval
+COALESCED_EVENTS = {"sbert_stage", "llm_item"}
+DEFAULT_PROGRESS_INTERVAL = 0.25
+
+def legacy_marker(event_type, fields):
+    """
+    The stdout marker line for an event, as parsed by older versions of the UI, or None.
+    """
+    if event_type == "stage":
+        return f"PROGRESS:{fields['stage']}"
+    if event_type == "sbert_stage":
+        return f"PROGRESS:SBERT_STAGE:{json.dumps(fields)}"
+    if event_type == "llm_total":
+        return f"PROGRESS:LLM_TOTAL_ITEMS:{fields['items']}"
+    if event_type == "llm_batch_start":
+        return (f"PROGRESS:LLM_BATCH_START:{fields['batch']}:{fields['batches']}:"
+                f"{fields['first']}:{fields['last']}:{fields['items']}")
+    if event_type == "llm_item":
+        if fields["status"] == "start":
+            return f"PROGRESS:LLM_ITEM_START:{fields['item']}:{fields['items']}"
+        if fields["status"] == "end":
+            return f"PROGRESS:LLM_ITEM_END:{fields['item']}:{fields['items']}:{fields['classification']}"
+        return f"PROGRESS:LLM_ITEM_ERROR:{fields['item']}:{fields['items']}"
+    if event_type == "llm_batch_end":
+        return f"PROGRESS:LLM_BATCH_END:{fields['batch']}:{fields['batches']}:{fields['seconds']:.2f}"
+    if event_type == "llm_deferred":
+        return f"PROGRESS:LLM_DEFERRED:{fields['pairs']}"
+    if event_type == "llm_end":
+        return f"PROGRESS:LLM_END:{json.dumps(fields['counts'])}"
+    if event_type == "output":
+        return f"JSON_OUTPUT_PATH:{fields['path']}"
+    return None
+
+class EventChannel:
+    """
+    Destination of backend events and log lines; see the module docstring.
+    """
+
+    def __init__(self):
+        self.stream = None
+        self.verbosity = LOG_LEVELS["DEBUG"]
+        self.human_logs = True
+        self.progress_interval = DEFAULT_PROGRESS_INTERVAL
+        self.last_written = {}
+        self.pending = {}
+        self.flush_timer = None
+        self.lock = threading.Lock()
+
+    def configure(self, events_fd=None, verbosity="debug", human_logs=True, progress_interval=DEFAULT_PROGRESS_INTERVAL):
+        """
+        Route events to events_fd (None keeps the stdout markers) and set the log verbosity.
+        """
+        self.verbosity = LOG_LEVELS[verbosity.upper()]
+        self.human_logs = human_logs
+        self.progress_interval = progress_interval
+        if events_fd is not None:
+            try:
+                self.stream = os.fdopen(events_fd, "w", encoding="utf-8", buffering=1)
+            except OSError as e:
+                # Fall back to the stdout markers so the UI still sees progress
+                self.stream = None
+                self.human_logs = True
+                self.log(f"Cannot write events to file descriptor {events_fd} ({e}); using stdout markers.", "WARNING")
+
+    @property
+    def structured(self):
+        return self.stream is not None
+
+    def write(self, event_type, fields):
+        self.stream.write(json.dumps({"type": event_type, "t": round(time.time(), 3), **fields}) + "\n")
+        self.last_written[event_type] = time.perf_counter()
+
+    def flush_pending(self):
+        for event_type, fields in self.pending.items():
+            self.write(event_type, fields)
+        self.pending = {}
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+    def flush_pending_later(self):
+        def flush():
+            with self.lock:
+                self.flush_timer = None
+                self.flush_pending()
+        if self.flush_timer is None:
+            self.flush_timer = threading.Timer(self.progress_interval, flush)
+            self.flush_timer.daemon = True
+            self.flush_timer.start()
+
+    def emit(self, event_type, **fields):
+        """
+        Send one typed event. Coalesced types may be held back and replaced by a newer
+        update; other events (except logs) first write the held-back updates, so order is kept.
+        """
+        if not self.structured:
+            marker = legacy_marker(event_type, fields)
+            if marker:
+                print(marker, flush=True)
+            return
+        with self.lock:
+            if event_type in COALESCED_EVENTS:
+                last = self.last_written.get(event_type)
+                if last is not None and time.perf_counter() - last < self.progress_interval:
+                    self.pending[event_type] = fields
+                    self.flush_pending_later()
+                    return
+                self.pending.pop(event_type, None)
+            elif event_type != "log":
+                self.flush_pending()
+            self.write(event_type, fields)
+
+    def log(self, message, message_type="INFO"):
+        """
+        Log a line: printed for humans (errors also to stderr) and sent as a "log" event.
+        PROGRESS messages are stage markers and always become "stage" events.
+        """
+        level = LOG_LEVELS.get(message_type, LOG_LEVELS["INFO"])
+        if message_type == "PROGRESS":
+            self.emit("stage", stage=message)
+        if level < self.verbosity and message_type != "ERROR":
+            return
+        formatted_message = f"[{datetime.now().strftime('%H:%M:%S')}] [{message_type}] {message}"
+        if self.human_logs:
+            print(formatted_message, flush=True)
+        if message_type == "ERROR":
+            print(formatted_message, file=sys.stderr, flush=True)
+        if self.structured and message_type != "PROGRESS":
+            self.emit("log", level=message_type, message=str(message))
+
+    def close(self):
+        if self.structured:
+            with self.lock:
+                self.flush_pending()
+                self.stream.flush()
+
+# Shared by all backend modules of one process
+events = EventChannel()
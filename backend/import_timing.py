@@ -0,0 +1,30 @@
+# filepath: backend/import_timing.py
+import sys
+import time
+import importlib
+
+# Seconds spent on the first import of each lazily imported module, in import order
+IMPORT_TIMES = {}
+
+def timed_import(module_name):
+    """
+    Import a module on first use and record how long the import took.
+    Heavy dependencies (pandas, google.generativeai, scikit-learn) are imported
+    through this so that the backend can report progress before loading them.
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    IMPORT_TIMES[module_name] = time.perf_counter() - start
+    return module
+
+def import_time_report():
+    """
+    Import-time breakdown as a single log line, slowest first.
+    """
+    if not IMPORT_TIMES:
+        return "no deferred imports"
+    ordered = sorted(IMPORT_TIMES.items(), key=lambda item: item[1], reverse=True)
+    total = sum(IMPORT_TIMES.values())
+    return f"{total:.2f}s total (" + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in ordered) + ")"
@@ -3,156 +3,251 @@ import os
 import time
 import json
 import pandas as pd
-import sys
 import re
-from datetime import datetime
-from dotenv import load_dotenv
-import google.generativeai as genai
+from utils import pair_key, load_llm_checkpoint, append_llm_checkpoint
+from llm_scheduler import order_by_priority, estimate_tokens, deferred_result, TokenUsage
+from triage_model import triage_pairs
+from pair_clustering import group_positions_by_cluster
+from import_timing import timed_import
+from event_channel import events
+from llm_providers import GeminiProvider, PooledGeminiProvider, LlamaCppProvider, RulesProvider, extract_retry_delay
+from quota_pool import Credential, QuotaPool
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
-load_dotenv(dotenv_path)
 
-GEMINI_API_KEY_ENV = os.getenv("GEMINI_API_KEY")  # Renamed to avoid conflict
+def gemini_api_key_from_env():
+    """
+    Read GEMINI_API_KEY from backend/.env or the environment.
+    python-dotenv is only imported when no key was passed explicitly.
+    """
+    timed_import("dotenv").load_dotenv(dotenv_path)
+    return os.getenv("GEMINI_API_KEY")
+
+def gemini_api_keys(api_key=None):
+    """
+    The Gemini API keys to use: api_key (one key, comma-separated keys or a list), else
+    GEMINI_API_KEYS (comma-separated) or GEMINI_API_KEY from backend/.env or the environment.
+    """
+    if not api_key:
+        timed_import("dotenv").load_dotenv(dotenv_path)
+        api_key = os.getenv("GEMINI_API_KEYS") or os.getenv("GEMINI_API_KEY")
+    keys = api_key.split(",") if isinstance(api_key, str) else list(api_key or [])
+    return list(dict.fromkeys(key.strip() for key in keys if key and key.strip()))
 
 def log_message(message, message_type="INFO"):
     """
-    Log a message to both stdout and stderr if it's an error
-    to ensure visibility in both UI and terminal.
+    Log a message for the UI and terminal (errors also go to stderr); see event_channel.
     """
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    formatted_message = f"[{timestamp}] [{message_type}] {message}"
-    
-    print(formatted_message, flush=True)
-    if message_type == "ERROR":
-        print(formatted_message, file=sys.stderr, flush=True)
-    
-    # For progress updates, add a special marker for the UI
-    if message_type == "PROGRESS":
-        print(f"PROGRESS:{message}", flush=True)
-
-def format_invoice_details_for_llm(invoice_prefix, row):
-    details = [
-        f"Document Number: {row.get(f'{invoice_prefix}_DOC_NO', 'N/A')}",
-        f"Vendor Name: {row.get(f'{invoice_prefix}_VENDOR_NAME', 'N/A')}",
-        f"Vendor ID: {row.get(f'{invoice_prefix}_VENDOR_ID', 'N/A')}",
-        f"Amount: {row.get(f'{invoice_prefix}_AMOUNT', 'N/A')} {row.get(f'{invoice_prefix}_CURRENCY', '')}",
-        f"Invoice Date: {pd.to_datetime(row.get(f'{invoice_prefix}_INVOICE_DATE')).strftime('%Y-%m-%d') if pd.notna(row.get(f'{invoice_prefix}_INVOICE_DATE')) else 'N/A'}",
-        f"Description: {row.get(f'{invoice_prefix}_DESCRIPTION', 'N/A')}",
-        f"Purchase Order: {row.get(f'{invoice_prefix}_PURCHASE_ORDER', 'N/A')}",
-        f"Company Code: {row.get(f'{invoice_prefix}_COMPANY_CODE', 'N/A')}"
-    ]
-    return "\n".join(details)
+    events.log(message, message_type)
 
-def generate_llm_prompt(row):
-    invoice1_details = format_invoice_details_for_llm("INV1", row)
-    invoice2_details = format_invoice_details_for_llm("INV2", row)
-    similarity_score = row.get('similarity', 'N/A')
+# Fields shown to the LLM, as (label, column suffix)
+PROMPT_FIELDS = [
+    ("Doc No", "DOC_NO"),
+    ("Vendor", "VENDOR_NAME"),
+    ("Vendor ID", "VENDOR_ID"),
+    ("Amount", "AMOUNT"),
+    ("Currency", "CURRENCY"),
+    ("Date", "INVOICE_DATE"),
+    ("Description", "DESCRIPTION"),
+    ("PO", "PURCHASE_ORDER"),
+    ("Company Code", "COMPANY_CODE"),
+]
 
-    return f"""
-Analyze the following pair of SAP invoices to determine the likelihood of them being duplicates.
-SBERT similarity score: {similarity_score}.
+# Set once as the model's system instruction instead of being repeated in every prompt
+LLM_INSTRUCTIONS = """You judge whether SAP invoices flagged by a similarity model are duplicates. "Both"/"All" lists fields identical on every invoice; missing fields are omitted.
+Reply with JSON only: {"classification": "Not likely"|"Likely"|"Very likely", "explanation": brief reasoning, "keyFactors": [3-5 short strings]}"""
 
-Invoice 1:
-{invoice1_details}
+def prompt_field_value(row, invoice_prefix, column):
+    """
+    Value of one invoice field as shown in the prompt, or None if it is empty.
+    """
+    value = row.get(f'{invoice_prefix}_{column}')
+    if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+        return None
+    if column == 'INVOICE_DATE':
+        date = pd.to_datetime(value, errors='coerce')
+        return date.strftime('%Y-%m-%d') if pd.notna(date) else None
+    if isinstance(value, float) and value.is_integer() and column != 'AMOUNT':
+        # IDs read as floats because the column has gaps
+        value = int(value)
+    text = str(value).strip()
+    return text if text and text not in ('N/A', 'nan') else None
 
-Invoice 2:
-{invoice2_details}
+def format_fields(fields):
+    return " | ".join(f"{label}: {value}" for label, value in fields)
 
-Provide your analysis as a JSON object with keys "classification" (string: "Not likely", "Likely", or "Very likely"), "explanation" (string: brief reasoning), and "keyFactors" (list of 3-5 strings).
-Example: {{"classification": "Likely", "explanation": "Amounts and vendor are identical, dates are close.", "keyFactors": ["identical amounts", "same vendor", "close invoice dates"]}}
-JSON response:
-"""
+def format_compact_invoices(invoices, shared_label):
+    """
+    Lines describing invoices given as (prefix, row) tuples: fields with the same value on all
+    of them are stated once under shared_label, empty fields are left out.
+    """
+    values = [{label: prompt_field_value(row, prefix, column) for label, column in PROMPT_FIELDS}
+              for prefix, row in invoices]
+    shared = [label for label, _ in PROMPT_FIELDS
+              if values[0][label] is not None and all(invoice[label] == values[0][label] for invoice in values[1:])]
+    lines = []
+    if shared:
+        lines.append(f"{shared_label}: {format_fields((label, values[0][label]) for label in shared)}")
+    for number, invoice in enumerate(values, start=1):
+        own = [(label, value) for label, value in invoice.items() if value is not None and label not in shared]
+        lines.append(f"Invoice {number}: {format_fields(own)}")
+    return "\n".join(lines)
 
-def extract_retry_delay(error_message):
-    """Extract retry_delay value from the API error message."""
+def format_similarity(value):
     try:
-        match = re.search(r'retry_delay\s*{\s*seconds:\s*(\d+)\s*}', error_message)
-        if match:
-            return int(match.group(1))
-        return 60  # Default retry delay if not found
-    except Exception:
-        return 60  # Default retry delay if there's any error
+        return f"{float(value):.3f}"
+    except (TypeError, ValueError):
+        return "N/A"
 
-def call_gemini_api(prompt_text, genai_model_instance, item_num=None, total_items=None):  # Added item tracking
-    if not genai_model_instance:  # Check passed instance
-        return {"classification": "Skipped", "explanation": "API key not configured or model not initialized", "keyFactors": []}
-    try:
-        # Add real-time logging of the API call with more specific steps
-        if item_num and total_items:
-            log_message(f"Calling Gemini API for item {item_num}/{total_items}...", "INFO")
-            # Add a specific PROGRESS marker for individual item start
-            print(f"PROGRESS:LLM_ITEM_START:{item_num}:{total_items}", flush=True)
-        
-        # Flush stdout to ensure logs appear immediately
-        sys.stdout.flush()
-        
-        # Log the prompt preparation
-        log_message(f"Preparing prompt for item {item_num}/{total_items}", "INFO")
-        sys.stdout.flush()
-        
-        # Make the API call with timing information
-        start_time = time.time()
-        log_message(f"Sending request to Gemini API...", "INFO")
-        sys.stdout.flush()
-        
-        response = genai_model_instance.generate_content(prompt_text)  # Use passed instance
-        
-        # Log the API call timing
-        elapsed_time = time.time() - start_time
-        log_message(f"Gemini API response received in {elapsed_time:.2f} seconds", "INFO")
-        sys.stdout.flush()
-        
-        response_text = response.text.strip()
-        
-        # Log the response receipt
-        if item_num and total_items:
-            log_message(f"Processing response for item {item_num}/{total_items}", "INFO")
-            sys.stdout.flush()
-            
-        # Robust JSON extraction
-        json_match = response_text[response_text.find('{'):response_text.rfind('}')+1]
-        if json_match:
-            result = json.loads(json_match)
-            # Log a summary of the classification
-            classification = result.get("classification", "Unknown")
-            log_message(f"Item {item_num}/{total_items}: Classified as '{classification}'", "INFO")
-            
-            # Add a specific PROGRESS marker for individual item completion
-            print(f"PROGRESS:LLM_ITEM_END:{item_num}:{total_items}:{classification}", flush=True)
-            sys.stdout.flush()
-            return result
+def generate_llm_prompt(row):
+    # The instructions are the model's system instruction (see create_gemini_model)
+    return f"""Pair, SBERT similarity {format_similarity(row.get('similarity'))}
+{format_compact_invoices([("INV1", row), ("INV2", row)], "Both")}"""
+
+def generate_cluster_prompt(cluster_df):
+    # One prompt for a whole duplicate cluster: every distinct invoice once, plus the pairwise SBERT scores
+    invoices = {}
+    for _, row in cluster_df.iterrows():
+        for prefix in ("INV1", "INV2"):
+            invoices.setdefault(str(row.get(f'{prefix}_DOC_NO')), (prefix, row))
+    pair_scores = "; ".join(
+        f"{row.get('INV1_DOC_NO')}/{row.get('INV2_DOC_NO')} {format_similarity(row.get('similarity'))}"
+        for _, row in cluster_df.iterrows()
+    )
+    return f"""Group of {len(invoices)} invoices, SBERT similarities above the threshold: {pair_scores}
+{format_compact_invoices(list(invoices.values()), "All")}
+Classify the group as a whole and add "notDuplicates": Doc Nos not duplicating the rest ([] if none)."""
+
+def estimate_request_tokens(prompt_text):
+    """Estimated input tokens of one request; the system instruction is billed with every request."""
+    return estimate_tokens(LLM_INSTRUCTIONS) + estimate_tokens(prompt_text)
+
+def expand_cluster_verdict(cluster_df, verdict):
+    """
+    Turn the LLM verdict on a cluster into one verdict per pair of the cluster.
+    Pairs involving an invoice the LLM singled out as not belonging to the group are 'Not likely'.
+    """
+    if verdict.get("classification") in ("Error", "Skipped"):
+        return [dict(verdict) for _ in range(len(cluster_df))]
+
+    excluded = {str(doc_no) for doc_no in verdict.get("notDuplicates") or []}
+    pair_verdict = {key: value for key, value in verdict.items() if key != "notDuplicates"}
+    pair_verdicts = []
+    for _, row in cluster_df.iterrows():
+        outliers = [doc_no for doc_no in (str(row.get('INV1_DOC_NO')), str(row.get('INV2_DOC_NO'))) if doc_no in excluded]
+        if outliers:
+            pair_verdicts.append({
+                "classification": "Not likely",
+                "explanation": f"Invoice {', '.join(outliers)} does not belong to the duplicate group. {verdict.get('explanation', '')}".strip(),
+                "keyFactors": verdict.get("keyFactors", []),
+            })
         else:
-            log_message(f"Warning: Could not parse JSON from LLM response: {response_text}", "WARNING")
-            # Add an error progress marker
-            print(f"PROGRESS:LLM_ITEM_ERROR:{item_num}:{total_items}", flush=True)
-            sys.stdout.flush()
-            return {"classification": "Error", "explanation": "LLM response parsing failed", "keyFactors": []}
-    except Exception as e:
-        error_message = str(e)
-        log_message(f"Error calling Gemini API: {e}", "ERROR")
+            pair_verdicts.append(dict(pair_verdict))
+    return pair_verdicts
+
+def parse_llm_response(response, item_num=None, total_items=None, elapsed_time=0.0):
+    """
+    Turn one provider response into a verdict dict; failed requests become Error verdicts
+    (with the API's retry_delay for rate limit errors).
+    """
+    # Item progress events are only sent for numbered items of a run
+    track_item = bool(item_num and total_items)
+    if response.error is not None:
+        error_message = str(response.error)
+        log_message(f"Error calling the LLM: {error_message}", "ERROR")
+        if track_item:
+            events.emit("llm_item", item=item_num, items=total_items, status="error")
         
         # Handle rate limit errors (HTTP 429)
         if "429" in error_message:
             retry_delay = extract_retry_delay(error_message)
             log_message(f"Rate limit exceeded. API suggests retry in {retry_delay} seconds.", "WARNING")
             # Return a more specific rate limit error with the actual delay value
-            error_result = {
+            return {
                 "classification": "Error", 
                 "explanation": f"API call error: 429 You exceeded your current quota, please check your plan and billing details.", 
                 "keyFactors": [],
                 "retry_delay": retry_delay  # Add the retry delay to the result
             }
-            print(f"PROGRESS:LLM_ITEM_ERROR:{item_num}:{total_items}", flush=True)
-            sys.stdout.flush()
-            return error_result
-        
-        print(f"PROGRESS:LLM_ITEM_ERROR:{item_num}:{total_items}", flush=True)
-        sys.stdout.flush()
         return {"classification": "Error", "explanation": f"API call error: {error_message}", "keyFactors": []}
 
-def classify_pairs_with_llm(scored_pairs_df, api_key=None, batch_size=2, delay_between_calls=4, delay_between_batches=10):  # Process 2 invoices at once
-    # Reduced to 15 requests per minute (4 second delay = ~15 messages/minute)
-    current_api_key = api_key if api_key else GEMINI_API_KEY_ENV
+    token_note = f" ({response.tokens['prompt']} prompt + {response.tokens['response']} response tokens)" if response.tokens else ""
+    log_message(f"LLM response received in {elapsed_time:.2f} seconds{token_note}", "DEBUG")
+
+    # Robust JSON extraction
+    response_text = response.text or ""
+    json_match = response_text[response_text.find('{'):response_text.rfind('}')+1]
+    result = None
+    if json_match:
+        try:
+            result = json.loads(json_match)
+        except json.JSONDecodeError:
+            result = None
+    if isinstance(result, dict):
+        if response.tokens:
+            result["tokens"] = response.tokens
+        # Log a summary of the classification
+        classification = result.get("classification", "Unknown")
+        log_message(f"Item {item_num}/{total_items}: Classified as '{classification}' in {elapsed_time:.2f}s", "INFO")
+        if track_item:
+            events.emit("llm_item", item=item_num, items=total_items, status="end", classification=classification)
+        return result
+
+    log_message(f"Warning: Could not parse JSON from LLM response: {response_text}", "WARNING")
+    if track_item:
+        events.emit("llm_item", item=item_num, items=total_items, status="error")
+    error_result = {"classification": "Error", "explanation": "LLM response parsing failed", "keyFactors": []}
+    if response.tokens:
+        error_result["tokens"] = response.tokens
+    return error_result
+
+def call_llm(provider, prompts, pairs, item_nums=None, total_items=None):
+    """
+    Send a batch of prompts to an LLM provider and return one verdict dict per prompt.
+    """
+    item_nums = item_nums or [None] * len(prompts)
+    for item_num in item_nums:
+        if item_num and total_items:
+            log_message(f"Calling {provider.name} for item {item_num}/{total_items}...", "DEBUG")
+            events.emit("llm_item", item=item_num, items=total_items, status="start")
+
+    start_time = time.time()
+    responses = provider.generate(prompts, pairs)
+    # A batch is generated in one call; attribute its time evenly to its prompts
+    elapsed_time = (time.time() - start_time) / max(len(prompts), 1)
+    results = []
+    for response, item_num in zip(responses, item_nums):
+        result = parse_llm_response(response, item_num, total_items, elapsed_time)
+        if result.get("classification") not in ("Error", "Skipped"):
+            result.setdefault("source", provider.source)
+        results.append(result)
+    return results
+
+def call_gemini_api(prompt_text, genai_model_instance, item_num=None, total_items=None):  # Added item tracking
+    if not genai_model_instance:  # Check passed instance
+        return {"classification": "Skipped", "explanation": "API key not configured or model not initialized", "keyFactors": []}
+    return call_llm(GeminiProvider(genai_model_instance), [prompt_text], [None], [item_num], total_items)[0]
+
+def exact_match_verdict(row):
+    """
+    Deterministic verdict for a pair found by the fingerprint fast path in predict_pairs.py.
+    """
+    fields = str(row.get('match_rule') or '').split('+')
+    readable_fields = [field.lower().replace('_', ' ') for field in fields if field]
+    return {
+        "classification": "Very likely",
+        "explanation": f"Exact duplicate: identical {', '.join(readable_fields)} after normalizing case, "
+                       f"whitespace, amount and date formats. Classified without the LLM.",
+        "keyFactors": [f"identical {field}" for field in readable_fields],
+        "source": "fingerprint",
+    }
+
+def create_gemini_model(api_key=None):
+    """
+    Configure the Gemini SDK and return a model instance, or None if there is no
+    API key or configuration fails. The SDK is imported here, on first use.
+    """
+    current_api_key = api_key if api_key else gemini_api_key_from_env()
     genai_model_instance = None  # Initialize instance
 
     if not current_api_key:
@@ -160,8 +255,8 @@ def classify_pairs_with_llm(scored_pairs_df, api_key=None, batch_size=2, delay_b
     else:
         try:
             log_message("Configuring Gemini API...", "INFO")
-            sys.stdout.flush()
             
+            genai = timed_import("google.generativeai")
             genai.configure(api_key=current_api_key)
             generation_config = {"temperature": 0.7, "top_p": 1, "top_k": 1, "max_output_tokens": 1024}
             safety_settings = [
@@ -172,93 +267,259 @@ def classify_pairs_with_llm(scored_pairs_df, api_key=None, batch_size=2, delay_b
             ]
             genai_model_instance = genai.GenerativeModel(model_name="gemini-1.5-flash",
                                                   generation_config=generation_config,
-                                                  safety_settings=safety_settings)
+                                                  safety_settings=safety_settings,
+                                                  system_instruction=LLM_INSTRUCTIONS)
             log_message("Gemini API configured successfully.", "INFO")
-            sys.stdout.flush()
         except Exception as e:
             log_message(f"Error configuring Gemini API: {e}. LLM classification will be skipped.", "ERROR")
-            sys.stdout.flush()
             # genai_model_instance remains None
+    return genai_model_instance
+
+def bind_gemini_client(model, api_key):
+    """
+    Give a Gemini model its own API client for api_key, built with the public
+    google.ai.generativelanguage client options, so models of several keys can coexist
+    although genai.configure() is global.
 
-    if not genai_model_instance:  # Check if instance was created
-        log_message("Skipping LLM classification as API key is not configured or model initialization failed.", "WARNING")
-        output_df = scored_pairs_df.copy()
-        output_df['llm_classification'] = "Skipped"
-        output_df['llm_explanation'] = "API key not configured or model initialization failed"
-        output_df['llm_key_factors'] = [[] for _ in range(len(output_df))]
-        return output_df
+    Returns False if the model does not keep its client in the _client attribute that
+    GenerativeModel sets up and sends through; a client set elsewhere would be ignored and
+    the model would send with the key configured last.
+    """
+    if "_client" not in vars(model):
+        return False
+    glm = timed_import("google.ai.generativelanguage")
+    client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+    model._client = client
+    return True
 
-    results = []
-    num_rows = len(scored_pairs_df)
-    log_message(f"Starting LLM classification for {num_rows} invoice pairs", "INFO")
-    sys.stdout.flush()
+def create_gemini_pool(api_keys, requests_per_minute=15):
+    """
+    A QuotaPool with one credential per Gemini API key that could be configured, or None.
+
+    Every model is checked to send through its own client for its key. If the installed
+    google-generativeai does not allow that, keys are not pooled: None is returned rather
+    than a pool whose credentials would all send with one key.
+    """
+    credentials = []
+    for number, key in enumerate(api_keys, start=1):
+        model = create_gemini_model(key)
+        if model is None:
+            continue
+        try:
+            bound = bind_gemini_client(model, key)
+        except Exception as e:
+            log_message(f"Could not create a Gemini client for key {number}: {e}", "ERROR")
+            bound = False
+        if not bound:
+            log_message("This google-generativeai version does not let each model use its own API key; "
+                        "the keys are not pooled.", "ERROR")
+            return None
+        credentials.append(Credential(f"key {number} (...{key[-4:]})", model, requests_per_minute))
+    if not credentials:
+        return None
+    log_message(f"Pooling {len(credentials)} Gemini API keys: up to {len(credentials) * requests_per_minute} requests per minute", "INFO")
+    return QuotaPool(credentials)
+
+def create_llm_provider(provider_name="gemini", api_key=None, local_model_path=None, threads=None, local_batch_size=16,
+                        requests_per_minute=15):
+    """
+    Create the LLM provider used for classification (see llm_providers), or None if it
+    cannot be set up. "gemini" needs an API key, "llama" a GGUF model file and llama-cpp-python.
+    With several Gemini keys their quotas of requests_per_minute each are pooled.
+    """
+    if provider_name == "rules":
+        log_message("Using the rule-based local stand-in instead of an LLM.", "INFO")
+        return RulesProvider()
+    if provider_name == "llama":
+        try:
+            log_message(f"Loading local model {local_model_path}...", "INFO")
+            provider = LlamaCppProvider(local_model_path, LLM_INSTRUCTIONS, threads=threads, batch_size=local_batch_size)
+            log_message("Local model loaded.", "INFO")
+            return provider
+        except Exception as e:
+            log_message(f"Error loading local model: {e}. LLM classification will be skipped.", "ERROR")
+            return None
+    api_keys = gemini_api_keys(api_key)
+    if len(api_keys) > 1:
+        pool = create_gemini_pool(api_keys, requests_per_minute)
+        if pool is not None:
+            return PooledGeminiProvider(pool)
+        log_message("Continuing with the first Gemini API key only.", "WARNING")
+    genai_model_instance = create_gemini_model(api_keys[0] if api_keys else None)
+    return GeminiProvider(genai_model_instance) if genai_model_instance is not None else None
+
+def classify_pairs_with_llm(scored_pairs_df, api_key=None, batch_size=2, delay_between_calls=4, delay_between_batches=10,  # Process 2 invoices at once
+                            checkpoint_path=None, budget=None, prioritize=True, triage_bundle=None, triage_confidence=0.95,
+                            cluster_pairs=True, token_usage=None, provider_name="gemini", provider_options=None):
+    # Reduced to 15 requests per minute (4 second delay = ~15 messages/minute)
+    # Verdicts are appended to checkpoint_path as they arrive; pairs already in it are not sent again
+    # Pairs are sent in priority order (see llm_scheduler); once the optional LLMBudget is used up
+    # the remaining pairs are marked as Deferred instead of being sent
+    # Exact fingerprint matches (match_type 'exact') get a deterministic verdict and are never sent
+    # With a triage_bundle (see triage_model), pairs the local model is confident about are auto-labelled
+    # Pairs sharing a cluster_id (see pair_clustering) are judged together in a single request
+    # Tokens used by the requests are accumulated in token_usage (a TokenUsage) if one is passed
+    # provider_name selects the LLM backend (see llm_providers); provider_options are passed to create_llm_provider
+    results = [None] * len(scored_pairs_df)
+    checkpointed_verdicts = load_llm_checkpoint(checkpoint_path)
+    pending_positions = []
+    for position, (_, row) in enumerate(scored_pairs_df.iterrows()):
+        verdict = checkpointed_verdicts.get(pair_key(row))
+        if verdict is not None:
+            results[position] = verdict
+        else:
+            pending_positions.append(position)
+    if len(pending_positions) < len(scored_pairs_df):
+        log_message(f"Resuming: reusing {len(scored_pairs_df) - len(pending_positions)} LLM verdicts from checkpoint", "INFO")
+
+    if 'match_type' in scored_pairs_df.columns:
+        match_types = scored_pairs_df['match_type'].to_numpy()
+        exact_positions = [position for position in pending_positions if match_types[position] == 'exact']
+        for position in exact_positions:
+            results[position] = exact_match_verdict(scored_pairs_df.iloc[position])
+        if exact_positions:
+            pending_positions = [position for position in pending_positions if match_types[position] != 'exact']
+            log_message(f"{len(exact_positions)} exact duplicate pairs labelled from their fingerprints without the LLM", "INFO")
+
+    if triage_bundle is not None:
+        triage_verdicts = triage_pairs(scored_pairs_df, pending_positions, triage_bundle, triage_confidence)
+        for position, verdict in triage_verdicts.items():
+            results[position] = verdict
+        pending_positions = [position for position in pending_positions if position not in triage_verdicts]
+        log_message(f"Triage model auto-labelled {len(triage_verdicts)} pairs; {len(pending_positions)} uncertain pairs left for the LLM", "INFO")
+
+    # The provider (and for Gemini its SDK) is only loaded when checkpoint and triage left pairs for the LLM
+    provider = create_llm_provider(provider_name, api_key, **(provider_options or {})) if pending_positions else None
+    if pending_positions and provider is None:  # Check if the provider was created
+        log_message("Skipping LLM classification as the LLM provider is not configured or failed to initialize.", "WARNING")
+        for position in pending_positions:
+            results[position] = {"classification": "Skipped", "explanation": "LLM provider not configured or initialization failed",
+                                 "keyFactors": [], "source": "none"}
+        pending_positions = []
+
+    if prioritize:
+        pending_positions = order_by_priority(scored_pairs_df, pending_positions)
+        log_message("Pairs ordered by similarity, amount and vendor risk for LLM review", "INFO")
+
+    if cluster_pairs:
+        work_units = group_positions_by_cluster(scored_pairs_df, pending_positions)
+    else:
+        work_units = [[position] for position in pending_positions]
+
+    # Local providers take whole batches at once and are not rate-limited; self-paced remote
+    # providers wait for their own quota, so no delays are added between their calls
+    requests_per_call = provider.max_batch_size if provider is not None else 1
+    rate_limited = provider is not None and provider.remote
+    paced = rate_limited and not provider.self_paced
+    if not paced:
+        batch_size = max(batch_size, requests_per_call)
+
+    num_rows = len(work_units)
+    log_message(f"Starting LLM classification for {len(pending_positions)} invoice pairs in {num_rows} requests"
+                + (f" with {provider.name}" if provider is not None else ""), "INFO")
     
-    # Print overall LLM process start
-    print(f"PROGRESS:LLM_TOTAL_ITEMS:{num_rows}", flush=True)
+    events.emit("llm_total", items=num_rows)
     
+    if token_usage is None:
+        token_usage = TokenUsage()
+    budget_exhausted_reason = None
+    if budget is not None:
+        budget.start()
+
     for i in range(0, num_rows, batch_size):
-        batch_df = scored_pairs_df.iloc[i:i+batch_size]
+        batch_units = work_units[i:i+batch_size]
         current_batch_number = i//batch_size + 1
         total_batches = (num_rows + batch_size -1)//batch_size
         
-        # PROGRESS: LLM Batch with more detailed information
-        print(f"PROGRESS:LLM_BATCH_START:{current_batch_number}:{total_batches}:{i+1}:{min(i+batch_size, num_rows)}:{num_rows}", flush=True)
-        log_message(f"LLM Processing batch {current_batch_number}/{total_batches} (items {i+1}-{min(i+batch_size, num_rows)} of {num_rows})", "INFO")
-        sys.stdout.flush()
+        events.emit("llm_batch_start", batch=current_batch_number, batches=total_batches,
+                    first=i + 1, last=min(i + batch_size, num_rows), items=num_rows)
+        log_message(f"LLM Processing batch {current_batch_number}/{total_batches} (items {i+1}-{min(i+batch_size, num_rows)} of {num_rows})", "DEBUG")
         
-        batch_results = []
         batch_start_time = time.time()
         
-        for idx, (index, row) in enumerate(batch_df.iterrows()):
-            item_num = i + idx + 1
-            prompt = generate_llm_prompt(row)
-            log_message(f"Processing item {item_num}/{num_rows} in batch {current_batch_number}", "INFO")
-            sys.stdout.flush()
-            
-            # Process the item with added detail
-            api_result = call_gemini_api(prompt, genai_model_instance, item_num, num_rows)  # Pass instance
-            batch_results.append(api_result)
+        for chunk_start in range(0, len(batch_units), requests_per_call):
+            # Prompts handed to the provider in one call: (item number, unit, unit rows, prompt)
+            chunk = []
+            chunk_tokens = 0
+            for idx in range(chunk_start, min(chunk_start + requests_per_call, len(batch_units))):
+                item_num = i + idx + 1
+                unit = batch_units[idx]
+                unit_df = scored_pairs_df.iloc[unit]
+                prompt = generate_llm_prompt(unit_df.iloc[0]) if len(unit) == 1 else generate_cluster_prompt(unit_df)
+                if budget is not None:
+                    budget_exhausted_reason = budget.exhausted_reason(chunk_tokens + estimate_request_tokens(prompt), queued_requests=len(chunk))
+                    if budget_exhausted_reason:
+                        break
+                    chunk_tokens += estimate_request_tokens(prompt)
+                log_message(f"Processing item {item_num}/{num_rows} in batch {current_batch_number}", "DEBUG")
+                chunk.append((item_num, unit, unit_df, prompt))
+            if not chunk:
+                break
+
+            api_results = call_llm(provider, [prompt for _, _, _, prompt in chunk], [unit_df for _, _, unit_df, _ in chunk],
+                                   [item_num for item_num, _, _, _ in chunk], num_rows)
+            for (item_num, unit, unit_df, prompt), api_result in zip(chunk, api_results):
+                # Local providers cost no quota; their tokens are only counted when they report them
+                prompt_tokens, _ = token_usage.record(LLM_INSTRUCTIONS + prompt if rate_limited else None, api_result.pop("tokens", None))
+                unit_verdicts = [api_result] if len(unit) == 1 else expand_cluster_verdict(unit_df, api_result)
+                for position, (_, row), verdict in zip(unit, unit_df.iterrows(), unit_verdicts):
+                    results[position] = verdict
+                    if checkpoint_path and verdict.get("classification") not in ("Error", "Skipped"):
+                        append_llm_checkpoint(checkpoint_path, pair_key(row), verdict)
+                if budget is not None:
+                    budget.record(prompt_tokens)
+            if budget_exhausted_reason:
+                break
             
             # Check if we hit a rate limit and need to adjust our delay
             current_delay = delay_between_calls
-            if "retry_delay" in api_result:
+            if "retry_delay" in api_results[-1]:
                 # We hit a rate limit, use the suggested retry delay from the API
-                current_delay = api_result["retry_delay"]
+                current_delay = api_results[-1]["retry_delay"]
                 log_message(f"Rate limit hit: Using API suggested delay of {current_delay}s for next request", "WARNING")
             
             # Rate limiting with feedback
-            if idx < len(batch_df) - 1 and genai_model_instance and current_delay > 0:
-                log_message(f"Rate limiting: waiting {current_delay}s before next API call...", "INFO")
-                sys.stdout.flush()
+            if chunk_start + requests_per_call < len(batch_units) and paced and current_delay > 0:
+                log_message(f"Rate limiting: waiting {current_delay}s before next API call...", "DEBUG")
                 time.sleep(current_delay)  # Use the current_delay (either default or from API)
         
-        results.extend(batch_results)
-        
         # Batch completion timing and progress update
         batch_elapsed_time = time.time() - batch_start_time
         log_message(f"Batch {current_batch_number}/{total_batches} completed in {batch_elapsed_time:.2f} seconds", "INFO")
-        sys.stdout.flush()
         
-        # Progress update after batch completion with more detailed information
-        print(f"PROGRESS:LLM_BATCH_END:{current_batch_number}:{total_batches}:{batch_elapsed_time:.2f}", flush=True)
-        log_message(f"Completed batch {current_batch_number}/{total_batches}", "INFO")
-        sys.stdout.flush()
-
-        if i + batch_size < num_rows and genai_model_instance and delay_between_batches > 0:
-            log_message(f"Waiting {delay_between_batches}s before next batch...", "INFO")
-            sys.stdout.flush()
+        events.emit("llm_batch_end", batch=current_batch_number, batches=total_batches, seconds=round(batch_elapsed_time, 2))
+
+        if budget is not None and not budget_exhausted_reason:
+            budget_exhausted_reason = budget.exhausted_reason()
+        if budget_exhausted_reason:
+            break
+
+        if i + batch_size < num_rows and paced and delay_between_batches > 0:
+            log_message(f"Waiting {delay_between_batches}s before next batch...", "DEBUG")
             time.sleep(delay_between_batches)
     
+    if budget_exhausted_reason:
+        deferred_positions = [position for position in pending_positions if results[position] is None]
+        for position in deferred_positions:
+            results[position] = deferred_result(budget_exhausted_reason)
+        log_message(f"LLM budget exhausted ({budget_exhausted_reason}): {len(deferred_positions)} lower-priority pairs deferred", "WARNING")
+        events.emit("llm_deferred", pairs=len(deferred_positions))
+    if budget is not None:
+        log_message(f"LLM budget used: {budget.summary()}", "INFO")
+    if token_usage.requests:
+        log_message(f"LLM token usage: {token_usage.summary()}", "INFO")
+    if provider is not None and provider.usage_summary():
+        log_message(f"LLM credential usage: {provider.usage_summary()}", "INFO")
+
     output_df = scored_pairs_df.copy()
     output_df['llm_classification'] = [r.get("classification", "Error") for r in results]
     output_df['llm_explanation'] = [r.get("explanation", "N/A") for r in results]
     output_df['llm_key_factors'] = [r.get("keyFactors", []) for r in results]
+    output_df['llm_source'] = [r.get("source", "llm") for r in results]
     
     # Count classification results
     classification_counts = output_df['llm_classification'].value_counts().to_dict()
     log_message(f"LLM Classification complete. Results: {classification_counts}", "INFO")
-    sys.stdout.flush()
     
-    # PROGRESS: LLM End with classification counts
-    print(f"PROGRESS:LLM_END:{json.dumps(classification_counts)}", flush=True)
+    events.emit("llm_end", counts=classification_counts)
     return output_df
@@ -0,0 +1,237 @@
+# filepath: backend/llm_providers.py
+"""
+LLM backends for llm_classifier.
+
+A provider turns a batch of prompts into raw response texts; parsing the JSON verdicts,
+progress events and rate limiting stay in llm_classifier. Besides Gemini there are two
+offline providers that need no network or quota:
+
+- "llama": a quantized GGUF model run on CPU through llama-cpp-python (optional dependency)
+- "rules": a deterministic stand-in that judges pairs from the triage features, useful to
+  benchmark and test the pipeline without any model
+"""
+import os
+import re
+import json
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from import_timing import timed_import
+from triage_model import pair_features, describe_factors
+
+LLM_PROVIDERS = ("gemini", "llama", "rules")
+
+def extract_retry_delay(error_message):
+    """Extract retry_delay value from the API error message."""
+    try:
+        match = re.search(r'retry_delay\s*{\s*seconds:\s*(\d+)\s*}', error_message)
+        if match:
+            return int(match.group(1))
+        return 60  # Default retry delay if not found
+    except Exception:
+        return 60  # Default retry delay if there's any error
+
+class LLMResponse:
+    """
+    Raw result of one prompt: the response text and, if the backend reports them, the
+    prompt and response token counts. error is set instead when the request failed.
+    """
+
+    def __init__(self, text=None, tokens=None, error=None):
+        self.text = text
+        self.tokens = tokens
+        self.error = error
+
+class LLMProvider:
+    """
+    Interface of an LLM backend.
+
+    remote providers are rate-limited between requests and billed in tokens, unless they are
+    self_paced and wait for their quota themselves; local ones are sent max_batch_size
+    prompts per generate() call without delays. source is stored in the llmAnalysis of
+    their verdicts.
+    """
+    name = None
+    source = "llm"
+    remote = False
+    self_paced = False
+    max_batch_size = 1
+
+    def usage_summary(self):
+        """Per-credential usage to log at the end of a run, or None."""
+        return None
+
+    def generate(self, prompts, pairs):
+        """
+        Run a batch of prompts.
+
+        Args:
+            prompts: Prompt texts (the instructions are set on the provider)
+            pairs: For each prompt, the DataFrame of scored pairs it describes
+
+        Returns:
+            One LLMResponse per prompt
+        """
+        raise NotImplementedError
+
+class GeminiProvider(LLMProvider):
+    """Gemini through a configured google.generativeai model (see create_gemini_model)."""
+    name = "gemini"
+    remote = True
+
+    def __init__(self, model):
+        self.model = model
+
+    def generate(self, prompts, pairs):
+        responses = []
+        for prompt in prompts:
+            try:
+                response = self.model.generate_content(prompt)
+                responses.append(LLMResponse(response.text.strip(), gemini_token_counts(response)))
+            except Exception as e:
+                responses.append(LLMResponse(error=e))
+        return responses
+
+def gemini_token_counts(response):
+    """
+    Prompt and response token counts from the usage metadata of a Gemini response, or None.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None or getattr(usage, "prompt_token_count", None) is None:
+        return None
+    return {"prompt": int(usage.prompt_token_count), "response": int(getattr(usage, "candidates_token_count", 0) or 0)}
+
+class PooledGeminiProvider(LLMProvider):
+    """
+    Gemini through several API keys whose quotas are pooled (see quota_pool.QuotaPool).
+
+    The prompts of a batch are sent concurrently, one thread per credential, and every
+    request waits for a credential with free capacity. A 429 pauses that credential for the
+    retry_delay the API asks for, and the request is retried on the next free one.
+    """
+    name = "gemini"
+    remote = True
+    self_paced = True
+
+    def __init__(self, pool, max_attempts=None):
+        self.pool = pool
+        # Enough prompts per call to keep every credential busy
+        self.max_batch_size = 4 * len(pool.credentials)
+        self.max_attempts = max_attempts or 2 * len(pool.credentials) + 1
+
+    def generate(self, prompts, pairs):
+        if not prompts:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(prompts), len(self.pool.credentials))) as executor:
+            return list(executor.map(self.send, prompts))
+
+    def send(self, prompt):
+        error = None
+        for _ in range(self.max_attempts):
+            credential = self.pool.acquire()
+            try:
+                response = credential.client.generate_content(prompt)
+                return LLMResponse(response.text.strip(), gemini_token_counts(response))
+            except Exception as e:
+                if "429" not in str(e):
+                    return LLMResponse(error=e)
+                error = e
+                self.pool.back_off(credential, extract_retry_delay(str(e)))
+        return LLMResponse(error=error)
+
+    def usage_summary(self):
+        return self.pool.summary()
+
+class LlamaCppProvider(LLMProvider):
+    """
+    A local GGUF model (e.g. a 4-bit quantized 1-3B instruct model) on CPU via llama-cpp-python.
+
+    The instructions are the same system message for every prompt, so with the prompt cache
+    their evaluated state is reused and only the pair data is processed per prompt.
+    llama-cpp-python's high-level API decodes one sequence at a time, so a batch is
+    generated back to back in one call, without network round-trips or delays.
+    """
+    name = "llama"
+    source = "local-llm"
+
+    def __init__(self, model_path, instructions, threads=None, context_size=4096, max_tokens=256, batch_size=16):
+        if not model_path or not os.path.exists(model_path):
+            raise FileNotFoundError(f"Local model not found: {model_path}")
+        llama_cpp = timed_import("llama_cpp")
+        self.model = llama_cpp.Llama(model_path=model_path, n_ctx=context_size, n_threads=threads, verbose=False)
+        self.model.set_cache(llama_cpp.LlamaRAMCache())
+        self.instructions = instructions
+        self.max_tokens = max_tokens
+        self.max_batch_size = batch_size
+
+    def generate(self, prompts, pairs):
+        responses = []
+        for prompt in prompts:
+            try:
+                completion = self.model.create_chat_completion(
+                    messages=[{"role": "system", "content": self.instructions},
+                              {"role": "user", "content": prompt}],
+                    temperature=0.0,
+                    max_tokens=self.max_tokens,
+                    response_format={"type": "json_object"},
+                )
+                usage = completion.get("usage") or {}
+                tokens = {"prompt": usage["prompt_tokens"], "response": usage.get("completion_tokens", 0)} if "prompt_tokens" in usage else None
+                responses.append(LLMResponse(completion["choices"][0]["message"]["content"].strip(), tokens))
+            except Exception as e:
+                responses.append(LLMResponse(error=e))
+        return responses
+
+def rule_classification(feature_row):
+    """
+    Deterministic verdict from the triage features of one pair.
+    """
+    if feature_row["same_currency"] == 0:
+        return "Not likely"
+    same_vendor = feature_row["same_vendor_id"] == 1 or feature_row["vendor_name_overlap"] >= 0.8
+    rel_diff = feature_row["amount_rel_diff"] if pd.notna(feature_row["amount_rel_diff"]) else 1.0
+    date_gap = feature_row["date_gap_days"] if pd.notna(feature_row["date_gap_days"]) else 0.0
+    if same_vendor and rel_diff <= 0.001 and date_gap <= 7:
+        return "Very likely"
+    if same_vendor and rel_diff <= 0.02 and date_gap <= 45:
+        return "Likely"
+    if feature_row["similarity"] >= 0.97 and rel_diff <= 0.05:
+        return "Likely"
+    return "Not likely"
+
+class RulesProvider(LLMProvider):
+    """
+    Offline stand-in for the LLM that answers from fixed rules on vendor, amount, currency
+    and date. Its responses have the LLM's JSON format, so the rest of the pipeline runs unchanged.
+    """
+    name = "rules"
+    source = "rules"
+    max_batch_size = 256
+
+    def generate(self, prompts, pairs):
+        return [LLMResponse(json.dumps(self.judge(pairs_df))) for pairs_df in pairs]
+
+    def judge(self, pairs_df):
+        features = pair_features(pairs_df)
+        classifications = [rule_classification(feature_row) for _, feature_row in features.iterrows()]
+        if len(pairs_df) == 1:
+            return {
+                "classification": classifications[0],
+                "explanation": "Rule-based local verdict on vendor, amount, currency and invoice date.",
+                "keyFactors": describe_factors(features.iloc[0]),
+            }
+
+        # A group: invoices with no likely partner in the group do not belong to it
+        linked = set()
+        for (_, row), classification in zip(pairs_df.iterrows(), classifications):
+            if classification != "Not likely":
+                linked.update((str(row.get("INV1_DOC_NO")), str(row.get("INV2_DOC_NO"))))
+        doc_nos = {str(doc_no) for column in ("INV1_DOC_NO", "INV2_DOC_NO") for doc_no in pairs_df[column]}
+        ranks = ["Not likely", "Likely", "Very likely"]
+        group_classification = max((c for c in classifications if c != "Not likely"), key=ranks.index, default="Not likely")
+        return {
+            "classification": group_classification,
+            "explanation": "Rule-based local verdict on vendor, amount, currency and invoice date for the group.",
+            "keyFactors": describe_factors(features.iloc[0]),
+            "notDuplicates": sorted(doc_nos - linked) if linked else [],
+        }
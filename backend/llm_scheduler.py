@@ -0,0 +1,162 @@
+# filepath: backend/llm_scheduler.py
+import time
+import numpy as np
+import pandas as pd
+
+# Weights of the cheap risk features added to the SBERT similarity
+AMOUNT_WEIGHT = 0.3       # Larger invoices are more costly to pay twice
+SAME_VENDOR_WEIGHT = 0.1  # Same vendor ID on both invoices
+SAME_AMOUNT_WEIGHT = 0.1  # Identical amounts (within a cent)
+
+DEFERRED_CLASSIFICATION = "Deferred"
+
+def priority_scores(scored_pairs_df):
+    """
+    Rank invoice pairs for LLM review: SBERT similarity plus cheap risk features
+    (invoice amount on a log scale, same vendor, identical amount).
+    Returns a numpy array with one score per row; higher means review first.
+    """
+    if scored_pairs_df.empty:
+        return np.zeros(0)
+
+    def column(name, numeric=False):
+        if name not in scored_pairs_df.columns:
+            return pd.Series(np.nan, index=scored_pairs_df.index)
+        values = scored_pairs_df[name]
+        return pd.to_numeric(values, errors='coerce') if numeric else values
+
+    similarity = column('similarity', numeric=True).fillna(0.0).to_numpy()
+
+    amount1 = column('INV1_AMOUNT', numeric=True).abs()
+    amount2 = column('INV2_AMOUNT', numeric=True).abs()
+    largest_amount = np.fmax(amount1.to_numpy(), amount2.to_numpy())
+    log_amount = np.log10(1.0 + np.nan_to_num(largest_amount, nan=0.0))
+    amount_factor = log_amount / log_amount.max() if log_amount.max() > 0 else np.zeros(len(log_amount))
+
+    vendor1 = column('INV1_VENDOR_ID').astype(str)
+    vendor2 = column('INV2_VENDOR_ID').astype(str)
+    same_vendor = ((vendor1 == vendor2) & column('INV1_VENDOR_ID').notna()).to_numpy()
+
+    same_amount = (np.abs(amount1 - amount2) < 0.01).fillna(False).to_numpy()
+
+    return (similarity
+            + AMOUNT_WEIGHT * amount_factor
+            + SAME_VENDOR_WEIGHT * same_vendor
+            + SAME_AMOUNT_WEIGHT * same_amount)
+
+def order_by_priority(scored_pairs_df, positions):
+    """
+    Sort row positions of scored_pairs_df by descending priority score (stable for ties).
+    """
+    scores = priority_scores(scored_pairs_df)
+    return sorted(positions, key=lambda position: -scores[position])
+
+def estimate_tokens(text):
+    """
+    Rough token estimate for budget checks before the real usage is known (~4 characters per token).
+    """
+    return max(1, len(text) // 4)
+
+class LLMBudget:
+    """
+    Upper bounds on the LLM work of one run. Any limit left as None is unbounded.
+    """
+
+    def __init__(self, max_requests=None, max_tokens=None, max_seconds=None):
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+        self.requests = 0
+        self.tokens = 0
+        self.start_time = None
+
+    def start(self):
+        """Start the wall-clock budget; called when the first request is about to be sent."""
+        if self.start_time is None:
+            self.start_time = time.time()
+
+    def elapsed(self):
+        return time.time() - self.start_time if self.start_time is not None else 0.0
+
+    def exhausted_reason(self, next_request_tokens=0, queued_requests=0):
+        """
+        Return why the next request would exceed the budget, or None if it fits.
+        queued_requests are requests about to be sent in the same batch but not recorded yet;
+        next_request_tokens then covers their tokens too.
+        """
+        if self.max_requests is not None and self.requests + queued_requests >= self.max_requests:
+            return f"request budget of {self.max_requests} reached"
+        if self.max_tokens is not None and self.tokens + next_request_tokens > self.max_tokens:
+            return f"token budget of {self.max_tokens} reached"
+        if self.max_seconds is not None and self.elapsed() >= self.max_seconds:
+            return f"time budget of {self.max_seconds:.0f}s reached"
+        return None
+
+    def record(self, tokens):
+        """Account for one sent request."""
+        self.requests += 1
+        self.tokens += tokens
+
+    def remaining_seconds(self):
+        if self.max_seconds is None:
+            return None
+        return max(0.0, self.max_seconds - self.elapsed())
+
+    def summary(self):
+        return {
+            "requests": self.requests,
+            "tokens": self.tokens,
+            "seconds": round(self.elapsed(), 2),
+            "maxRequests": self.max_requests,
+            "maxTokens": self.max_tokens,
+            "maxSeconds": self.max_seconds,
+        }
+
+class TokenUsage:
+    """
+    Tokens consumed by the LLM requests of one run. Counts reported by the API are used where
+    available; requests without usage metadata (errors, other SDKs) fall back to estimate_tokens.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        self.estimated_requests = 0
+
+    def record(self, prompt_text, tokens=None):
+        """
+        Account for one sent request and return its (prompt, response) token counts.
+        tokens is the {"prompt": ..., "response": ...} dict returned by call_gemini_api, if any.
+        prompt_text is None for local providers, whose unreported tokens are not estimated.
+        """
+        self.requests += 1
+        if tokens and tokens.get("prompt") is not None:
+            prompt_tokens, response_tokens = tokens["prompt"], tokens.get("response") or 0
+        elif prompt_text is None:
+            prompt_tokens, response_tokens = 0, 0
+        else:
+            prompt_tokens, response_tokens = estimate_tokens(prompt_text), 0
+            self.estimated_requests += 1
+        self.prompt_tokens += prompt_tokens
+        self.response_tokens += response_tokens
+        return prompt_tokens, response_tokens
+
+    def summary(self):
+        return {
+            "requests": self.requests,
+            "promptTokens": self.prompt_tokens,
+            "responseTokens": self.response_tokens,
+            "totalTokens": self.prompt_tokens + self.response_tokens,
+            "promptTokensPerRequest": round(self.prompt_tokens / self.requests, 1) if self.requests else 0.0,
+            "estimatedRequests": self.estimated_requests,
+        }
+
+def deferred_result(reason):
+    """
+    LLM result placeholder for a pair that was not sent because the budget ran out.
+    """
+    return {"classification": DEFERRED_CLASSIFICATION,
+            "explanation": f"Not sent to the LLM: {reason}. Resume the run or raise the budget to classify it.",
+            "keyFactors": [],
+            "source": "none"}
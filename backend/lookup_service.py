@@ -0,0 +1,251 @@
+# filepath: backend/lookup_service.py
+"""
+Single-invoice duplicate lookup against a prebuilt invoice index (see content/invoice_index.py).
+
+The index and the SBERT model are loaded once; each request then takes one invoice record
+and returns its scored matches. Requests are read as JSON lines from stdin or served over
+local HTTP. Verdicts come from exact fingerprints and the local triage model, which stands
+in for the LLM so lookups work offline; an LLM provider is only called with --llm.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import pandas as pd
+
+from llm_classifier import exact_match_verdict, generate_llm_prompt, call_llm, create_llm_provider
+from triage_model import load_triage_model, triage_pairs, pair_features, describe_factors, TRIAGE_SOURCE
+from utils import map_invoice_data_to_json, custom_json_serializer
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTENT_DIR = os.path.join(os.path.dirname(BASE_DIR), 'content')
+SBERT_MODEL_PATH = os.path.join(CONTENT_DIR, 'invoice_sbert')
+
+# The index and model code live next to predict_pairs.py
+sys.path.insert(0, CONTENT_DIR)
+from invoice_index import InvoiceIndex, invoice_frame
+from predict_pairs import load_model
+
+def log_message(message, message_type="INFO"):
+    """
+    Log a message to stderr; stdout carries the responses in stdin mode.
+    """
+    timestamp = datetime.now().strftime("%H:%M:%S")
+    print(f"[{timestamp}] [{message_type}] {message}", file=sys.stderr, flush=True)
+
+def no_verdict(reason):
+    return {"classification": "Skipped", "explanation": reason, "keyFactors": [], "source": "none"}
+
+def standin_verdicts(matches_df, positions, bundle):
+    """
+    Offline stand-in for the LLM: label the pairs the triage model is not confident about
+    by its duplicate probability alone.
+    """
+    if not positions:
+        return {}
+    features = pair_features(matches_df.iloc[positions])
+    probabilities = bundle["estimator"].predict_proba(features)[:, 1]
+    verdicts = {}
+    for position, probability, (_, feature_row) in zip(positions, probabilities, features.iterrows()):
+        verdicts[position] = {
+            "classification": "Likely" if probability >= 0.5 else "Not likely",
+            "explanation": f"Uncertain pair labelled offline by the local triage model (duplicate probability {probability:.2f}); not sent to the LLM.",
+            "keyFactors": describe_factors(feature_row),
+            "source": TRIAGE_SOURCE,
+        }
+    return verdicts
+
+class LookupService:
+    """
+    Loaded invoice index, SBERT model and verdict sources for answering lookup requests.
+    """
+
+    def __init__(self, index_dir, model_path=SBERT_MODEL_PATH, threshold=None, neighbours=10,
+                 triage_model_path=None, triage_confidence=0.95, use_llm=False, api_key=None,
+                 llm_provider="gemini", local_model_path=None):
+        start = time.perf_counter()
+        self.index = InvoiceIndex(index_dir)
+        log_message(f"Loaded index of {len(self.index.df)} invoices from {index_dir}")
+        self.model, self.device = load_model(model_path)
+        # The first encode call initializes the model's kernels; do it now rather than on the first request
+        self.model.encode(["warm-up"], show_progress_bar=False)
+        self.threshold = threshold
+        self.neighbours = neighbours
+        self.triage_confidence = triage_confidence
+
+        self.triage_bundle = None
+        if triage_model_path:
+            self.triage_bundle = load_triage_model(triage_model_path)
+            log_message(f"Loaded triage model trained on {self.triage_bundle['trained_pairs']} pairs")
+
+        self.llm_provider = None
+        if use_llm:
+            provider_options = {"local_model_path": local_model_path} if llm_provider == "llama" else {}
+            self.llm_provider = create_llm_provider(llm_provider, api_key, **provider_options)
+            if self.llm_provider is None:
+                log_message(f"LLM provider {llm_provider} is not available; uncertain matches are labelled offline.", "WARNING")
+        log_message(f"Lookup service ready in {time.perf_counter() - start:.2f}s")
+
+    def verdicts(self, matches_df):
+        """
+        One LLM-style verdict per match: exact fingerprint matches are labelled directly,
+        then the triage model labels the pairs it is confident about, and the rest go to
+        the LLM provider if enabled or to the offline stand-in otherwise. Also returns the LLM tokens used.
+        """
+        results = {}
+        pending = []
+        llm_tokens = 0
+        for position, match_type in enumerate(matches_df['match_type']):
+            if match_type == 'exact':
+                results[position] = exact_match_verdict(matches_df.iloc[position])
+            else:
+                pending.append(position)
+
+        if self.triage_bundle is not None and pending:
+            results.update(triage_pairs(matches_df, pending, self.triage_bundle, self.triage_confidence))
+            pending = [position for position in pending if position not in results]
+
+        if self.llm_provider is not None and pending:
+            prompts = [generate_llm_prompt(matches_df.iloc[position]) for position in pending]
+            pairs = [matches_df.iloc[[position]] for position in pending]
+            # Local providers take all pending matches in one call; Gemini sends them one by one
+            for start in range(0, len(pending), self.llm_provider.max_batch_size):
+                end = start + self.llm_provider.max_batch_size
+                for position, verdict in zip(pending[start:end], call_llm(self.llm_provider, prompts[start:end], pairs[start:end])):
+                    llm_tokens += sum((verdict.pop("tokens", None) or {}).values())
+                    results[position] = verdict
+        elif self.triage_bundle is not None:
+            results.update(standin_verdicts(matches_df, pending, self.triage_bundle))
+        else:
+            for position in pending:
+                results[position] = no_verdict("No verdict source configured; start the service with --triage-model or --llm.")
+        return [results[position] for position in range(len(matches_df))], llm_tokens
+
+    def lookup(self, request):
+        """
+        Answer one request: either an invoice record keyed by the input CSV column names, or
+        {"invoice": record, "threshold": ..., "neighbours": ...} to override the defaults.
+        """
+        start = time.perf_counter()
+        record = request.get("invoice", request)
+        threshold = request.get("threshold", self.threshold) if "invoice" in request else self.threshold
+        neighbours = request.get("neighbours", self.neighbours) if "invoice" in request else self.neighbours
+
+        query_df = invoice_frame([record], self.index.df.columns)
+        matches_df, timings = self.index.lookup(query_df, self.model, self.device, threshold=threshold, neighbours=neighbours)
+        verdict_start = time.perf_counter()
+        verdicts, llm_tokens = self.verdicts(matches_df) if not matches_df.empty else ([], 0)
+        timings['verdict_ms'] = (time.perf_counter() - verdict_start) * 1000
+
+        matches = []
+        for (_, row), verdict in zip(matches_df.iterrows(), verdicts):
+            doc = map_invoice_data_to_json(row, "INV2")
+            amount = row.get('INV1_AMOUNT')
+            amount_diff = abs(float(amount) - doc["amount"]) if pd.notna(amount) and doc["amount"] is not None else None
+            matches.append({
+                "score": float(row['similarity']),
+                "matchType": row['match_type'],
+                "matchRule": row['match_rule'] if pd.notna(row['match_rule']) else None,
+                "candidateSource": row['candidate_source'].split('+'),
+                "doc": doc,
+                "amountDiff": amount_diff,
+                "llmAnalysis": verdict,
+            })
+        timings['total_ms'] = (time.perf_counter() - start) * 1000
+        return {
+            "invoice": map_invoice_data_to_json(query_df.add_prefix('INV1_').iloc[0], "INV1"),
+            "threshold": threshold if threshold is not None else self.index.threshold,
+            "candidates": timings.pop('candidates'),
+            "matches": matches,
+            "timingsMs": {name: round(value, 2) for name, value in timings.items()},
+            "llmTokens": llm_tokens,
+        }
+
+def serve_stdin(service, output):
+    """Answer one JSON request per input line with one JSON response line."""
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            response = service.lookup(json.loads(line))
+        except Exception as e:
+            response = {"error": str(e)}
+        output.write(json.dumps(response, default=custom_json_serializer) + "\n")
+        output.flush()
+
+def serve_http(service, host, port):
+    """Serve POST /lookup (JSON invoice in, JSON matches out) and GET /health."""
+    class LookupHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, payload):
+            body = json.dumps(payload, default=custom_json_serializer).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, {"status": "ok", "invoices": len(service.index.df)})
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/lookup":
+                self.send_json(404, {"error": "not found"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            except (ValueError, json.JSONDecodeError) as e:
+                self.send_json(400, {"error": f"invalid JSON: {e}"})
+                return
+            try:
+                self.send_json(200, service.lookup(request))
+            except Exception as e:
+                log_message(f"Lookup failed: {e}", "ERROR")
+                self.send_json(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            log_message(format % args)
+
+    server = HTTPServer((host, port), LookupHandler)
+    log_message(f"Serving lookups on http://{host}:{port}/lookup")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Look up duplicates of single invoices against a prebuilt invoice index.")
+    parser.add_argument("--index", required=True, help="Index directory built with content/invoice_index.py.")
+    parser.add_argument("--model", default=SBERT_MODEL_PATH, help="Path to the SBERT model the index was built with.")
+    parser.add_argument("--threshold", type=float, default=None, help="Similarity threshold (defaults to the one the index was built with).")
+    parser.add_argument("--neighbours", type=int, default=10, help="Nearest neighbours added to the blocking candidates (0 = blocking only).")
+    parser.add_argument("--triage-model", default=None, help="Local triage model used as the offline stand-in for the LLM.")
+    parser.add_argument("--triage-confidence", type=float, default=0.95, help="Minimum triage model confidence to label a pair without Gemini.")
+    parser.add_argument("--llm", action="store_true", help="Send matches the triage model is unsure about to the LLM provider.")
+    parser.add_argument("--llm-provider", choices=["gemini", "llama", "rules"], default="gemini", help="LLM backend used with --llm.")
+    parser.add_argument("--local-model", default=None, help="GGUF model file for --llm-provider llama.")
+    parser.add_argument("--api_key", default=None, help="Gemini API Key, or several comma-separated keys whose quotas are pooled.")
+    parser.add_argument("--http", type=int, default=None, metavar="PORT", help="Serve over HTTP on this port instead of reading stdin.")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind the HTTP server to.")
+
+    args = parser.parse_args()
+
+    # In stdin mode stdout only carries responses; everything else printed while loading or classifying goes to stderr
+    responses = sys.stdout
+    sys.stdout = sys.stderr
+
+    service = LookupService(args.index, args.model, threshold=args.threshold, neighbours=args.neighbours,
+                            triage_model_path=args.triage_model, triage_confidence=args.triage_confidence,
+                            use_llm=args.llm, api_key=args.api_key, llm_provider=args.llm_provider,
+                            local_model_path=args.local_model)
+    if args.http is not None:
+        serve_http(service, args.host, args.http)
+    else:
+        serve_stdin(service, responses)
@@ -1,16 +1,20 @@
 # filepath: backend/main.py
+import time
+STARTUP_TIME = time.perf_counter()
+
 import argparse
 import json
 import os
+import sys
 import uuid
-import time
+import shutil
 from datetime import datetime
-import pandas as pd
-import sys
 
-from pair_predictor import get_sbert_predictions
-from llm_classifier import classify_pairs_with_llm
-from utils import format_output_json, custom_json_serializer
+# Only the standard library is imported up front so the UI gets its first PROGRESS event
+# immediately; pandas, the Gemini SDK and scikit-learn are imported by the stage that needs them
+from import_timing import timed_import, import_time_report
+from run_state import load_run_state, save_run_state
+from event_channel import events, VERBOSITY_LEVELS
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CONTENT_DIR = os.path.join(os.path.dirname(BASE_DIR), 'content')
@@ -20,22 +24,27 @@ SBERT_MODEL_PATH = os.path.join(CONTENT_DIR, 'invoice_sbert')
 THRESHOLD_PATH = os.path.join(CONTENT_DIR, 'best_threshold.txt')
 PREDICT_PAIRS_SCRIPT_PATH = os.path.join(CONTENT_DIR, 'predict_pairs.py')
 
+def user_cache_dir(app_name="PayGuard"):
+    """
+    Per-user cache directory of the app. content/ may be installed read-only with the app
+    (Program Files, /Applications), so caches kept across runs go here instead.
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+    elif sys.platform == "darwin":
+        base = os.path.join(os.path.expanduser("~"), "Library", "Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, app_name)
+
+FIELD_CACHE_DIR = os.path.join(user_cache_dir(), "field_cache")
+
 # Add a custom logging function
 def log_message(message, message_type="INFO"):
     """
-    Log a message to both stdout and stderr if it's an error
-    to ensure visibility in both UI and terminal.
+    Log a message for the UI and terminal (errors also go to stderr); see event_channel.
     """
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    formatted_message = f"[{timestamp}] [{message_type}] {message}"
-    
-    print(formatted_message, flush=True)
-    if message_type == "ERROR":
-        print(formatted_message, file=sys.stderr, flush=True)
-    
-    # For progress updates, add a special marker for the UI
-    if message_type == "PROGRESS":
-        print(f"PROGRESS:{message}", flush=True)
+    events.log(message, message_type)
 
 def delete_output_file(file_path):
     """
@@ -89,13 +98,9 @@ def cleanup_old_outputs(output_dir_base, max_age_days=7, keep_latest=5):
         for dir_path in dirs_to_check:
             dir_age = current_time - os.path.getctime(dir_path)
             if dir_age > max_age_seconds:
-                # Delete the directory and all its contents
+                # Delete the directory and all its contents (including checkpoints)
                 try:
-                    for item in os.listdir(dir_path):
-                        item_path = os.path.join(dir_path, item)
-                        if os.path.isfile(item_path):
-                            os.remove(item_path)
-                    os.rmdir(dir_path)
+                    shutil.rmtree(dir_path)
                     log_message(f"Cleaned up old output directory: {dir_path}", "INFO")
                 except Exception as e:
                     log_message(f"Error cleaning up directory {dir_path}: {e}", "ERROR")
@@ -105,52 +110,169 @@ def cleanup_old_outputs(output_dir_base, max_age_days=7, keep_latest=5):
         log_message(f"Error during cleanup: {e}", "ERROR")
         return False
 
-def process_invoices(input_csv_path, output_dir_base, api_key=None):
-    # Clean up old output directories first
-    cleanup_old_outputs(output_dir_base)
-    
-    # Create a unique subdirectory for this run's outputs
-    run_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    output_dir = os.path.join(output_dir_base, f"run_{run_timestamp}")
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+def find_resume_dir(output_dir_base, resume):
+    """
+    Resolve the run directory to resume: an explicit path,
+    or the most recently modified run_* directory for "latest".
+    """
+    if resume != "latest":
+        return resume if os.path.isdir(resume) else None
+
+    if not os.path.exists(output_dir_base):
+        return None
+    run_dirs = [os.path.join(output_dir_base, item) for item in os.listdir(output_dir_base)
+                if item.startswith("run_") and os.path.isdir(os.path.join(output_dir_base, item))]
+    return max(run_dirs, key=os.path.getmtime) if run_dirs else None
+
+def describe_input(input_csv_path):
+    """
+    Identify an input file so a resumed run can verify it is processing the same data.
+    """
+    stat = os.stat(input_csv_path)
+    return {"path": os.path.abspath(input_csv_path), "size": stat.st_size, "mtime": stat.st_mtime}
 
-    log_message(f"Processing file: {input_csv_path}")
+def expand_input_paths(paths):
+    """
+    Expand the --input arguments into CSV files: directories stand for the .csv files in them.
+    """
+    input_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            input_paths += sorted(os.path.join(path, item) for item in os.listdir(path)
+                                  if item.lower().endswith(".csv") and os.path.isfile(os.path.join(path, item)))
+        else:
+            input_paths.append(path)
+    return input_paths
+
+def process_invoices(input_csv_path, output_dir_base, api_key=None, resume=None, llm_budget=None,
+                     triage_model_path=None, triage_confidence=0.95, cluster_pairs=True, max_cluster_edges=None,
+                     partition_by=None, workers=1, cross_partition_vendor=False, save_scores=False,
+                     embedding_format="float32", llm_provider="gemini", llm_provider_options=None, lexical_band=None,
+                     scoring_mode="sentence", memory_limit=None, field_cache_dir=FIELD_CACHE_DIR):
+    """
+    Run the pipeline on input_csv_path, or on a list of CSV paths as one batch: the files
+    are combined into one invoice table tagged by SOURCE_FILE and blocked and scored
+    together, so duplicates across files are found with a single model load. A batch
+    writes the combined output plus one output per file with the pairs involving it.
+    """
+    input_paths = [input_csv_path] if isinstance(input_csv_path, str) else list(input_csv_path)
+    if not input_paths:
+        log_message("No input CSV files given.", "ERROR")
+        return None
+    batch = len(input_paths) > 1
+    input_description = [describe_input(path) for path in input_paths] if batch else describe_input(input_paths[0])
+
+    if resume:
+        output_dir = find_resume_dir(output_dir_base, resume)
+        if not output_dir:
+            log_message(f"No run directory found to resume ({resume}).", "ERROR")
+            return None
+        run_state = load_run_state(output_dir)
+        if run_state.get("input") and run_state["input"] != input_description:
+            log_message(f"Run directory {output_dir} was created for a different or modified input file; not resuming.", "ERROR")
+            return None
+        run_timestamp = os.path.basename(os.path.normpath(output_dir))[len("run_"):]
+        log_message(f"Resuming run in: {output_dir}", "INFO")
+    else:
+        # Clean up old output directories first
+        cleanup_old_outputs(output_dir_base)
+        
+        # Create a unique subdirectory for this run's outputs
+        run_timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_dir = os.path.join(output_dir_base, f"run_{run_timestamp}")
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        run_state = {}
+
+    run_state["input"] = input_description
+    save_run_state(output_dir, run_state)
+
+    if batch:
+        log_message(f"Processing {len(input_paths)} files as one batch: {', '.join(input_paths)}")
+    else:
+        log_message(f"Processing file: {input_paths[0]}")
     log_message(f"Output will be saved in: {output_dir}")
 
     temp_sbert_output_csv = os.path.join(output_dir, "sbert_scored_pairs_temp.csv")
+    sbert_checkpoint_dir = os.path.join(output_dir, "sbert_checkpoint")
+    llm_checkpoint_path = os.path.join(output_dir, "llm_verdicts.jsonl")
     
     # PROGRESS: Overall Start
     log_message("OVERALL_START", message_type="PROGRESS")
+    log_message(f"Backend ready {time.perf_counter() - STARTUP_TIME:.2f}s after start", "INFO")
     log_message("Step 1: Getting SBERT similarity scores...", "INFO")
     
-    # Force stdout flush to ensure immediate display
-    sys.stdout.flush()
-    
-    scored_pairs_df = get_sbert_predictions(
-        input_csv_path,
-        PREDICT_PAIRS_SCRIPT_PATH,
-        SBERT_MODEL_PATH,
-        THRESHOLD_PATH,
-        temp_sbert_output_csv
-    )
+    utils = timed_import("utils")
+    source_files = utils.source_file_labels(input_paths) if batch else None
+    pair_predictor = timed_import("pair_predictor")
+    if run_state.get("sbert_complete") and os.path.exists(temp_sbert_output_csv):
+        log_message("SBERT stage already completed in this run, reusing scored pairs.", "INFO")
+        events.emit("stage", stage="SBERT_START")
+        scored_pairs_df = pair_predictor.load_sbert_results(temp_sbert_output_csv)
+        events.emit("stage", stage="SBERT_END")
+    else:
+        sbert_input_path = input_paths[0]
+        if batch:
+            sbert_input_path = os.path.join(output_dir, "combined_input.csv")
+            file_rows = utils.combine_input_files(input_paths, sbert_input_path)
+            log_message(f"Combined {sum(file_rows.values())} invoices from {len(file_rows)} files into {sbert_input_path}", "INFO")
+            for source_file, rows in file_rows.items():
+                log_message(f"  {source_file}: {rows} invoices", "DEBUG")
+        scored_pairs_df = pair_predictor.get_sbert_predictions(
+            sbert_input_path,
+            PREDICT_PAIRS_SCRIPT_PATH,
+            SBERT_MODEL_PATH,
+            THRESHOLD_PATH,
+            temp_sbert_output_csv,
+            checkpoint_dir=sbert_checkpoint_dir,
+            partition_by=partition_by,
+            workers=workers,
+            cross_partition_vendor=cross_partition_vendor,
+            scores_path=os.path.join(output_dir, "candidate_scores.npz") if save_scores else None,
+            embedding_format=embedding_format,
+            lexical_band=lexical_band,
+            scoring_mode=scoring_mode,
+            field_cache_dir=field_cache_dir,
+            memory_limit=memory_limit
+        )
 
     if scored_pairs_df.empty:
         log_message("No pairs found or SBERT prediction failed.", message_type="ERROR")
         return None
 
+    run_state["sbert_complete"] = True
+    save_run_state(output_dir, run_state)
+
     log_message(f"Found {len(scored_pairs_df)} potential duplicate pairs from SBERT.", "INFO")
-    sys.stdout.flush()
+    if batch:
+        cross_file = scored_pairs_df[f"INV1_{utils.SOURCE_FILE_COLUMN}"] != scored_pairs_df[f"INV2_{utils.SOURCE_FILE_COLUMN}"]
+        log_message(f"{int(cross_file.sum())} of them pair invoices from different files.", "INFO")
+
+    if cluster_pairs:
+        scored_pairs_df = timed_import("pair_clustering").assign_clusters(scored_pairs_df, max_edges_per_invoice=max_cluster_edges)
+        log_message(f"Grouped pairs into {scored_pairs_df['cluster_id'].nunique()} duplicate clusters.", "INFO")
 
     log_message("Step 2: Classifying pairs with LLM...", "INFO")
     # PROGRESS: LLM Classification Start (overall, individual batches handled in llm_classifier)
     log_message("LLM_CLASSIFICATION_START", message_type="PROGRESS")
-    sys.stdout.flush()
     
     # Start time for LLM processing
     llm_start_time = time.time()
     
-    llm_results_df = classify_pairs_with_llm(scored_pairs_df, api_key=api_key)
+    triage_bundle = None
+    if triage_model_path:
+        try:
+            triage_bundle = timed_import("triage_model").load_triage_model(triage_model_path)
+            log_message(f"Loaded triage model trained on {triage_bundle['trained_pairs']} pairs", "INFO")
+        except Exception as e:
+            log_message(f"Could not load triage model {triage_model_path}: {e}. All pairs go to the LLM.", "WARNING")
+
+    token_usage = timed_import("llm_scheduler").TokenUsage()
+    llm_results_df = timed_import("llm_classifier").classify_pairs_with_llm(scored_pairs_df, api_key=api_key, checkpoint_path=llm_checkpoint_path,
+                                             budget=llm_budget, triage_bundle=triage_bundle,
+                                             triage_confidence=triage_confidence, cluster_pairs=cluster_pairs,
+                                             token_usage=token_usage, provider_name=llm_provider,
+                                             provider_options=llm_provider_options)
     
     # Calculate LLM processing time
     llm_elapsed_time = time.time() - llm_start_time
@@ -158,52 +280,128 @@ def process_invoices(input_csv_path, output_dir_base, api_key=None):
     
     # PROGRESS: LLM Classification End (overall, individual batches handled in llm_classifier)
     log_message("LLM_CLASSIFICATION_END", message_type="PROGRESS")
-    sys.stdout.flush()
 
     log_message("Step 3: Formatting output JSON...", "INFO")
     # PROGRESS: Formatting Start
     log_message("FORMATTING_START", message_type="PROGRESS")
-    sys.stdout.flush()
     
     project_id = f"project-{uuid.uuid4()}"
-    project_name = f"SAP Invoice Analysis - {os.path.basename(input_csv_path)}"
+    if batch:
+        project_name = f"SAP Invoice Analysis - {len(input_paths)} files ({source_files[0]} to {source_files[-1]})"
+    else:
+        project_name = f"SAP Invoice Analysis - {os.path.basename(input_paths[0])}"
     project_description = "Analysis of SAP invoice pairs using SBERT and LLM."
 
-    final_json_output = format_output_json(
+    final_json_output = utils.format_output_json(
         llm_results_df,
         project_id,
         project_name,
-        project_description
+        project_description,
+        llm_usage=token_usage.summary(),
+        source_files=source_files
     )
 
     output_filename = f"analysis_output_{run_timestamp}.json"
     output_filepath = os.path.join(output_dir, output_filename)
 
     with open(output_filepath, 'w') as f:
-        json.dump(final_json_output, f, indent=2, default=custom_json_serializer)
+        json.dump(final_json_output, f, indent=2, default=utils.custom_json_serializer)
+
+    # Per-file outputs of a batch; pairs across two files are in both
+    file_outputs = {}
+    for source_file in source_files or []:
+        file_json_output = utils.format_output_json(
+            utils.pairs_for_source_file(llm_results_df, source_file),
+            f"project-{uuid.uuid4()}",
+            f"SAP Invoice Analysis - {source_file}",
+            f"{project_description} Includes duplicates in the other files of the batch.",
+            source_files=source_files
+        )
+        file_stem = os.path.splitext(source_file)[0].replace(os.sep, "_")
+        file_outputs[source_file] = os.path.join(output_dir, f"analysis_output_{run_timestamp}_{file_stem}.json")
+        with open(file_outputs[source_file], 'w') as f:
+            json.dump(file_json_output, f, indent=2, default=utils.custom_json_serializer)
+        log_message(f"Output for {source_file} ({file_json_output['project']['totalPairs']} pairs) saved to: {file_outputs[source_file]}", "INFO")
 
     log_message(f"Processing complete. Output saved to: {output_filepath}", "INFO")
-    # Print a special marker for the IPC process to capture the output path - with special format for easier parsing
-    print(f"JSON_OUTPUT_PATH:{output_filepath}", flush=True)
+    log_message(f"Deferred import times: {import_time_report()}", "INFO")
+    # Tell the Electron main process where the output is
+    events.emit("output", path=output_filepath)
     # PROGRESS: Overall End
     log_message("OVERALL_END", message_type="PROGRESS")
-    sys.stdout.flush()
     
     # Return both the file path and the JSON content
     return {
         "filePath": output_filepath,
-        "jsonContent": final_json_output
+        "jsonContent": final_json_output,
+        "fileOutputs": file_outputs
     }
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process SAP invoice data.")
-    parser.add_argument("--input", required=True, help="Path to the input CSV file.")
+    parser.add_argument("--input", required=True, nargs="+",
+                        help="Path to the input CSV file. Several files or directories of CSV files are processed as one batch.")
     parser.add_argument("--output_dir", default=DEFAULT_OUTPUT_DIR, help="Base directory to save the output JSON file.")
-    parser.add_argument("--api_key", default=None, help="Gemini API Key.")
+    parser.add_argument("--api_key", default=None, help="Gemini API Key, or several comma-separated keys whose quotas are pooled.")
+    parser.add_argument("--requests-per-minute", type=int, default=15, help="Request quota of each Gemini API key when several are pooled.")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None,
+                        help="Resume an interrupted run, skipping completed SBERT and LLM work. "
+                             "Takes a run directory, or resumes the most recent run if no value is given.")
+    parser.add_argument("--llm-max-requests", type=int, default=None, help="Maximum number of LLM requests in this run.")
+    parser.add_argument("--llm-max-tokens", type=int, default=None, help="Maximum number of (estimated) prompt tokens sent to the LLM.")
+    parser.add_argument("--llm-max-minutes", type=float, default=None, help="Maximum wall-clock minutes spent on LLM classification.")
+    parser.add_argument("--triage-model", default=None, help="Local triage model (see triage_model.py) that auto-labels clear-cut pairs.")
+    parser.add_argument("--triage-confidence", type=float, default=0.95, help="Minimum triage model confidence to auto-label a pair.")
+    parser.add_argument("--no-clustering", action="store_true", help="Send every pair to the LLM separately instead of one request per duplicate cluster.")
+    parser.add_argument("--partition-by", default=None, help="Comma-separated columns (e.g. COMPANY_CODE,CURRENCY) to block and score each partition separately.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for partitioned blocking and scoring (0 = all cores).")
+    parser.add_argument("--cross-partition-vendor", action="store_true", help="With --partition-by, also compare invoices of the same vendor ID across partitions.")
+    parser.add_argument("--save-scores", action="store_true", help="Keep the scores of all candidate pairs in the run directory for content/threshold_sweep.py.")
+    parser.add_argument("--embedding-format", choices=["float32", "float16", "int8"], default="float32",
+                        help="Hold and score SBERT embeddings as float16 or int8 to cut memory per invoice 2-4x.")
+    parser.add_argument("--lexical-band", default=None,
+                        help="Decide pairs outside LOW:HIGH on TF-IDF character n-gram similarity before SBERT, or 'auto' to calibrate the band on a sample.")
+    parser.add_argument("--scoring-mode", choices=["sentence", "fields"], default="sentence",
+                        help="Score pairs from embeddings of each distinct vendor name and description (cached across runs) instead of one embedding per invoice.")
+    parser.add_argument("--field-cache", default=FIELD_CACHE_DIR,
+                        help="Writable directory for the field embedding cache of --scoring-mode fields (default: the user's cache directory).")
+    parser.add_argument("--memory-limit", default=None,
+                        help="Memory ceiling (e.g. 8G) for sizing SBERT scoring batches; by default they are sized from available memory.")
+    parser.add_argument("--llm-provider", choices=["gemini", "llama", "rules"], default="gemini",
+                        help="LLM backend: Gemini, a local GGUF model via llama-cpp-python, or the offline rule-based stand-in.")
+    parser.add_argument("--local-model", default=None, help="GGUF model file for --llm-provider llama.")
+    parser.add_argument("--llm-threads", type=int, default=None, help="CPU threads for the local model (default: llama.cpp's choice).")
+    parser.add_argument("--events-fd", type=int, default=None,
+                        help="Write progress and log events as JSON lines to this file descriptor instead of PROGRESS: lines on stdout.")
+    parser.add_argument("--verbosity", choices=VERBOSITY_LEVELS, default="debug", help="Lowest log level that is printed and sent as an event.")
+    parser.add_argument("--no-human-logs", action="store_true", help="Do not print log lines to stdout (errors still go to stderr).")
+    parser.add_argument("--max-cluster-edges", type=int, default=None, help="Only link each invoice to its N most similar partners when building clusters.")
     
     args = parser.parse_args()
+    events.configure(events_fd=args.events_fd, verbosity=args.verbosity, human_logs=not args.no_human_logs)
+
+    llm_budget = None
+    if args.llm_max_requests is not None or args.llm_max_tokens is not None or args.llm_max_minutes is not None:
+        llm_budget = timed_import("llm_scheduler").LLMBudget(
+            max_requests=args.llm_max_requests,
+            max_tokens=args.llm_max_tokens,
+            max_seconds=args.llm_max_minutes * 60 if args.llm_max_minutes is not None else None
+        )
 
-    result_file = process_invoices(args.input, args.output_dir, api_key=args.api_key)
-    if result_file:
-        # This specific print format can be caught by Electron's main process
-        log_message(f"JSON_OUTPUT_PATH:{result_file}")
+    llm_provider_options = None
+    if args.llm_provider == "llama":
+        llm_provider_options = {"local_model_path": args.local_model, "threads": args.llm_threads}
+    elif args.llm_provider == "gemini":
+        llm_provider_options = {"requests_per_minute": args.requests_per_minute}
+    result_file = process_invoices(expand_input_paths(args.input), args.output_dir, api_key=args.api_key, resume=args.resume,
+                                   llm_budget=llm_budget, triage_model_path=args.triage_model,
+                                   triage_confidence=args.triage_confidence, cluster_pairs=not args.no_clustering,
+                                   max_cluster_edges=args.max_cluster_edges,
+                                   partition_by=[column.strip() for column in args.partition_by.split(",")] if args.partition_by else None,
+                                   workers=args.workers if args.workers > 0 else os.cpu_count(),
+                                   cross_partition_vendor=args.cross_partition_vendor, save_scores=args.save_scores,
+                                   embedding_format=args.embedding_format, llm_provider=args.llm_provider,
+                                   llm_provider_options=llm_provider_options,
+                                   lexical_band=args.lexical_band, scoring_mode=args.scoring_mode,
+                                   memory_limit=args.memory_limit, field_cache_dir=args.field_cache)
+    events.close()
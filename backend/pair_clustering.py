@@ -0,0 +1,122 @@
+# filepath: backend/pair_clustering.py
+import numpy as np
+import pandas as pd
+
+# Clusters with more invoices than this are not sent as one prompt; their pairs are classified one by one
+MAX_CLUSTER_INVOICES = 12
+
+class UnionFind:
+    """
+    Disjoint-set forest over hashable items with path compression and union by size.
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, item):
+        if item not in self.parent:
+            self.parent[item] = item
+            self.size[item] = 1
+            return item
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, item1, item2):
+        root1, root2 = self.find(item1), self.find(item2)
+        if root1 == root2:
+            return root1
+        if self.size[root1] < self.size[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        self.size[root1] += self.size[root2]
+        return root1
+
+def strongest_edges(scored_pairs_df, max_edges_per_invoice):
+    """
+    Boolean mask of the pairs that are among the max_edges_per_invoice most similar
+    pairs of at least one of their two invoices.
+    """
+    num_pairs = len(scored_pairs_df)
+    similarity = pd.to_numeric(scored_pairs_df['similarity'], errors='coerce').fillna(0.0).to_numpy()
+    # Every pair is an edge of both its invoices, so rank both endpoints' edges together
+    edges = pd.DataFrame({
+        'doc': np.concatenate([scored_pairs_df['INV1_DOC_NO'].astype(str).to_numpy(),
+                               scored_pairs_df['INV2_DOC_NO'].astype(str).to_numpy()]),
+        'similarity': np.concatenate([similarity, similarity]),
+        'position': np.concatenate([np.arange(num_pairs), np.arange(num_pairs)]),
+    })
+    ranks = edges.groupby('doc')['similarity'].rank(method='first', ascending=False)
+    keep = np.zeros(num_pairs, dtype=bool)
+    keep[edges.loc[ranks <= max_edges_per_invoice, 'position'].to_numpy()] = True
+    return keep
+
+def assign_clusters(scored_pairs_df, max_edges_per_invoice=None):
+    """
+    Group above-threshold pairs into duplicate clusters: connected components of the
+    graph with invoices as nodes and scored pairs as edges.
+
+    With max_edges_per_invoice, only each invoice's strongest edges connect components,
+    so a single weak link does not chain two unrelated groups together. Pairs whose
+    invoices end up in different components form a cluster of their own.
+
+    Returns a copy of scored_pairs_df with an integer 'cluster_id' column.
+    """
+    clustered_df = scored_pairs_df.copy()
+    if clustered_df.empty:
+        clustered_df['cluster_id'] = pd.Series(dtype=int)
+        return clustered_df
+
+    doc1 = clustered_df['INV1_DOC_NO'].astype(str).to_numpy()
+    doc2 = clustered_df['INV2_DOC_NO'].astype(str).to_numpy()
+    if max_edges_per_invoice:
+        keep = strongest_edges(clustered_df, max_edges_per_invoice)
+    else:
+        keep = np.ones(len(clustered_df), dtype=bool)
+
+    components = UnionFind()
+    for first, second, kept in zip(doc1, doc2, keep):
+        components.find(first)
+        components.find(second)
+        if kept:
+            components.union(first, second)
+
+    cluster_ids = {}
+    assigned = []
+    for position, (first, second) in enumerate(zip(doc1, doc2)):
+        root1, root2 = components.find(first), components.find(second)
+        # A pruned edge between two components is judged on its own
+        cluster_key = root1 if root1 == root2 else ('pair', position)
+        assigned.append(cluster_ids.setdefault(cluster_key, len(cluster_ids)))
+    clustered_df['cluster_id'] = assigned
+    return clustered_df
+
+def cluster_invoice_count(cluster_df):
+    """Number of distinct invoices in the pairs of one cluster."""
+    return len(set(cluster_df['INV1_DOC_NO'].astype(str)) | set(cluster_df['INV2_DOC_NO'].astype(str)))
+
+def group_positions_by_cluster(scored_pairs_df, positions, max_cluster_invoices=MAX_CLUSTER_INVOICES):
+    """
+    Split row positions of scored_pairs_df into LLM work units: one unit per cluster,
+    or one unit per pair for pairs without a cluster_id and for clusters too large
+    for a single prompt. Units keep the order of their first position.
+    """
+    if 'cluster_id' not in scored_pairs_df.columns:
+        return [[position] for position in positions]
+
+    cluster_ids = scored_pairs_df['cluster_id'].to_numpy()
+    units = {}
+    for position in positions:
+        units.setdefault(cluster_ids[position], []).append(position)
+
+    grouped = []
+    for unit in units.values():
+        if len(unit) > 1 and cluster_invoice_count(scored_pairs_df.iloc[unit]) > max_cluster_invoices:
+            grouped.extend([position] for position in unit)
+        else:
+            grouped.append(unit)
+    return grouped
@@ -1,97 +1,123 @@
 # filepath: backend/pair_predictor.py
-import subprocess
 import pandas as pd
 import os
 import sys
 import time
-from datetime import datetime
+
+from progress_monitor import stream_process_output
+from event_channel import events
 
 def log_message(message, message_type="INFO"):
     """
-    Log a message to both stdout and stderr if it's an error
-    to ensure visibility in both UI and terminal.
+    Log a message for the UI and terminal (errors also go to stderr); see event_channel.
+    """
+    events.log(message, message_type)
+
+def load_sbert_results(scored_pairs_csv_path):
+    """
+    Load the scored pairs CSV written by predict_pairs.py.
     """
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    formatted_message = f"[{timestamp}] [{message_type}] {message}"
+    log_message(f"Loading SBERT results from {scored_pairs_csv_path}", "INFO")
+    scored_pairs_df = pd.read_csv(scored_pairs_csv_path)
     
-    print(formatted_message, flush=True)
-    if message_type == "ERROR":
-        print(formatted_message, file=sys.stderr, flush=True)
+    # Log some statistics about the results
+    log_message(f"SBERT found {len(scored_pairs_df)} candidate pairs", "INFO")
     
-    # For progress updates, add a special marker for the UI
-    if message_type == "PROGRESS":
-        print(f"PROGRESS:{message}", flush=True)
+    # Ensure date columns are parsed correctly if predict_pairs.py doesn't save them as datetime objects
+    for col in scored_pairs_df.columns:
+        if 'DATE' in col.upper():
+            try:
+                scored_pairs_df[col] = pd.to_datetime(scored_pairs_df[col], errors='coerce')
+            except Exception as e:
+                log_message(f"Warning: Could not convert column {col} to datetime: {str(e)}", "WARNING")
+    
+    # Log some similarity stats if available
+    if 'similarity_score' in scored_pairs_df.columns:
+        log_message(f"Similarity score stats: min={scored_pairs_df['similarity_score'].min():.4f}, " 
+                   f"max={scored_pairs_df['similarity_score'].max():.4f}, "
+                   f"mean={scored_pairs_df['similarity_score'].mean():.4f}", "INFO")
+    
+    return scored_pairs_df
 
-def get_sbert_predictions(input_csv_path, predict_script_path, model_path, threshold_path, temp_output_csv_path):
+def get_sbert_predictions(input_csv_path, predict_script_path, model_path, threshold_path, temp_output_csv_path,
+                          checkpoint_dir=None, partition_by=None, workers=1, cross_partition_vendor=False,
+                          scores_path=None, embedding_format="float32", lexical_band=None, scoring_mode="sentence",
+                          memory_limit=None, field_cache_dir=None):
     """
     Runs the predict_pairs.py script and returns its output as a DataFrame.
     Requires predict_pairs.py to be modified to accept an --output_csv argument.
+    The script's stdout is streamed while it runs so that its PROGRESS:SBERT_STAGE
+    events reach the UI immediately.
+    partition_by (list of columns), workers and cross_partition_vendor select the
+    partitioned parallel mode of predict_pairs.py. With scores_path the scores of all
+    candidate pairs are saved for content/threshold_sweep.py. embedding_format selects
+    float16 or int8 embeddings for scoring (see content/embedding_store.py). lexical_band
+    ("LOW:HIGH" or "auto") decides pairs outside the band on TF-IDF character n-gram
+    similarity before SBERT (see content/lexical_cascade.py). scoring_mode "fields" encodes
+    each distinct vendor name and description once instead of every invoice (see
+    content/field_scoring.py), cached in field_cache_dir, which must be writable. memory_limit (e.g. "8G") is a ceiling on the script's memory
+    that every scoring batch must fit under; the script fails if none fits (see content/batch_sizing.py).
     """
     command = [
         sys.executable, # Use the same Python interpreter running this script
+        "-u", # Unbuffered, so progress lines are not held back by the child
         predict_script_path,
         "--input", input_csv_path,
         "--model", model_path,
         "--threshold", threshold_path,
         "--output_csv", temp_output_csv_path
     ]
+    if checkpoint_dir:
+        command += ["--checkpoint-dir", checkpoint_dir]
+    if partition_by:
+        command += ["--partition-by", ",".join(partition_by)]
+        if cross_partition_vendor:
+            command.append("--cross-partition-vendor")
+    if scores_path:
+        command += ["--scores-output", scores_path]
+    if workers != 1:
+        command += ["--workers", str(workers)]
+    if embedding_format != "float32":
+        command += ["--embedding-format", embedding_format]
+    if lexical_band:
+        command += ["--lexical-band", lexical_band]
+    if scoring_mode != "sentence":
+        command += ["--scoring-mode", scoring_mode]
+        if field_cache_dir:
+            command += ["--field-cache", field_cache_dir]
+    if memory_limit:
+        command += ["--memory-limit", memory_limit]
     
     log_message(f"Running SBERT prediction command: {' '.join(command)}", "INFO")
-    log_message("Starting SBERT similarity analysis", "PROGRESS")
+    log_message("Starting SBERT similarity analysis", "INFO")
     try:
-        # PROGRESS: Starting SBERT
-        print("PROGRESS:SBERT_START")
+        events.emit("stage", stage="SBERT_START")
         
         # Start time for measuring performance
         start_time = time.time()
         
-        process = subprocess.run(command, capture_output=True, text=True, check=True, cwd=os.path.dirname(predict_script_path))
-        
+        exit_code, _, stderr = stream_process_output(command, cwd=os.path.dirname(predict_script_path))
+
+        if exit_code != 0:
+            log_message(f"Error running SBERT script: exit code {exit_code}", "ERROR")
+            log_message(f"Stderr: {stderr}", "ERROR")
+            return pd.DataFrame()
+
         # Calculate elapsed time
         elapsed_time = time.time() - start_time
         log_message(f"SBERT processing took {elapsed_time:.2f} seconds", "INFO")
         
-        log_message("SBERT script stdout:", "DEBUG")
-        print(process.stdout)
-        
-        if process.stderr:
-            log_message("SBERT script stderr:", "WARNING")
-            print(process.stderr)
-            
-        # PROGRESS: SBERT Done
-        log_message("SBERT similarity analysis completed", "PROGRESS")
-        print("PROGRESS:SBERT_END")
+        if stderr:
+            log_message(f"SBERT script stderr:\n{stderr}", "WARNING")
+
+        log_message("SBERT similarity analysis completed", "INFO")
+        events.emit("stage", stage="SBERT_END")
 
         if os.path.exists(temp_output_csv_path):
-            log_message(f"Loading SBERT results from {temp_output_csv_path}", "INFO")
-            scored_pairs_df = pd.read_csv(temp_output_csv_path)
-            
-            # Log some statistics about the results
-            log_message(f"SBERT found {len(scored_pairs_df)} candidate pairs", "INFO")
-            
-            # Ensure date columns are parsed correctly if predict_pairs.py doesn't save them as datetime objects
-            for col in scored_pairs_df.columns:
-                if 'DATE' in col.upper():
-                    try:
-                        scored_pairs_df[col] = pd.to_datetime(scored_pairs_df[col], errors='coerce')
-                    except Exception as e:
-                        log_message(f"Warning: Could not convert column {col} to datetime: {str(e)}", "WARNING")
-            
-            # Log some similarity stats if available
-            if 'similarity_score' in scored_pairs_df.columns:
-                log_message(f"Similarity score stats: min={scored_pairs_df['similarity_score'].min():.4f}, " 
-                           f"max={scored_pairs_df['similarity_score'].max():.4f}, "
-                           f"mean={scored_pairs_df['similarity_score'].mean():.4f}", "INFO")
-            
-            return scored_pairs_df
+            return load_sbert_results(temp_output_csv_path)
         else:
             log_message(f"Error: SBERT script did not produce output file: {temp_output_csv_path}", "ERROR")
             return pd.DataFrame()
-    except subprocess.CalledProcessError as e:
-        log_message(f"Error running SBERT script: {e}", "ERROR")
-        log_message(f"Stdout: {e.stdout}", "ERROR")
-        log_message(f"Stderr: {e.stderr}", "ERROR")
-        return pd.DataFrame()
     except FileNotFoundError:
         log_message(f"Error: Python interpreter or script not found. Command: {' '.join(command)}", "ERROR")
         return pd.DataFrame()
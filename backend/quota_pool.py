@@ -0,0 +1,98 @@
+# filepath: backend/quota_pool.py
+"""
+Request quotas of several credentials for one remote LLM.
+
+An organization often has several API keys (e.g. one per project), each with its own
+requests-per-minute quota. The pool keeps a sliding one-minute window and a rate-limit
+backoff per credential and hands every request to the credential that can send soonest,
+so together they send at the sum of their quotas and one key's 429 does not stall the others.
+The clients only need a generate_content(prompt) method, so fake local clients can stand in.
+"""
+import time
+import threading
+from collections import deque
+
+from event_channel import events
+
+QUOTA_WINDOW_SECONDS = 60.0
+
+def log_message(message, message_type="INFO"):
+    """
+    Log a message for the UI and terminal (errors also go to stderr); see event_channel.
+    """
+    events.log(message, message_type)
+
+class Credential:
+    """
+    One API credential: its client, its quota and the requests it sent in the current window.
+    """
+
+    def __init__(self, name, client, requests_per_minute=15, window=QUOTA_WINDOW_SECONDS):
+        self.name = name
+        self.client = client
+        self.requests_per_minute = requests_per_minute
+        self.window = window
+        self.sent = deque()
+        self.blocked_until = 0.0
+        self.requests = 0
+        self.rate_limits = 0
+
+    def wait_time(self, now):
+        """
+        Seconds until this credential may send again: after its backoff and once a request
+        has left the window if the window is full.
+        """
+        while self.sent and self.sent[0] <= now - self.window:
+            self.sent.popleft()
+        wait = self.blocked_until - now
+        if self.requests_per_minute and len(self.sent) >= self.requests_per_minute:
+            wait = max(wait, self.sent[0] + self.window - now)
+        return max(0.0, wait)
+
+class QuotaPool:
+    """
+    Route requests to the credential with free capacity. Safe to use from several threads.
+
+    clock and sleep can be replaced to simulate time, e.g. to test the pool with fake clients.
+    """
+
+    def __init__(self, credentials, clock=time.monotonic, sleep=time.sleep):
+        if not credentials:
+            raise ValueError("A quota pool needs at least one credential")
+        self.credentials = list(credentials)
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+
+    @property
+    def requests_per_minute(self):
+        return sum(credential.requests_per_minute for credential in self.credentials)
+
+    def acquire(self):
+        """
+        Wait until a credential has free capacity, count a request against it and return it.
+        """
+        while True:
+            with self.lock:
+                now = self.clock()
+                # The credential free soonest; among free ones, the one with the fewest requests in its window
+                credential = min(self.credentials, key=lambda candidate: (candidate.wait_time(now), len(candidate.sent)))
+                wait = credential.wait_time(now)
+                if wait <= 0:
+                    credential.sent.append(now)
+                    credential.requests += 1
+                    return credential
+            self.sleep(wait)
+
+    def back_off(self, credential, seconds):
+        """
+        Keep a rate-limited credential out of rotation for the delay the API asked for.
+        """
+        with self.lock:
+            credential.blocked_until = max(credential.blocked_until, self.clock() + seconds)
+            credential.rate_limits += 1
+        log_message(f"Rate limit on {credential.name}: pausing it for {seconds}s, other credentials continue", "WARNING")
+
+    def summary(self):
+        return "; ".join(f"{credential.name}: {credential.requests} requests, {credential.rate_limits} rate limits"
+                         for credential in self.credentials)
@@ -0,0 +1,23 @@
+# filepath: backend/run_state.py
+import os
+import json
+
+def load_run_state(run_dir):
+    """
+    Load the run_state.json of a run directory, or an empty state if there is none.
+    """
+    state_path = os.path.join(run_dir, "run_state.json")
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+def save_run_state(run_dir, state):
+    """
+    Atomically write the run_state.json of a run directory.
+    """
+    state_path = os.path.join(run_dir, "run_state.json")
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
@@ -0,0 +1,293 @@
+# filepath: backend/triage_model.py
+"""
+Local triage model that auto-labels clear-cut invoice pairs before the LLM.
+
+The model is trained from past analysis output JSON files, using reviewer
+decisions where available and LLM verdicts otherwise, and only pairs it is
+confident about are kept away from Gemini.
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from event_channel import events
+
+FEATURE_NAMES = [
+    "similarity",
+    "amount_diff",
+    "amount_rel_diff",
+    "date_gap_days",
+    "same_vendor_id",
+    "same_purchase_order",
+    "same_currency",
+    "same_company_code",
+    "vendor_name_overlap",
+    "description_overlap",
+]
+
+# Reviewer statuses from the PayGuard website; anything else (e.g. "pending") is unlabelled
+POSITIVE_STATUSES = {"confirmed", "duplicate", "confirmed_duplicate"}
+NEGATIVE_STATUSES = {"rejected", "not_duplicate", "dismissed", "false_positive"}
+POSITIVE_CLASSIFICATIONS = {"Likely", "Very likely"}
+NEGATIVE_CLASSIFICATIONS = {"Not likely"}
+
+TRIAGE_SOURCE = "triage"
+# Verdicts that were not judged by the LLM or a reviewer and must not be learned from
+AUTOMATIC_SOURCES = {TRIAGE_SOURCE, "fingerprint", "rules"}
+
+def log_message(message, message_type="INFO"):
+    """
+    Log a message for the UI and terminal (errors also go to stderr); see event_channel.
+    """
+    events.log(message, message_type)
+
+def _column(df, name):
+    return df[name] if name in df.columns else pd.Series(np.nan, index=df.index)
+
+def _normalized_text(series):
+    return series.fillna("").astype(str).str.strip().str.lower()
+
+def _token_overlap(series1, series2):
+    """Jaccard overlap of the word sets of two text columns (NaN if either side is empty)."""
+    overlaps = []
+    for text1, text2 in zip(_normalized_text(series1), _normalized_text(series2)):
+        tokens1, tokens2 = set(text1.split()), set(text2.split())
+        if not tokens1 or not tokens2:
+            overlaps.append(np.nan)
+        else:
+            overlaps.append(len(tokens1 & tokens2) / len(tokens1 | tokens2))
+    return np.array(overlaps, dtype=float)
+
+def _equal(series1, series2):
+    """1.0 if both values are present and equal after normalization, 0.0 if they differ, NaN if missing."""
+    text1, text2 = _normalized_text(series1), _normalized_text(series2)
+    equal = (text1 == text2).astype(float)
+    equal[(text1 == "") | (text2 == "") | (text1 == "nan") | (text2 == "nan")] = np.nan
+    return equal.to_numpy()
+
+def pair_features(scored_pairs_df):
+    """
+    Compute the triage feature matrix for a DataFrame of scored pairs with INV1_/INV2_ columns.
+    Missing information is left as NaN.
+    """
+    amount1 = pd.to_numeric(_column(scored_pairs_df, "INV1_AMOUNT"), errors="coerce")
+    amount2 = pd.to_numeric(_column(scored_pairs_df, "INV2_AMOUNT"), errors="coerce")
+    amount_diff = (amount1 - amount2).abs()
+    amount_scale = np.fmax(amount1.abs(), amount2.abs()).replace(0, np.nan)
+
+    date1 = pd.to_datetime(_column(scored_pairs_df, "INV1_INVOICE_DATE"), errors="coerce")
+    date2 = pd.to_datetime(_column(scored_pairs_df, "INV2_INVOICE_DATE"), errors="coerce")
+
+    features = pd.DataFrame({
+        "similarity": pd.to_numeric(_column(scored_pairs_df, "similarity"), errors="coerce").to_numpy(),
+        "amount_diff": amount_diff.to_numpy(),
+        "amount_rel_diff": (amount_diff / amount_scale).to_numpy(),
+        "date_gap_days": (date1 - date2).abs().dt.days.to_numpy(dtype=float),
+        "same_vendor_id": _equal(_column(scored_pairs_df, "INV1_VENDOR_ID"), _column(scored_pairs_df, "INV2_VENDOR_ID")),
+        "same_purchase_order": _equal(_column(scored_pairs_df, "INV1_PURCHASE_ORDER"), _column(scored_pairs_df, "INV2_PURCHASE_ORDER")),
+        "same_currency": _equal(_column(scored_pairs_df, "INV1_CURRENCY"), _column(scored_pairs_df, "INV2_CURRENCY")),
+        "same_company_code": _equal(_column(scored_pairs_df, "INV1_COMPANY_CODE"), _column(scored_pairs_df, "INV2_COMPANY_CODE")),
+        "vendor_name_overlap": _token_overlap(_column(scored_pairs_df, "INV1_VENDOR_NAME"), _column(scored_pairs_df, "INV2_VENDOR_NAME")),
+        "description_overlap": _token_overlap(_column(scored_pairs_df, "INV1_DESCRIPTION"), _column(scored_pairs_df, "INV2_DESCRIPTION")),
+    }, columns=FEATURE_NAMES)
+    return features
+
+def json_pair_to_row(pair):
+    """
+    Convert a pair from an analysis output JSON file back to the INV1_/INV2_ row layout.
+    """
+    row = {"similarity": pair.get("score")}
+    for prefix, doc_key in (("INV1", "doc1"), ("INV2", "doc2")):
+        doc = pair.get(doc_key) or {}
+        row[f"{prefix}_DOC_NO"] = doc.get("number")
+        row[f"{prefix}_AMOUNT"] = doc.get("amount")
+        row[f"{prefix}_CURRENCY"] = doc.get("currency")
+        row[f"{prefix}_COMPANY_CODE"] = doc.get("companyCode")
+        row[f"{prefix}_VENDOR_ID"] = doc.get("vendorNumber")
+        row[f"{prefix}_VENDOR_NAME"] = doc.get("vendorName")
+        row[f"{prefix}_DESCRIPTION"] = doc.get("postingText")
+        # Only present in outputs written since the triage model was introduced
+        row[f"{prefix}_INVOICE_DATE"] = doc.get("invoiceDate")
+        row[f"{prefix}_PURCHASE_ORDER"] = doc.get("purchaseOrder")
+    return row
+
+def pair_label(pair):
+    """
+    Training label of an output JSON pair: the reviewer decision if there is one,
+    otherwise the LLM verdict. Returns None for unlabelled pairs and for pairs
+    that were auto-labelled by the triage model or the fingerprint fast path.
+    """
+    status = str(pair.get("status") or "").lower()
+    if status in POSITIVE_STATUSES:
+        return 1
+    if status in NEGATIVE_STATUSES:
+        return 0
+
+    analysis = pair.get("llmAnalysis") or {}
+    if analysis.get("source") in AUTOMATIC_SOURCES:
+        return None
+    classification = analysis.get("classification")
+    if classification in POSITIVE_CLASSIFICATIONS:
+        return 1
+    if classification in NEGATIVE_CLASSIFICATIONS:
+        return 0
+    return None
+
+def load_training_pairs(paths):
+    """
+    Collect labelled pairs from output JSON files or directories containing them.
+    Returns (rows DataFrame, labels array).
+    """
+    json_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            json_files.extend(glob.glob(os.path.join(path, "**", "*.json"), recursive=True))
+        else:
+            json_files.append(path)
+
+    rows, labels, seen = [], [], set()
+    # Newest files first, so a pair that appears in several runs keeps its most recent label
+    for json_file in sorted(json_files, key=os.path.getmtime, reverse=True):
+        try:
+            with open(json_file, "r") as f:
+                content = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            log_message(f"Skipping {json_file}: {e}", "WARNING")
+            continue
+        if not isinstance(content, dict) or "pairs" not in content:
+            continue
+
+        for pair in content["pairs"]:
+            label = pair_label(pair)
+            if label is None:
+                continue
+            row = json_pair_to_row(pair)
+            key = (row["INV1_DOC_NO"], row["INV2_DOC_NO"])
+            if key in seen:
+                continue
+            seen.add(key)
+            rows.append(row)
+            labels.append(label)
+
+    log_message(f"Loaded {len(rows)} labelled pairs from {len(json_files)} files", "INFO")
+    return pd.DataFrame(rows), np.array(labels, dtype=int)
+
+def build_estimator(model_type="gbdt"):
+    """
+    Create an untrained triage estimator. Both variants accept NaN features.
+    """
+    if model_type == "logistic":
+        from sklearn.pipeline import make_pipeline
+        from sklearn.impute import SimpleImputer
+        from sklearn.preprocessing import StandardScaler
+        from sklearn.linear_model import LogisticRegression
+        return make_pipeline(SimpleImputer(strategy="median", add_indicator=True), StandardScaler(),
+                             LogisticRegression(max_iter=1000, class_weight="balanced"))
+    if model_type == "gbdt":
+        from sklearn.ensemble import HistGradientBoostingClassifier
+        return HistGradientBoostingClassifier(max_iter=200, learning_rate=0.1, random_state=42)
+    raise ValueError(f"Unknown triage model type: {model_type}")
+
+def train_triage_model(paths, model_path, model_type="gbdt", confidence=0.95):
+    """
+    Train a triage model from output JSON files, report holdout quality and save it with joblib.
+    """
+    import joblib
+    from sklearn.model_selection import train_test_split
+    from sklearn.metrics import roc_auc_score
+
+    rows_df, labels = load_training_pairs(paths)
+    if len(labels) < 20 or len(set(labels)) < 2:
+        raise ValueError(f"Need at least 20 labelled pairs including both classes to train, "
+                         f"found {int(labels.sum())} duplicates and {int(len(labels) - labels.sum())} non-duplicates")
+
+    features = pair_features(rows_df)
+    train_x, test_x, train_y, test_y = train_test_split(features, labels, test_size=0.2, random_state=42, stratify=labels)
+
+    estimator = build_estimator(model_type)
+    estimator.fit(train_x, train_y)
+    probabilities = estimator.predict_proba(test_x)[:, 1]
+    confident = (probabilities >= confidence) | (probabilities <= 1 - confidence)
+    accuracy = ((probabilities[confident] >= 0.5) == test_y[confident]).mean() if confident.any() else float("nan")
+    metrics = {
+        "holdout_auc": float(roc_auc_score(test_y, probabilities)) if len(set(test_y)) > 1 else float("nan"),
+        "holdout_auto_labelled": float(confident.mean()),
+        "holdout_auto_label_accuracy": float(accuracy),
+    }
+    log_message(f"Holdout metrics at confidence {confidence}: {metrics}", "INFO")
+
+    # Refit on all labelled pairs for the saved model
+    estimator = build_estimator(model_type)
+    estimator.fit(features, labels)
+    joblib.dump({"estimator": estimator, "features": FEATURE_NAMES, "model_type": model_type,
+                 "trained_pairs": int(len(labels)), "metrics": metrics}, model_path)
+    log_message(f"Saved triage model to {model_path}", "INFO")
+    return metrics
+
+def load_triage_model(model_path):
+    import joblib
+    bundle = joblib.load(model_path)
+    if bundle.get("features") != FEATURE_NAMES:
+        raise ValueError("Triage model was trained with a different feature set; retrain it")
+    return bundle
+
+def describe_factors(feature_row):
+    """Short human-readable key factors for an auto-labelled pair."""
+    factors = [f"SBERT similarity {feature_row['similarity']:.2f}"]
+    if feature_row["same_vendor_id"] == 1:
+        factors.append("same vendor")
+    elif feature_row["same_vendor_id"] == 0:
+        factors.append("different vendors")
+    if pd.notna(feature_row["amount_diff"]):
+        factors.append("identical amounts" if feature_row["amount_diff"] < 0.01 else f"amount difference {feature_row['amount_diff']:.2f}")
+    if pd.notna(feature_row["date_gap_days"]):
+        factors.append(f"{int(feature_row['date_gap_days'])} days between invoice dates")
+    if feature_row["same_purchase_order"] == 1:
+        factors.append("same purchase order")
+    return factors
+
+def triage_pairs(scored_pairs_df, positions, bundle, confidence=0.95):
+    """
+    Auto-label the pairs at the given row positions that the triage model is confident about.
+    Returns a dict mapping position to an LLM-style result for every auto-labelled pair.
+    """
+    if not positions:
+        return {}
+    subset = scored_pairs_df.iloc[positions]
+    features = pair_features(subset)
+    probabilities = bundle["estimator"].predict_proba(features)[:, 1]
+
+    verdicts = {}
+    for position, probability, (_, feature_row) in zip(positions, probabilities, features.iterrows()):
+        if probability >= confidence:
+            classification = "Very likely"
+        elif probability <= 1 - confidence:
+            classification = "Not likely"
+        else:
+            continue
+        verdicts[position] = {
+            "classification": classification,
+            "explanation": f"Auto-labelled by the local triage model (duplicate probability {probability:.2f}); not sent to the LLM.",
+            "keyFactors": describe_factors(feature_row),
+            "source": TRIAGE_SOURCE,
+        }
+    return verdicts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the local triage model from past analysis outputs.")
+    parser.add_argument("--inputs", nargs="+", required=True, help="Output JSON files or directories containing them.")
+    parser.add_argument("--model", required=True, help="Path to save the trained model (joblib).")
+    parser.add_argument("--model-type", choices=["gbdt", "logistic"], default="gbdt", help="Gradient boosting or logistic regression.")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence used to report holdout auto-label coverage.")
+
+    args = parser.parse_args()
+
+    try:
+        train_triage_model(args.inputs, args.model, args.model_type, args.confidence)
+    except ValueError as e:
+        log_message(str(e), "ERROR")
+        sys.exit(1)
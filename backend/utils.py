@@ -1,10 +1,14 @@
 # filepath: backend/utils.py
+import os
 import json
 import uuid
 from datetime import datetime
 import pandas as pd
 import numpy as np
 
+# Column tagging each invoice with its input file in multi-file batch runs
+SOURCE_FILE_COLUMN = 'SOURCE_FILE'
+
 def custom_json_serializer(obj):
     if isinstance(obj, (datetime, pd.Timestamp)):
         return obj.isoformat()
@@ -39,7 +43,13 @@ def map_invoice_data_to_json(row, prefix):
     company_code = row.get(f'{prefix}_COMPANY_CODE')
     company_code_str = str(company_code) if pd.notna(company_code) else None
 
-    return {
+    invoice_date = row.get(f'{prefix}_INVOICE_DATE')
+    invoice_date_str = pd.to_datetime(invoice_date).strftime('%Y-%m-%d') if pd.notna(invoice_date) else None
+
+    purchase_order = row.get(f'{prefix}_PURCHASE_ORDER')
+    purchase_order_str = str(purchase_order) if pd.notna(purchase_order) else None
+
+    invoice_data = {
         "number": doc_no_str,
         "amount": amount_float,
         "currency": currency_str,
@@ -48,11 +58,18 @@ def map_invoice_data_to_json(row, prefix):
         "vendorNumber": vendor_id_str,
         "vendorName": vendor_name_str,
         "postingText": description_str,
+        "invoiceDate": invoice_date_str,
+        "purchaseOrder": purchase_order_str,
         "debitCreditIndicator": "H", # Default, as not in SBERT output
         "sapLink": f"sap-link://doc/{doc_no_str}" if doc_no_str else None
     }
+    # Only present in multi-file batch runs
+    if f'{prefix}_{SOURCE_FILE_COLUMN}' in row:
+        source_file = row.get(f'{prefix}_{SOURCE_FILE_COLUMN}')
+        invoice_data["sourceFile"] = str(source_file) if pd.notna(source_file) else None
+    return invoice_data
 
-def format_output_json(processed_df, project_id, project_name, project_description):
+def format_output_json(processed_df, project_id, project_name, project_description, llm_usage=None, source_files=None):
     pairs_list = []
     for _, row in processed_df.iterrows():
         doc1_data = map_invoice_data_to_json(row, "INV1")
@@ -62,9 +79,12 @@ def format_output_json(processed_df, project_id, project_name, project_descripti
         if doc1_data["amount"] is not None and doc2_data["amount"] is not None:
             amount_diff = abs(doc1_data["amount"] - doc2_data["amount"])
 
+        cluster_id = row.get('cluster_id')
         pair_data = {
             "id": str(uuid.uuid4()),
             "score": float(row.get('similarity', 0.0)) if pd.notna(row.get('similarity')) else 0.0,
+            "clusterId": int(cluster_id) if pd.notna(cluster_id) else None,
+            "matchType": row.get('match_type') if pd.notna(row.get('match_type')) else "sbert",
             "status": "pending",
             "doc1": doc1_data,
             "doc2": doc2_data,
@@ -76,21 +96,102 @@ def format_output_json(processed_df, project_id, project_name, project_descripti
                 "classification": row.get('llm_classification', 'N/A'),
                 "explanation": row.get('llm_explanation', 'N/A'),
                 "keyFactors": row.get('llm_key_factors', []),
+                "source": row.get('llm_source', 'llm'),
                 # "duplicationProbability": 0.94, # Example field, LLM could provide this
                 # "recommendedAction": "mark_as_duplicate" # Example field
             }
         }
         pairs_list.append(pair_data)
 
+    project = {
+        "id": project_id,
+        "name": project_name,
+        "description": project_description,
+        "createdAt": datetime.now().isoformat(),
+        "lastUpdated": datetime.now().isoformat(),
+        "totalPairs": len(pairs_list),
+        "reviewedPairs": 0,
+        "deferredPairs": sum(1 for pair in pairs_list if pair["llmAnalysis"]["classification"] == "Deferred"),
+        "duplicateClusters": len({pair["clusterId"] for pair in pairs_list if pair["clusterId"] is not None}),
+        # Requests and tokens sent to the LLM in this run (see llm_scheduler.TokenUsage)
+        "llmUsage": llm_usage
+    }
+    if source_files is not None:
+        project["sourceFiles"] = source_files
     return {
-        "project": {
-            "id": project_id,
-            "name": project_name,
-            "description": project_description,
-            "createdAt": datetime.now().isoformat(),
-            "lastUpdated": datetime.now().isoformat(),
-            "totalPairs": len(pairs_list),
-            "reviewedPairs": 0
-        },
+        "project": project,
         "pairs": pairs_list
     }
+
+def source_file_labels(input_paths):
+    """
+    Label each input file by its path relative to the files' common directory
+    (the file name, unless two files in different directories share it).
+    """
+    paths = [os.path.abspath(path) for path in input_paths]
+    common_dir = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return [os.path.relpath(path, common_dir) for path in paths]
+
+def combine_input_files(input_paths, combined_csv_path):
+    """
+    Concatenate several invoice extracts into one semicolon-separated CSV with a
+    SOURCE_FILE column, so they are blocked and scored as one table.
+
+    Rows identical in every column (the same invoice in overlapping extracts) are kept
+    once, tagged with the first file they appear in.
+
+    Returns:
+        Dict of source file label to the number of its rows in the combined CSV
+    """
+    frames = []
+    for path, label in zip(input_paths, source_file_labels(input_paths)):
+        frame = pd.read_csv(path, dtype=str, sep=';')
+        frame[SOURCE_FILE_COLUMN] = label
+        frames.append(frame)
+    combined_df = pd.concat(frames, ignore_index=True)
+    data_columns = [column for column in combined_df.columns if column != SOURCE_FILE_COLUMN]
+    combined_df = combined_df.drop_duplicates(subset=data_columns, keep='first')
+    combined_df.to_csv(combined_csv_path, sep=';', index=False)
+    return combined_df[SOURCE_FILE_COLUMN].value_counts().reindex(source_file_labels(input_paths), fill_value=0).to_dict()
+
+def pairs_for_source_file(processed_df, source_file):
+    """
+    Pairs with at least one invoice from source_file, including pairs across files.
+    """
+    if processed_df.empty:
+        return processed_df
+    in_file = (processed_df[f'INV1_{SOURCE_FILE_COLUMN}'] == source_file) | (processed_df[f'INV2_{SOURCE_FILE_COLUMN}'] == source_file)
+    return processed_df[in_file]
+
+def pair_key(row):
+    """
+    Stable identifier of an invoice pair, used to match checkpointed LLM verdicts.
+    """
+    return f"{row.get('INV1_DOC_NO')}|{row.get('INV2_DOC_NO')}"
+
+def load_llm_checkpoint(checkpoint_path):
+    """
+    Load per-pair LLM verdicts written by an earlier (possibly interrupted) run.
+    Returns a dict mapping pair_key to the verdict.
+    """
+    verdicts = {}
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return verdicts
+    with open(checkpoint_path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be truncated if the run was killed mid-write
+                continue
+            verdicts[entry.pop('key')] = entry
+    return verdicts
+
+def append_llm_checkpoint(checkpoint_path, key, verdict):
+    """
+    Append one LLM verdict to the checkpoint file and flush it to disk immediately.
+    """
+    with open(checkpoint_path, 'a') as f:
+        f.write(json.dumps({"key": key, **verdict}, default=custom_json_serializer) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
@@ -0,0 +1,232 @@
+import os
+import gc
+import re
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MIN_BATCH_SIZE = 10000
+MAX_BATCH_SIZE = 8000000
+# Share of the available memory one batch may take; the rest is left for the OS and page cache
+MEMORY_HEADROOM = 0.5
+# Throughput must improve by this share for a larger batch to be kept
+THROUGHPUT_GAIN = 0.05
+MEMORY_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_memory_size(text):
+    '''
+    Parse a memory size like "512M", "8G" or "1.5GiB" (binary units) into bytes.
+    A plain number is a number of bytes.
+    '''
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*', str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid memory size: {text}")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()])
+
+def format_bytes(num_bytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TiB"
+
+def read_int(path):
+    try:
+        with open(path, 'r') as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+def cgroup_available_memory():
+    '''
+    Memory left under the cgroup limit of a container (v2 or v1), or None without a limit.
+    '''
+    for limit_path, usage_path in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        limit, usage = read_int(limit_path), read_int(usage_path)
+        # cgroup v1 reports "no limit" as a huge number
+        if limit is not None and usage is not None and limit < 1 << 60:
+            return max(0, limit - usage)
+    return None
+
+def available_memory():
+    '''
+    Bytes of memory available to this process without swapping, or None if unknown.
+
+    The smaller of the system's available memory (psutil, else /proc/meminfo) and the room
+    left under a container's cgroup limit, which the OOM killer enforces.
+    '''
+    candidates = [cgroup_available_memory()]
+    if psutil is not None:
+        candidates.append(psutil.virtual_memory().available)
+    else:
+        try:
+            with open('/proc/meminfo', 'r') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        candidates.append(int(line.split()[1]) * 1024)
+                        break
+        except OSError:
+            pass
+    candidates = [value for value in candidates if value is not None]
+    return min(candidates) if candidates else None
+
+def process_memory():
+    '''
+    Resident memory of this process in bytes, or None if unknown.
+    '''
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class AdaptiveBatchSizer:
+    '''
+    Choose the number of pairs per scoring batch from memory and observed throughput.
+
+    A batch may take MEMORY_HEADROOM of the available memory, but never gets smaller than
+    min_size for it. Within that budget, the size is doubled while throughput improves by
+    THROUGHPUT_GAIN and stepped back once it stops improving; it shrinks as soon as the budget
+    no longer fits it.
+
+    memory_limit is a hard ceiling, also for fixed batches: before every batch, the batch's
+    estimated memory must fit in the room left between the process's resident memory and the
+    limit. The batch is made as small as needed for that, below min_size down to one pair,
+    and MemoryError is raised when not even one pair fits. Memory the caller allocates
+    outside the batches, and errors in the estimate, are not covered.
+
+    The memory a batch takes is estimated as fixed_bytes plus bytes_per_pair for the index
+    and score arrays, plus row_bytes for every flagged pair turned into output rows, with
+    the flagged share observed on the batches scored so far.
+    '''
+
+    def __init__(self, bytes_per_pair, fixed_bytes=0, row_bytes=0, initial_size=250000, min_size=MIN_BATCH_SIZE,
+                 max_size=MAX_BATCH_SIZE, memory_limit=None, adaptive=True, headroom=MEMORY_HEADROOM):
+        '''
+        Args:
+            bytes_per_pair: Memory per pair in a batch, independent of the outcome
+            fixed_bytes: Memory a batch takes regardless of its size (e.g. kernel chunk buffers)
+            row_bytes: Memory per flagged pair for its output rows
+            initial_size: Size of the first batch, lowered to what the memory budget allows
+            min_size: Smallest batch size the available memory can push it to; only
+                memory_limit can go below it
+            max_size: Largest batch size
+            memory_limit: Optional hard ceiling on the process's resident memory, in bytes
+            adaptive: False keeps initial_size for every batch that fits under memory_limit
+            headroom: Share of the available memory a batch may take
+        '''
+        self.bytes_per_pair = bytes_per_pair
+        self.fixed_bytes = fixed_bytes
+        self.row_bytes = row_bytes
+        self.min_size = max(1, min(min_size, max_size))
+        self.max_size = max_size
+        self.memory_limit = memory_limit
+        self.adaptive = adaptive
+        self.headroom = headroom
+        self.pairs_seen = 0
+        self.flagged_seen = 0
+        self.best_throughput = None
+        self.growing = adaptive
+        self.sizes = []
+        self.size = initial_size if not adaptive else min(max(initial_size, self.min_size), max_size)
+
+    def limit_budget(self):
+        '''
+        Bytes left under memory_limit, or None without a limit. The process's resident memory
+        counts against the limit in full when it cannot be measured.
+        '''
+        if not self.memory_limit:
+            return None
+        resident = process_memory()
+        return max(0.0, self.memory_limit - (resident if resident is not None else self.memory_limit))
+
+    def memory_budget(self):
+        '''
+        Bytes the next batch may take, or None if no memory information is available.
+        '''
+        budgets = []
+        available = available_memory()
+        if available is not None:
+            budgets.append(available * self.headroom)
+        limit = self.limit_budget()
+        if limit is not None:
+            budgets.append(limit)
+        return max(0.0, min(budgets)) if budgets else None
+
+    def pair_bytes(self):
+        flagged_share = self.flagged_seen / self.pairs_seen if self.pairs_seen else 0.0
+        return self.bytes_per_pair + flagged_share * self.row_bytes
+
+    def fitting_size(self, budget):
+        return int((budget - self.fixed_bytes) / self.pair_bytes())
+
+    def memory_size(self):
+        '''
+        Largest batch size the memory budget allows right now: at least min_size for the
+        available memory, but no more than fits under memory_limit.
+        '''
+        size = self.max_size
+        available = available_memory()
+        if available is not None:
+            size = max(self.min_size, min(size, self.fitting_size(available * self.headroom)))
+        limit = self.limit_budget()
+        if limit is not None:
+            size = min(size, self.fitting_size(limit))
+        return size
+
+    def next_size(self):
+        '''
+        Size of the next batch. Logs the size whenever it changes.
+
+        Raises:
+            MemoryError: If memory_limit leaves no room for a batch of one pair
+        '''
+        fitting = self.memory_size() if self.adaptive or self.memory_limit else self.size
+        if fitting < self.size:
+            # Free what earlier batches left behind before settling for a smaller batch
+            gc.collect()
+            fitting = self.memory_size()
+            if fitting < 1:
+                resident = process_memory()
+                raise MemoryError(
+                    f"Memory limit of {format_bytes(self.memory_limit)} leaves no room for a scoring batch: "
+                    f"the process already uses {format_bytes(resident) if resident is not None else 'an unknown amount'} "
+                    f"and a batch takes at least {format_bytes(self.fixed_bytes + self.pair_bytes())}; "
+                    f"raise --memory-limit")
+            if fitting < self.size:
+                self.size = fitting
+                self.growing = False
+        if not self.sizes or self.sizes[-1] != self.size:
+            budget = self.memory_budget()
+            budget_text = f", memory budget {format_bytes(budget)}" if budget is not None else ""
+            print(f"Scoring batches of {self.size} pairs (~{format_bytes(self.fixed_bytes + self.size * self.pair_bytes())}"
+                  f"{budget_text})")
+            self.sizes.append(self.size)
+        return self.size
+
+    def record(self, pairs, flagged, seconds):
+        '''
+        Report a scored batch: its size, the pairs it flagged and the seconds it took.
+        '''
+        self.pairs_seen += pairs
+        self.flagged_seen += flagged
+        if not self.adaptive or pairs < self.size or seconds <= 0:
+            # The last, partial batch says nothing about the batch size
+            return
+        throughput = pairs / seconds
+        if self.best_throughput is None or throughput > self.best_throughput * (1 + THROUGHPUT_GAIN):
+            self.best_throughput = throughput
+            if self.growing:
+                self.size = min(self.max_size, self.size * 2)
+        elif self.growing:
+            # No gain from the last doubling: go back and stay there
+            self.size = max(self.min_size, self.size // 2)
+            self.growing = False
+        else:
+            self.best_throughput = max(self.best_throughput, throughput)
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import pandas as pd
+
+from generate_invoices import generate_invoices
+from predict_pairs import load_invoices, load_model, predict_duplicates, SCORING_MODES
+from embedding_store import EMBEDDING_FORMATS
+from vendor_blocking import VENDOR_BLOCKING_METHODS
+from lexical_cascade import parse_lexical_band
+from batch_sizing import parse_memory_size
+
+def compute_recall(result_df, labels_df):
+    '''
+    Compute the share of injected duplicate pairs that were flagged.
+
+    Args:
+        result_df: DataFrame returned by predict_duplicates
+        labels_df: DataFrame of injected pairs with INV1_DOC_NO and INV2_DOC_NO
+
+    Returns:
+        Tuple of (recall, number of flagged pairs that are not injected duplicates)
+    '''
+    expected = {frozenset((str(a), str(b))) for a, b in zip(labels_df['INV1_DOC_NO'], labels_df['INV2_DOC_NO'])}
+    flagged = set()
+    if not result_df.empty:
+        flagged = {frozenset((str(a), str(b))) for a, b in zip(result_df['INV1_DOC_NO'], result_df['INV2_DOC_NO'])}
+
+    recall = len(expected & flagged) / len(expected) if expected else 1.0
+    return recall, len(flagged - expected)
+
+def run_benchmark(scales, model_path, threshold_path, batch_size=250000, vendor_skew=1.1,
+                  duplicate_rate=0.05, seed=42, work_dir=None, partition_by=None, workers=1,
+                  cross_partition_vendor=False, embedding_format='float32', pca_dims=None, vendor_blocking='minhash',
+                  vendor_typo_rate=0.0, lexical_band=None, scoring_mode='sentence', field_cache_dir=None,
+                  memory_limit=None):
+    '''
+    Time the SBERT pipeline stages on synthetic extracts of increasing size.
+
+    Args:
+        scales: List of invoice counts to benchmark
+        model_path: Path to the saved model
+        threshold_path: Path to the saved threshold
+        batch_size: Number of pairs to process in each batch
+        vendor_skew: Zipf exponent of the vendor distribution
+        duplicate_rate: Fraction of injected near-duplicates
+        seed: Random seed for the generator
+        work_dir: Directory for the generated CSVs (temporary directory if None)
+        partition_by: Optional partition key columns for the partitioned parallel mode
+        workers: Number of worker processes
+        cross_partition_vendor: Add the cross-partition VENDOR_ID pass
+        embedding_format: Format embeddings are scored in; for anything but float32 the
+            flagged pairs are also compared with float32 scoring
+        pca_dims: Optional number of PCA dimensions to reduce the embeddings to
+        vendor_blocking: Vendor name blocking method (see generate_candidate_pairs)
+        vendor_typo_rate: Share of injected duplicates booked on a duplicate vendor record
+            with a misspelled name
+        lexical_band: Optional lexical cascade band, (low, high) or 'auto' (see predict_duplicates)
+        scoring_mode: 'sentence' or 'fields' (see predict_duplicates)
+        field_cache_dir: Field embedding cache directory for scoring_mode='fields'
+        memory_limit: Optional memory ceiling in bytes for sizing scoring batches
+
+    Returns:
+        List of dicts with per-scale timings, throughput and recall
+    '''
+    # Load the model once so that model loading does not distort the per-scale numbers
+    load_start = time.perf_counter()
+    model, device = load_model(model_path)
+    model_load_time = time.perf_counter() - load_start
+    print(f"Model loaded in {model_load_time:.2f}s on {device}")
+
+    work_dir = work_dir or tempfile.mkdtemp(prefix='payguard_bench_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+    for num_invoices in scales:
+        print(f"\n=== Benchmarking {num_invoices} invoices ===")
+        df, labels_df = generate_invoices(num_invoices, vendor_skew=vendor_skew,
+                                          duplicate_rate=duplicate_rate, seed=seed, vendor_typo_rate=vendor_typo_rate)
+        input_path = os.path.join(work_dir, f"invoices_{num_invoices}.csv")
+        output_path = os.path.join(work_dir, f"scored_pairs_{num_invoices}.csv")
+        df.to_csv(input_path, sep=';', index=False)
+
+        load_start = time.perf_counter()
+        df = load_invoices(input_path)
+        load_time = time.perf_counter() - load_start
+
+        stage_timings = {}
+        quantized = embedding_format != 'float32' or pca_dims
+        quantization_report = {} if quantized else None
+        run_start = time.perf_counter()
+        result_df = predict_duplicates(df, model_path, threshold_path, batch_size=batch_size,
+                                       output_csv_path=output_path, model=model, device=device,
+                                       stage_timings=stage_timings, partition_by=partition_by, workers=workers,
+                                       cross_partition_vendor=cross_partition_vendor,
+                                       embedding_format=embedding_format, pca_dims=pca_dims,
+                                       quantization_report=quantization_report, vendor_blocking=vendor_blocking,
+                                       lexical_band=lexical_band, scoring_mode=scoring_mode,
+                                       field_cache_dir=field_cache_dir, memory_limit=memory_limit)
+        total_time = time.perf_counter() - run_start + load_time
+
+        recall, unexpected = compute_recall(result_df, labels_df)
+        candidate_pairs = stage_timings.get('candidate_pairs', 0)
+        scoring_time = stage_timings['encoding'] + stage_timings['scoring']
+
+        results.append({
+            'invoices': num_invoices,
+            'workers': workers,
+            'vendor_blocking': vendor_blocking,
+            'injected_duplicates': len(labels_df),
+            'candidate_pairs': candidate_pairs,
+            'flagged_pairs': len(result_df),
+            'unexpected_pairs': unexpected,
+            'recall': recall,
+            'load_s': load_time,
+            'exact_pairs': stage_timings.get('exact_pairs', 0),
+            'fingerprint_s': stage_timings['fingerprint'],
+            'blocking_s': stage_timings['blocking'],
+            'encoding_s': stage_timings['encoding'],
+            'scoring_s': stage_timings['scoring'],
+            'output_s': stage_timings['output'],
+            'lexical_s': stage_timings['lexical'],
+            # Pairs the lexical cascade decided without SBERT, and invoices left to encode
+            'lexical_rejected': stage_timings.get('lexical_rejected', 0),
+            'lexical_accepted': stage_timings.get('lexical_accepted', 0),
+            'encoded_invoices': stage_timings.get('encoded_invoices', 0),
+            'scoring_mode': scoring_mode,
+            # Field values encoded in this run; cached ones are not counted
+            'encoded_fields': stage_timings.get('encoded_fields', 0),
+            'max_batch_size': max(stage_timings.get('batch_sizes') or [0]),
+            'total_s': total_time,
+            'invoices_per_s': num_invoices / total_time if total_time > 0 else 0.0,
+            'pairs_per_s': candidate_pairs / scoring_time if scoring_time > 0 else 0.0,
+            'embedding_format': embedding_format if not pca_dims else f"{embedding_format}/pca{pca_dims}",
+            'bytes_per_invoice': quantization_report.get('bytes_per_invoice') if quantized else None,
+            # Pairs whose threshold decision differs from float32 scoring
+            'lost_pairs': quantization_report.get('lost') if quantized else 0,
+            'added_pairs': quantization_report.get('added') if quantized else 0,
+        })
+
+    return results
+
+def print_report(results):
+    '''
+    Print the benchmark results as a table.
+
+    Args:
+        results: List of dicts returned by run_benchmark
+    '''
+    report_df = pd.DataFrame(results)
+    print("\n=== Benchmark results ===")
+    print(report_df.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the duplicate detection pipeline on synthetic invoices')
+    parser.add_argument('--scales', type=str, default='1000,5000,20000', help='Comma-separated invoice counts')
+    parser.add_argument('--model', type=str, default='invoice_sbert', help='Path to model directory')
+    parser.add_argument('--threshold', type=str, default='best_threshold.txt', help='Path to threshold file')
+    parser.add_argument('--batch-size', type=int, default=250000, help='Batch size for processing')
+    parser.add_argument('--vendor-skew', type=float, default=1.1, help='Zipf exponent of vendor popularity')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05, help='Fraction of injected near-duplicates')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    parser.add_argument('--work-dir', type=str, default=None, help='Directory for generated CSVs and outputs')
+    parser.add_argument('--partition-by', type=str, default=None, help='Comma-separated partition columns, e.g. COMPANY_CODE,CURRENCY')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes (0 = all cores)')
+    parser.add_argument('--cross-partition-vendor', action='store_true', help='Add the cross-partition VENDOR_ID pass')
+    parser.add_argument('--embedding-format', type=str, choices=EMBEDDING_FORMATS, default='float32', help='Format embeddings are scored in')
+    parser.add_argument('--pca-dims', type=int, default=None, help='Reduce embeddings to this many PCA dimensions')
+    parser.add_argument('--vendor-blocking', type=str, choices=VENDOR_BLOCKING_METHODS, default='minhash',
+                        help='Block on similar vendor names (MinHash-LSH) or on the vendor name prefix')
+    parser.add_argument('--vendor-typo-rate', type=float, default=0.0,
+                        help='Share of injected duplicates booked on a duplicate vendor record with a misspelled name')
+    parser.add_argument('--lexical-band', type=str, default=None,
+                        help='Decide pairs outside LOW:HIGH on TF-IDF n-gram similarity, or auto to calibrate the band')
+    parser.add_argument('--scoring-mode', type=str, choices=SCORING_MODES, default='sentence',
+                        help='Encode whole invoice sentences, or each distinct vendor name and description once')
+    parser.add_argument('--field-cache', type=str, default=None, help='Field embedding cache directory for --scoring-mode fields')
+    parser.add_argument('--memory-limit', type=str, default=None, help='Memory ceiling for sizing scoring batches, e.g. 4G')
+    parser.add_argument('--report', type=str, default=None, help='Path to save the results as JSON')
+
+    args = parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(',') if scale.strip()]
+    results = run_benchmark(scales, args.model, args.threshold, args.batch_size, args.vendor_skew,
+                            args.duplicate_rate, args.seed, args.work_dir,
+                            partition_by=[column.strip() for column in args.partition_by.split(',')] if args.partition_by else None,
+                            workers=args.workers if args.workers > 0 else os.cpu_count(),
+                            cross_partition_vendor=args.cross_partition_vendor,
+                            embedding_format=args.embedding_format, pca_dims=args.pca_dims,
+                            vendor_blocking=args.vendor_blocking, vendor_typo_rate=args.vendor_typo_rate,
+                            lexical_band=parse_lexical_band(args.lexical_band), scoring_mode=args.scoring_mode,
+                            field_cache_dir=args.field_cache,
+                            memory_limit=parse_memory_size(args.memory_limit) if args.memory_limit else None)
+    print_report(results)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved benchmark report to {args.report}")
@@ -0,0 +1,209 @@
+import os
+import numpy as np
+
+EMBEDDING_FORMATS = ('float32', 'float16', 'int8')
+# Pairs gathered per kernel call and rows per matrix-vector chunk; both bound temporary memory
+PAIR_CHUNK_SIZE = 16384
+ROW_CHUNK_SIZE = 2048
+PCA_SAMPLE_SIZE = 50000
+
+def fit_pca(embeddings, dims, sample_size=PCA_SAMPLE_SIZE, seed=42):
+    '''
+    Fit the projection onto the top principal directions of the embeddings.
+
+    The data is not centered: the uncentered SVD gives the rank-dims subspace that best
+    preserves dot products, and dot products are what the threshold is applied to.
+
+    Args:
+        embeddings: float32 array of L2-normalized embeddings
+        dims: Number of dimensions to keep
+        sample_size: Number of embeddings the projection is fitted on
+        seed: Random seed for the sample
+
+    Returns:
+        float32 array of shape (dims, original dimensions)
+    '''
+    if dims >= embeddings.shape[1]:
+        raise ValueError(f"PCA dimensions ({dims}) must be below the embedding size ({embeddings.shape[1]})")
+    sample = embeddings
+    if len(embeddings) > sample_size:
+        rng = np.random.default_rng(seed)
+        sample = embeddings[np.sort(rng.choice(len(embeddings), sample_size, replace=False))]
+    _, _, components = np.linalg.svd(np.asarray(sample, dtype=np.float32), full_matrices=False)
+    return components[:dims].astype(np.float32)
+
+class EmbeddingStore:
+    '''
+    L2-normalized embeddings held as float32, float16 or per-vector-scaled int8, optionally
+    PCA-reduced, with similarity kernels that work on the stored format directly.
+
+    int8 vectors are stored as codes round(127 * x / max(|x|)). Quantized formats keep one
+    float32 scale per vector, 1 / norm(stored vector), so scale1 * scale2 * (dot product of
+    the stored vectors, accumulated in int32 or float32) is the cosine of the stored vectors.
+    Correcting the norm removes the error rounding introduces in it, which would otherwise
+    shift all scores of a vector in the same direction.
+    '''
+
+    def __init__(self, vectors, scales=None, components=None):
+        self.vectors = vectors
+        self.scales = scales
+        self.components = components
+
+    @classmethod
+    def from_float32(cls, embeddings, embedding_format='float32', pca_dims=None):
+        '''
+        Build a store from float32 embeddings.
+
+        Args:
+            embeddings: float32 array of L2-normalized embeddings
+            embedding_format: One of EMBEDDING_FORMATS
+            pca_dims: Optional number of dimensions to reduce to before quantizing
+        '''
+        if embedding_format not in EMBEDDING_FORMATS:
+            raise ValueError(f"Unknown embedding format {embedding_format}; use one of {', '.join(EMBEDDING_FORMATS)}")
+        components = fit_pca(embeddings, pca_dims) if pca_dims and len(embeddings) else None
+        store = cls(None, components=components)
+        store.vectors, store.scales = store.encode(embeddings, embedding_format)
+        return store
+
+    @property
+    def embedding_format(self):
+        return self.vectors.dtype.name
+
+    def project(self, embeddings):
+        '''
+        Apply the PCA projection (if any) and re-normalize, so dot products stay cosine similarities.
+        '''
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.components is None:
+            return embeddings
+        projected = embeddings @ self.components.T
+        return projected / np.maximum(np.linalg.norm(projected, axis=-1, keepdims=True), 1e-12)
+
+    def encode(self, embeddings, embedding_format=None):
+        '''
+        Convert float32 embeddings to the stored format.
+
+        Returns:
+            Tuple of (vectors, per-vector float32 scales or None for float32)
+        '''
+        embedding_format = embedding_format or self.embedding_format
+        embeddings = self.project(embeddings)
+        if embedding_format == 'float32':
+            return embeddings, None
+        if embedding_format == 'int8':
+            ranges = np.abs(embeddings).max(axis=-1, initial=0.0)
+            ranges = np.where(ranges > 0, ranges, 1.0)
+            vectors = np.rint(embeddings * (127.0 / ranges[..., None])).astype(np.int8)
+        else:
+            vectors = embeddings.astype(embedding_format)
+        norms = np.linalg.norm(vectors.astype(np.float32), axis=-1)
+        scales = (1.0 / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+        return vectors, scales
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def bytes_per_vector(self):
+        return self.vectors.shape[1] * self.vectors.itemsize + (4 if self.scales is not None else 0)
+
+    @property
+    def nbytes(self):
+        return len(self) * self.bytes_per_vector
+
+    def pair_similarities(self, rows1, rows2, chunk_size=PAIR_CHUNK_SIZE):
+        '''
+        Compute cosine similarities for pairs of stored vectors.
+
+        Args:
+            rows1: Rows of the first vector of each pair
+            rows2: Rows of the second vector of each pair
+            chunk_size: Number of pairs gathered at once, bounds temporary memory
+
+        Returns:
+            float32 array of similarities
+        '''
+        similarities = np.empty(len(rows1), dtype=np.float32)
+        for start in range(0, len(rows1), chunk_size):
+            end = start + chunk_size
+            first, second = rows1[start:end], rows2[start:end]
+            # int8 codes are multiplied exactly in int32, float16 is accumulated in float32
+            accumulator = np.int32 if self.embedding_format == 'int8' else np.float32
+            dots = np.einsum('ij,ij->i', self.vectors[first], self.vectors[second], dtype=accumulator)
+            if self.scales is not None:
+                dots = dots * self.scales[first] * self.scales[second]
+            similarities[start:end] = dots
+        return similarities
+
+    def similarities_to(self, embedding, chunk_size=ROW_CHUNK_SIZE):
+        '''
+        Cosine similarity of one float32 embedding to every stored vector.
+
+        The query is projected but not quantized, so only the stored side carries quantization error.
+        '''
+        query = self.project(embedding).astype(np.float32)
+        if self.embedding_format == 'float32':
+            return np.asarray(self.vectors @ query, dtype=np.float32)
+        similarities = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), chunk_size):
+            # Converting a chunk keeps the product on the float32 BLAS path
+            similarities[start:start + chunk_size] = self.vectors[start:start + chunk_size].astype(np.float32) @ query
+        if self.scales is not None:
+            similarities *= self.scales
+        return similarities
+
+    def save(self, directory, name='embeddings'):
+        '''
+        Write the store as .npy files that load() can memory-map.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        arrays = {name: self.vectors, f"{name}_scales": self.scales, f"{name}_pca": self.components}
+        for array_name, array in arrays.items():
+            path = os.path.join(directory, f"{array_name}.npy")
+            if array is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            tmp_path = f"{path}.tmp.npy"
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, directory, name='embeddings', mmap=True):
+        def load_array(array_name, mmap_mode=None):
+            path = os.path.join(directory, f"{array_name}.npy")
+            return np.load(path, mmap_mode=mmap_mode) if os.path.exists(path) else None
+        return cls(load_array(name, 'r' if mmap else None), load_array(f"{name}_scales"), load_array(f"{name}_pca"))
+
+    def describe(self):
+        pca = f", PCA to {self.vectors.shape[1]} dims" if self.components is not None else ""
+        return f"{self.embedding_format}{pca}, {self.bytes_per_vector} bytes per invoice"
+
+def threshold_agreement(reference, scores, threshold):
+    '''
+    Compare the threshold decision on quantized scores with the one on float32 scores.
+
+    Args:
+        reference: float32 similarities of the candidate pairs
+        scores: Similarities of the same pairs from a quantized store
+        threshold: Similarity threshold
+
+    Returns:
+        Dict with the pairs flagged either way, the pairs only flagged in float32 ('lost') or only
+        with quantization ('added'), and the mean and maximum absolute score error
+    '''
+    reference = np.asarray(reference, dtype=np.float32)
+    scores = np.asarray(scores, dtype=np.float32)
+    flagged_reference = reference >= threshold
+    flagged = scores >= threshold
+    errors = np.abs(scores - reference)
+    return {
+        'pairs': int(len(reference)),
+        'flagged_float32': int(flagged_reference.sum()),
+        'flagged': int(flagged.sum()),
+        'lost': int((flagged_reference & ~flagged).sum()),
+        'added': int((flagged & ~flagged_reference).sum()),
+        'mean_abs_error': float(errors.mean()) if len(errors) else 0.0,
+        'max_abs_error': float(errors.max()) if len(errors) else 0.0,
+    }
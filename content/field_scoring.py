@@ -0,0 +1,346 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Free-text fields that are embedded on their own; each distinct value is encoded once
+FIELD_TEXT_COLUMNS = ('VENDOR_NAME', 'DESCRIPTION')
+# Coded fields that are compared for equality, as row_to_sentence spells them out
+FIELD_CODE_COLUMNS = ('VENDOR_ID', 'CURRENCY', 'PURCHASE_ORDER', 'COST_CENTER', 'TAX_CODE', 'PAYMENT_TERMS')
+FIELD_FEATURES = (
+    ('vendor_name_similarity', 'description_similarity', 'amount_closeness', 'date_closeness')
+    + tuple(f"same_{column.lower()}" for column in FIELD_CODE_COLUMNS)
+)
+FIELD_CALIBRATION_SAMPLE_SIZE = 2000
+FIELD_EMBEDDINGS_FILE = 'field_embeddings.npz'
+FIELD_CACHE_MANIFEST = 'model.json'
+# Model files that change when a model is retrained: weights by size and modification time,
+# configuration by content
+MODEL_WEIGHT_SUFFIXES = ('.safetensors', '.bin', '.pt', '.onnx')
+PAIR_CHUNK_SIZE = 16384
+# Memory per pair in a scoring batch: features, scores, index gathers and masks
+FIELD_BYTES_PER_PAIR = 256
+
+def field_text(value):
+    '''
+    Text of a field value as row_to_sentence writes it, with "unknown" for missing values.
+    '''
+    if pd.isna(value) or str(value).strip() == '':
+        return 'unknown'
+    return ' '.join(str(value).split())
+
+def text_keys(texts):
+    '''
+    Stable 64-bit keys of texts (unlike hash() of a str, equal across processes).
+    '''
+    return pd.util.hash_array(np.asarray(list(texts), dtype=object))
+
+def model_fingerprint(model_path):
+    '''
+    SHA-1 of a model directory's content: the size and modification time of every weights
+    file and the content of every JSON configuration file, so a model retrained into the
+    same directory gets a new fingerprint without hashing gigabytes of weights.
+    '''
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(model_path):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, model_path)
+            if name.endswith(MODEL_WEIGHT_SUFFIXES):
+                stat = os.stat(path)
+                digest.update(f"{relative}:{stat.st_size}:{stat.st_mtime_ns}\n".encode('utf-8'))
+            elif name.endswith('.json'):
+                digest.update(f"{relative}\n".encode('utf-8'))
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, FIELD_CACHE_MANIFEST), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class FieldEmbeddingCache:
+    '''
+    Embeddings of distinct field values, persisted per model so that values seen in earlier
+    runs are never encoded again.
+
+    The cache of a model lives in <cache_dir>/<model fingerprint>/ and holds the embeddings
+    keyed by a 64-bit hash of the text, plus one score calibration per threshold. Its
+    model.json records the model path and fingerprint. A cache whose fingerprint does not
+    match, e.g. of a model since retrained into the same directory, is deleted with its
+    calibrations instead of being used.
+    '''
+
+    def __init__(self, cache_dir, model_path):
+        model_path = os.path.abspath(model_path)
+        self.fingerprint = model_fingerprint(model_path)
+        self.directory = os.path.join(cache_dir, self.fingerprint[:16])
+        self.model_path = model_path
+        self.path = os.path.join(self.directory, FIELD_EMBEDDINGS_FILE)
+        self.discard_stale(cache_dir)
+        if os.path.exists(self.path):
+            with np.load(self.path) as saved:
+                self.keys, self.embeddings = saved['keys'], saved['embeddings']
+        else:
+            self.keys, self.embeddings = np.zeros(0, dtype=np.uint64), None
+        self.added = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def discard_stale(self, cache_dir):
+        '''
+        Delete caches built with an earlier version of this model, or with no recorded
+        fingerprint, and this model's directory if its manifest does not match.
+        '''
+        if not os.path.isdir(cache_dir):
+            return
+        for name in os.listdir(cache_dir):
+            directory = os.path.join(cache_dir, name)
+            if not os.path.isdir(directory):
+                continue
+            manifest = read_manifest(directory) or {}
+            if directory == self.directory:
+                stale = (bool(manifest) or os.path.exists(self.path)) and manifest.get('fingerprint') != self.fingerprint
+            else:
+                stale = manifest.get('model') == self.model_path and manifest.get('fingerprint') != self.fingerprint
+            if stale:
+                print(f"Discarding field embeddings and calibrations of a different version of {self.model_path} in {directory}")
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def positions(self, texts):
+        '''
+        Row of every text in the cached embeddings, -1 if it is not cached.
+        '''
+        keys = text_keys(texts)
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        return np.where(found, positions, -1)
+
+    def missing(self, texts):
+        '''
+        The distinct texts that are not cached yet.
+        '''
+        texts = list(dict.fromkeys(texts))
+        return [text for text, position in zip(texts, self.positions(texts)) if position < 0]
+
+    def add(self, texts, embeddings):
+        '''
+        Add the float32 embeddings of new texts and keep the keys sorted.
+        '''
+        if not len(texts):
+            return
+        keys = np.concatenate([self.keys, text_keys(texts)])
+        stacked = embeddings if self.embeddings is None else np.vstack([self.embeddings, embeddings])
+        keys, first = np.unique(keys, return_index=True)
+        self.keys, self.embeddings = keys, stacked[first].astype(np.float32)
+        self.added += len(texts)
+
+    def lookup(self, texts):
+        '''
+        Cached embeddings of texts, which must all be cached.
+        '''
+        positions = self.positions(texts)
+        if (positions < 0).any():
+            raise KeyError(f"{int((positions < 0).sum())} field values are not in the embedding cache")
+        return self.embeddings[positions]
+
+    def save(self):
+        '''
+        Write the cache if values were added, atomically so an interrupted run keeps the old file.
+        A cache directory that cannot be written only costs the reuse in later runs, so the
+        error is reported and the run goes on.
+        '''
+        if not self.added:
+            return
+        tmp_path = f"{self.path}.tmp.npz"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, FIELD_CACHE_MANIFEST), 'w') as f:
+                json.dump({'model': self.model_path, 'fingerprint': self.fingerprint}, f)
+            np.savez(tmp_path, keys=self.keys, embeddings=self.embeddings)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Warning: could not save field embeddings to {self.directory}: {e}")
+            return
+        self.added = 0
+
+    def calibration_path(self, threshold):
+        return os.path.join(self.directory, f"calibration_{threshold:.6f}.json")
+
+class FieldPairScorer:
+    '''
+    Pair features of an invoice table from per-field embeddings and field comparisons.
+
+    Vendor names and descriptions are compared by the cosine of their embeddings, amounts by
+    1 / (1 + 100 * relative difference), dates by 1 / (1 + days apart / 7), and the coded
+    fields by equality. As in row_to_sentence, two missing values count as equal.
+    '''
+
+    def __init__(self, df):
+        '''
+        Args:
+            df: DataFrame with AMOUNT and INVOICE_DATE converted (see load_invoices)
+        '''
+        self.text_codes, self.texts = {}, {}
+        for column in FIELD_TEXT_COLUMNS:
+            codes, uniques = pd.factorize(df[column].map(field_text))
+            self.text_codes[column], self.texts[column] = codes, list(uniques)
+        self.code_columns = {column: pd.factorize(df[column].map(field_text))[0] for column in FIELD_CODE_COLUMNS}
+        self.amounts = pd.to_numeric(df['AMOUNT'], errors='coerce').to_numpy(dtype=np.float64)
+        dates = pd.to_datetime(df['INVOICE_DATE'], errors='coerce')
+        self.days = np.where(dates.isna(), np.nan, dates.to_numpy(dtype='datetime64[D]').astype(np.float64))
+        self.vectors = {}
+
+    def distinct_texts(self):
+        '''
+        Every distinct text value across the embedded columns.
+        '''
+        return list(dict.fromkeys(text for column in FIELD_TEXT_COLUMNS for text in self.texts[column]))
+
+    def load_vectors(self, cache):
+        '''
+        Take the embeddings of the distinct values from the cache, which must hold all of them.
+        '''
+        for column in FIELD_TEXT_COLUMNS:
+            self.vectors[column] = cache.lookup(self.texts[column])
+
+    def batch_memory(self):
+        '''
+        (bytes per pair, fixed bytes) a batch of features takes; a chunk gathers both vectors
+        of one embedded field at a time for PAIR_CHUNK_SIZE pairs.
+        '''
+        vector_bytes = max((2 * vectors.shape[1] * vectors.itemsize for vectors in self.vectors.values()), default=0)
+        return FIELD_BYTES_PER_PAIR, PAIR_CHUNK_SIZE * vector_bytes
+
+    def features(self, rows1, rows2, chunk_size=PAIR_CHUNK_SIZE):
+        '''
+        Features of pairs of rows, in the order of FIELD_FEATURES.
+
+        Returns:
+            float32 array of shape (len(rows1), len(FIELD_FEATURES))
+        '''
+        features = np.empty((len(rows1), len(FIELD_FEATURES)), dtype=np.float32)
+        for start in range(0, len(rows1), chunk_size):
+            end = start + chunk_size
+            idx1, idx2 = rows1[start:end], rows2[start:end]
+            columns = []
+            for column in FIELD_TEXT_COLUMNS:
+                vectors, codes = self.vectors[column], self.text_codes[column]
+                columns.append(np.einsum('ij,ij->i', vectors[codes[idx1]], vectors[codes[idx2]]))
+            columns.append(closeness(self.amounts[idx1], self.amounts[idx2], relative=True, scale=0.01))
+            columns.append(closeness(self.days[idx1], self.days[idx2], relative=False, scale=7.0))
+            for column in FIELD_CODE_COLUMNS:
+                codes = self.code_columns[column]
+                columns.append(codes[idx1] == codes[idx2])
+            features[start:end] = np.column_stack(columns)
+        return features
+
+def closeness(values1, values2, relative, scale):
+    '''
+    1 / (1 + difference / scale) of two arrays, 1 where both are missing and 0 where one is.
+    '''
+    difference = np.abs(values1 - values2)
+    if relative:
+        largest = np.maximum(np.abs(values1), np.abs(values2))
+        difference = np.divide(difference, largest, out=np.zeros_like(difference), where=largest > 0)
+    result = 1.0 / (1.0 + difference / scale)
+    both_missing = np.isnan(values1) & np.isnan(values2)
+    return np.where(both_missing, 1.0, np.nan_to_num(result, nan=0.0))
+
+class FieldScoreModel:
+    '''
+    Linear pair score on the field features, fitted to the SBERT similarity of full invoice
+    sentences and shifted so that the SBERT threshold separates its decisions the same way.
+    '''
+
+    def __init__(self, coefficients, intercept, threshold, sample_pairs=0, agreement=None):
+        self.coefficients = np.asarray(coefficients, dtype=np.float32)
+        self.intercept = float(intercept)
+        self.threshold = float(threshold)
+        self.sample_pairs = sample_pairs
+        self.agreement = agreement or {}
+
+    def score(self, features):
+        '''
+        Pair scores on the SBERT scale, clipped to [-1, 1].
+        '''
+        return np.clip(features @ self.coefficients + np.float32(self.intercept), -1.0, 1.0).astype(np.float32)
+
+    @classmethod
+    def fit(cls, features, semantic, threshold, weights=None):
+        '''
+        Fit the score on a sample of pairs scored by SBERT.
+
+        The least-squares fit of the SBERT similarity is shifted to the cutoff at which it
+        disagrees with the SBERT threshold decision on the least (weighted) sample pairs, so
+        that scores at or above threshold are the pairs SBERT would flag.
+
+        Args:
+            features: Field features of the sample pairs
+            semantic: SBERT similarities of the same pairs
+            threshold: SBERT similarity threshold
+            weights: Number of pairs each sample pair stands for; 1 if None
+        '''
+        weights = np.ones(len(semantic)) if weights is None else np.asarray(weights, dtype=np.float64)
+        design = np.column_stack([features.astype(np.float64), np.ones(len(features))])
+        solution = np.linalg.lstsq(design, semantic.astype(np.float64), rcond=None)[0]
+        fitted = design @ solution
+        flagged = semantic >= threshold
+        cutoff = threshold
+        if flagged.any():
+            order = np.argsort(fitted, kind='stable')
+            # With the cutoff at the i-th lowest fit, the flagged pairs below it are lost and
+            # the unflagged pairs from it on are added
+            lost = np.concatenate([[0.0], np.cumsum(np.where(flagged[order], weights[order], 0.0))[:-1]])
+            added = (weights[~flagged].sum()
+                     - np.concatenate([[0.0], np.cumsum(np.where(~flagged[order], weights[order], 0.0))[:-1]]))
+            cutoff = float(fitted[order][np.argmin(lost + added)])
+        model = cls(solution[:-1], solution[-1] + threshold - cutoff, threshold, len(semantic))
+        model.agreement = {
+            'flagged_sbert': int(flagged.sum()),
+            'lost': int((flagged & (model.score(features) < threshold)).sum()),
+            'added': int((~flagged & (model.score(features) >= threshold)).sum()),
+        }
+        return model
+
+    def to_dict(self):
+        return {'features': list(FIELD_FEATURES), 'coefficients': self.coefficients.tolist(),
+                'intercept': self.intercept, 'threshold': self.threshold,
+                'sample_pairs': self.sample_pairs, 'agreement': self.agreement}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['coefficients'], data['intercept'], data['threshold'], data.get('sample_pairs', 0),
+                   data.get('agreement'))
+
+    def save(self, path):
+        '''
+        Save the calibration; if path cannot be written it is refitted in the next run.
+        '''
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2)
+        except OSError as e:
+            print(f"Warning: could not save the field score calibration to {path}: {e}")
+
+    @classmethod
+    def load(cls, path, threshold):
+        '''
+        Load a saved calibration, or None if there is none for these features and threshold.
+        '''
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data.get('features') != list(FIELD_FEATURES) or abs(data.get('threshold', -1) - threshold) > 1e-9:
+            return None
+        return cls.from_dict(data)
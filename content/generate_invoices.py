@@ -0,0 +1,200 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+INVOICE_COLUMNS = [
+    'DOC_NO', 'DUP_OF_DOC_ID', 'VENDOR_NAME', 'VENDOR_ID', 'AMOUNT', 'CURRENCY', 'INVOICE_DATE',
+    'DESCRIPTION', 'PURCHASE_ORDER', 'COMPANY_CODE', 'COST_CENTER', 'TAX_CODE', 'PAYMENT_TERMS'
+]
+
+VENDOR_STEMS = [
+    'Acme', 'Nordwind', 'Siebert', 'Helios', 'Bergmann', 'Kronos', 'Alpina', 'Weber', 'Lindner', 'Orion',
+    'Falkner', 'Brandt', 'Vektor', 'Meridian', 'Hansen', 'Zeller', 'Atlas', 'Polaris', 'Krause', 'Sonnen'
+]
+VENDOR_SUFFIXES = ['GmbH', 'AG', 'KG', 'SE', 'Ltd', 'Inc', 'S.A.', 'B.V.', 'GmbH & Co. KG', 'Services']
+VENDOR_TRADES = ['Logistik', 'Consulting', 'Technik', 'Bau', 'Software', 'Elektro', 'Facility', 'Druck', 'Handel', 'Energie']
+DESCRIPTIONS = [
+    'Monthly maintenance fee', 'Consulting services', 'Office supplies', 'Freight charges', 'Software license renewal',
+    'Cleaning services', 'Hardware purchase', 'Travel expenses', 'Marketing campaign', 'Electricity supply',
+    'Catering services', 'Spare parts', 'Legal advisory', 'Training workshop', 'Cloud hosting'
+]
+CURRENCIES = ['EUR', 'USD', 'GBP', 'CHF']
+TAX_CODES = ['V1', 'V2', 'V0', 'I1']
+PAYMENT_TERMS = ['NT30', 'NT45', 'NT60', 'ZB14', 'Z001']
+
+def generate_vendors(num_vendors, rng):
+    '''
+    Generate a vendor master with IDs and names.
+
+    Args:
+        num_vendors: Number of distinct vendors
+        rng: numpy random Generator
+
+    Returns:
+        DataFrame with VENDOR_ID, VENDOR_NAME and CURRENCY columns
+    '''
+    names = []
+    for i in range(num_vendors):
+        stem = VENDOR_STEMS[rng.integers(len(VENDOR_STEMS))]
+        trade = VENDOR_TRADES[rng.integers(len(VENDOR_TRADES))]
+        suffix = VENDOR_SUFFIXES[rng.integers(len(VENDOR_SUFFIXES))]
+        # Most vendors share a stem with others, a counter keeps names distinct
+        names.append(f"{stem} {trade} {suffix} {i}" if rng.random() < 0.3 else f"{stem} {trade} {suffix}")
+
+    return pd.DataFrame({
+        'VENDOR_ID': [f"V{100000 + i}" for i in range(num_vendors)],
+        'VENDOR_NAME': names,
+        'CURRENCY': rng.choice(CURRENCIES, size=num_vendors, p=[0.7, 0.15, 0.1, 0.05]),
+    })
+
+def misspell(name, rng):
+    '''
+    Drop, double or swap one letter of a name, as in a vendor created twice in the vendor master.
+    '''
+    positions = [i for i, char in enumerate(name[:-1]) if char.isalpha() and name[i + 1].isalpha()]
+    if not positions:
+        return name
+    pos = positions[rng.integers(len(positions))]
+    edit = rng.integers(3)
+    if edit == 0:
+        return name[:pos] + name[pos + 1:]
+    if edit == 1:
+        return name[:pos] + name[pos] + name[pos:]
+    return name[:pos] + name[pos + 1] + name[pos] + name[pos + 2:]
+
+def perturb_invoice(invoice, rng, vendor_typo_rate=0.0):
+    '''
+    Create a near-duplicate of an invoice the way re-keyed or re-scanned copies look in SAP.
+
+    Args:
+        invoice: dict with the original invoice fields
+        rng: numpy random Generator
+        vendor_typo_rate: Probability that the copy is booked on a duplicate vendor master
+            record: another VENDOR_ID and a misspelled VENDOR_NAME
+
+    Returns:
+        dict with the perturbed copy (DOC_NO not yet assigned)
+    '''
+    copy = dict(invoice)
+
+    # Copy booked on a duplicate vendor record
+    if vendor_typo_rate and rng.random() < vendor_typo_rate:
+        copy['VENDOR_ID'] = f"V9{rng.integers(10**5):05d}"
+        copy['VENDOR_NAME'] = misspell(copy['VENDOR_NAME'], rng)
+
+    # Whitespace and case changes in the vendor name
+    if rng.random() < 0.4:
+        copy['VENDOR_NAME'] = copy['VENDOR_NAME'].upper() if rng.random() < 0.5 else f" {copy['VENDOR_NAME']}  "
+    # Reformatted amount (same value, different string) or small rounding difference
+    if rng.random() < 0.4:
+        copy['AMOUNT'] = f"{float(copy['AMOUNT']):.1f}" if rng.random() < 0.5 else f"{float(copy['AMOUNT']) + 0.01:.2f}"
+    # Invoice re-dated by a few days
+    if rng.random() < 0.4:
+        shifted = pd.Timestamp(copy['INVOICE_DATE']) + pd.Timedelta(days=int(rng.integers(1, 6)))
+        copy['INVOICE_DATE'] = shifted.strftime('%Y-%m-%d')
+    # Typo or truncation in the description
+    if rng.random() < 0.3:
+        description = copy['DESCRIPTION']
+        pos = int(rng.integers(1, len(description)))
+        copy['DESCRIPTION'] = description[:pos] + description[pos + 1:]
+    # Purchase order missing on the copy
+    if rng.random() < 0.2:
+        copy['PURCHASE_ORDER'] = ''
+
+    return copy
+
+def generate_invoices(num_invoices, num_vendors=None, vendor_skew=1.1, duplicate_rate=0.05,
+                      num_company_codes=4, seed=42, vendor_typo_rate=0.0):
+    '''
+    Generate a synthetic SAP invoice extract with injected near-duplicates.
+
+    Args:
+        num_invoices: Total number of invoices, including injected duplicates
+        num_vendors: Number of distinct vendors (defaults to num_invoices // 20)
+        vendor_skew: Zipf exponent of the vendor distribution (0 = uniform)
+        duplicate_rate: Fraction of invoices that are near-duplicates of another invoice
+        num_company_codes: Number of distinct COMPANY_CODE values
+        seed: Random seed for reproducibility
+        vendor_typo_rate: Share of duplicates booked on a duplicate vendor record with a
+            misspelled name (see perturb_invoice)
+
+    Returns:
+        Tuple of (invoices DataFrame in the predict_pairs.py schema,
+                  DataFrame of injected duplicate pairs with INV1_DOC_NO, INV2_DOC_NO, LABEL)
+    '''
+    rng = np.random.default_rng(seed)
+    num_vendors = num_vendors or max(1, num_invoices // 20)
+    vendors = generate_vendors(num_vendors, rng)
+
+    # Zipf-like vendor popularity: a few vendors issue most invoices
+    weights = 1.0 / np.power(np.arange(1, num_vendors + 1), vendor_skew)
+    weights /= weights.sum()
+
+    num_duplicates = int(num_invoices * duplicate_rate)
+    num_originals = num_invoices - num_duplicates
+
+    vendor_idx = rng.choice(num_vendors, size=num_originals, p=weights)
+    start_date = pd.Timestamp('2024-01-01')
+    day_offsets = rng.integers(0, 365, size=num_originals)
+    amounts = np.round(rng.lognormal(mean=6.5, sigma=1.2, size=num_originals), 2)
+    company_codes = [f"{1000 + 10 * i}" for i in range(num_company_codes)]
+
+    originals = pd.DataFrame({
+        'DOC_NO': [f"51{i:08d}" for i in range(num_originals)],
+        'DUP_OF_DOC_ID': '',
+        'VENDOR_NAME': vendors['VENDOR_NAME'].to_numpy()[vendor_idx],
+        'VENDOR_ID': vendors['VENDOR_ID'].to_numpy()[vendor_idx],
+        'AMOUNT': [f"{amount:.2f}" for amount in amounts],
+        'CURRENCY': vendors['CURRENCY'].to_numpy()[vendor_idx],
+        'INVOICE_DATE': (start_date + pd.to_timedelta(day_offsets, unit='D')).strftime('%Y-%m-%d'),
+        'DESCRIPTION': rng.choice(DESCRIPTIONS, size=num_originals),
+        'PURCHASE_ORDER': np.where(rng.random(num_originals) < 0.7,
+                                   [f"45{po:08d}" for po in rng.integers(0, 10**8, size=num_originals)], ''),
+        'COMPANY_CODE': rng.choice(company_codes, size=num_originals),
+        'COST_CENTER': [f"CC{cc}" for cc in rng.integers(100, 999, size=num_originals)],
+        'TAX_CODE': rng.choice(TAX_CODES, size=num_originals),
+        'PAYMENT_TERMS': rng.choice(PAYMENT_TERMS, size=num_originals),
+    }, columns=INVOICE_COLUMNS)
+    invoices = originals.to_dict('records')
+
+    # Inject near-duplicates of randomly chosen originals
+    labels = []
+    sources = rng.integers(0, num_originals, size=num_duplicates) if num_originals else []
+    for j, source_idx in enumerate(sources):
+        original = invoices[source_idx]
+        duplicate = perturb_invoice(original, rng, vendor_typo_rate)
+        duplicate['DOC_NO'] = f"52{j:08d}"
+        duplicate['DUP_OF_DOC_ID'] = original['DOC_NO']
+        invoices.append(duplicate)
+        labels.append({'INV1_DOC_NO': original['DOC_NO'], 'INV2_DOC_NO': duplicate['DOC_NO'], 'LABEL': 1})
+
+    # Shuffle so duplicates are not clustered at the end of the extract
+    df = pd.DataFrame(invoices, columns=INVOICE_COLUMNS)
+    df = df.sample(frac=1, random_state=seed).reset_index(drop=True)
+    labels_df = pd.DataFrame(labels, columns=['INV1_DOC_NO', 'INV2_DOC_NO', 'LABEL'])
+
+    return df, labels_df
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate a synthetic SAP invoice extract')
+    parser.add_argument('--rows', type=int, default=10000, help='Number of invoices to generate')
+    parser.add_argument('--vendors', type=int, default=None, help='Number of distinct vendors (default: rows / 20)')
+    parser.add_argument('--vendor-skew', type=float, default=1.1, help='Zipf exponent of vendor popularity (0 = uniform)')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05, help='Fraction of rows that are injected near-duplicates')
+    parser.add_argument('--company-codes', type=int, default=4, help='Number of distinct company codes')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    parser.add_argument('--vendor-typo-rate', type=float, default=0.0,
+                        help='Share of duplicates booked on a duplicate vendor record with a misspelled name')
+    parser.add_argument('--output', type=str, required=True, help='Path to the semicolon-separated invoice CSV')
+    parser.add_argument('--labels', type=str, default=None, help='Path to save the injected duplicate pairs')
+
+    args = parser.parse_args()
+
+    df, labels_df = generate_invoices(args.rows, args.vendors, args.vendor_skew, args.duplicate_rate,
+                                      args.company_codes, args.seed, args.vendor_typo_rate)
+    df.to_csv(args.output, sep=';', index=False)
+    print(f"Saved {len(df)} invoices ({len(labels_df)} injected duplicates) to {args.output}")
+
+    if args.labels:
+        labels_df.to_csv(args.labels, index=False)
+        print(f"Saved duplicate labels to {args.labels}")
@@ -0,0 +1,300 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from predict_pairs import (FINGERPRINT_FIELD_SETS, row_to_sentence, load_invoices, load_model, encode_sentences,
+                           drop_exact_duplicates, doc_nos_hash, normalize_field, build_pair_frame)
+from embedding_store import EmbeddingStore, EMBEDDING_FORMATS
+from vendor_blocking import VendorNameLSH, VendorNameIndex, VENDOR_BLOCKING_METHODS
+
+# Blocking rules of generate_candidate_pairs, in the same order
+BLOCKING_RULES = ['VENDOR_ID', 'VENDOR_NAME_PREFIX', 'PURCHASE_ORDER', 'DESCRIPTION', 'AMOUNT_CURRENCY']
+# Replaces VENDOR_NAME_PREFIX with MinHash vendor blocking; matched through a VendorNameIndex, not by key
+SIMILAR_VENDOR_NAME = 'SIMILAR_VENDOR_NAME'
+NEAREST_NEIGHBOUR = 'NEAREST_NEIGHBOUR'
+
+def blocking_rules(vendor_blocking):
+    '''
+    The blocking rules for a vendor blocking method (see generate_candidate_pairs).
+    '''
+    if vendor_blocking == 'prefix':
+        return BLOCKING_RULES
+    return [SIMILAR_VENDOR_NAME if rule == 'VENDOR_NAME_PREFIX' else rule for rule in BLOCKING_RULES]
+
+def blocking_keys(df):
+    '''
+    Blocking key of every row under each rule of generate_candidate_pairs.
+
+    Two invoices are a candidate pair in the batch pipeline exactly when they share a key
+    under at least one rule (with 'prefix' vendor blocking; SIMILAR_VENDOR_NAME has no key).
+
+    Returns:
+        DataFrame with one column per rule in BLOCKING_RULES; NaN where a rule does not apply
+    '''
+    def present(column):
+        return df[column].notna() & (df[column].astype(str) != '')
+
+    amounts = pd.to_numeric(df['AMOUNT'], errors='coerce').astype(float)
+    # float.hex is exact, so keys match exactly when the parsed amounts are equal, as in the groupby
+    amount_keys = amounts.map(float.hex, na_action='ignore') + '|' + df['CURRENCY'].astype(str)
+    return pd.DataFrame({
+        'VENDOR_ID': df['VENDOR_ID'].astype(str).where(present('VENDOR_ID')),
+        'VENDOR_NAME_PREFIX': df['VENDOR_NAME'].astype(str).str[:4].where(present('VENDOR_NAME')),
+        'PURCHASE_ORDER': df['PURCHASE_ORDER'].astype(str).where(present('PURCHASE_ORDER')),
+        'DESCRIPTION': df['DESCRIPTION'].astype(str).where(present('DESCRIPTION')),
+        'AMOUNT_CURRENCY': amount_keys.where(amounts.notna() & df['CURRENCY'].notna()),
+    }, columns=BLOCKING_RULES)
+
+def hash_keys(rule, keys):
+    '''
+    64-bit hashes of 'RULE|key' strings; fixed-size, so long descriptions do not bloat the index.
+    '''
+    return pd.util.hash_array((rule + '|' + pd.Series(keys, dtype=object).astype(str)).to_numpy(dtype=object))
+
+def build_blocking_index(df, vendor_blocking='minhash'):
+    '''
+    Invert the blocking keys into a CSR layout: sorted key hashes, offsets and row indices.
+    '''
+    keys = blocking_keys(df)
+    entries = []
+    for rule in blocking_rules(vendor_blocking):
+        if rule == SIMILAR_VENDOR_NAME:
+            continue
+        column = keys[rule].dropna()
+        entries.append(pd.DataFrame({'key': hash_keys(rule, column.to_numpy()), 'row': column.index.to_numpy()}))
+    entries = pd.concat(entries, ignore_index=True).sort_values(['key', 'row'], kind='stable')
+    unique_keys, starts = np.unique(entries['key'].to_numpy(), return_index=True)
+    offsets = np.append(starts, len(entries)).astype(np.int64)
+    return unique_keys, offsets, entries['row'].to_numpy(dtype=np.int32)
+
+def fingerprint_keys(df, field_sets):
+    '''
+    Every row's normalized fingerprint per field set (see fingerprint_pairs), with each column
+    normalized once.
+
+    Returns:
+        List with one object array per field set: the joined normalized values, or None for
+        rows with a missing field
+    '''
+    columns = {column for fields in field_sets for column in fields}
+    normalized = {column: normalize_field(df[column], column).astype(object) for column in columns}
+    keys = []
+    for fields in field_sets:
+        joined = normalized[fields[0]].astype('string').str.cat([normalized[column].astype('string') for column in fields[1:]],
+                                                                sep='\x1f')
+        keys.append(joined.astype(object).where(joined.notna(), None).to_numpy())
+    return keys
+
+def build_index(input_path, index_dir, model_path, threshold_path, chunk_size=10000,
+                fingerprint_field_sets=FINGERPRINT_FIELD_SETS, embedding_format='float32', pca_dims=None,
+                vendor_blocking='minhash'):
+    '''
+    Encode every invoice of an extract and persist the embeddings and blocking keys for lookups.
+
+    Args:
+        input_path: Semicolon-separated invoice CSV
+        index_dir: Directory to write the index to
+        model_path: Path to the SBERT model
+        threshold_path: Path to the similarity threshold file
+        chunk_size: Number of sentences passed to the model per call
+        fingerprint_field_sets: Field sets used to flag exact duplicates at lookup time
+        embedding_format: Format the embeddings are stored in (see embedding_store.py)
+        pca_dims: Optional number of PCA dimensions to reduce the embeddings to
+        vendor_blocking: Vendor name blocking method of the batch pipeline to mirror
+
+    Returns:
+        The index manifest
+    '''
+    os.makedirs(index_dir, exist_ok=True)
+    with open(threshold_path, 'r') as f:
+        threshold = float(f.read().strip())
+
+    df, removed = drop_exact_duplicates(load_invoices(input_path))
+    if removed:
+        print(f"Removed {removed} exact duplicate rows")
+    print(f"Indexing {len(df)} invoices")
+
+    start = time.perf_counter()
+    model, device = load_model(model_path)
+    embeddings = encode_sentences(model, device, [row_to_sentence(row) for _, row in df.iterrows()],
+                                  chunk_size=chunk_size)
+    print(f"Encoded {len(df)} invoices in {time.perf_counter() - start:.2f}s")
+    store = EmbeddingStore.from_float32(embeddings, embedding_format, pca_dims)
+    print(f"Storing embeddings as {store.describe()}")
+
+    keys, offsets, rows = build_blocking_index(df, vendor_blocking)
+    store.save(index_dir)
+    tmp_path = os.path.join(index_dir, 'blocking.tmp.npz')
+    np.savez(tmp_path, keys=keys, offsets=offsets, rows=rows)
+    os.replace(tmp_path, os.path.join(index_dir, 'blocking.npz'))
+    df.to_csv(os.path.join(index_dir, 'invoices.csv'), sep=';', index=False, date_format='%Y-%m-%d')
+
+    manifest = {'rows': len(df), 'doc_nos_hash': doc_nos_hash(df), 'model': os.path.abspath(model_path),
+                'threshold': threshold, 'dimensions': int(embeddings.shape[1]) if len(embeddings) else 0,
+                'embedding_format': store.embedding_format, 'pca_dims': pca_dims,
+                'fingerprint_field_sets': [list(fields) for fields in fingerprint_field_sets],
+                'vendor_blocking': vendor_blocking,
+                'vendor_lsh': VendorNameLSH().params if vendor_blocking == 'minhash' else None,
+                'source': os.path.abspath(input_path), 'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(os.path.join(index_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Saved index with {len(keys)} blocking keys to {index_dir}")
+    return manifest
+
+def invoice_frame(records, columns):
+    '''
+    Turn invoice records (dicts keyed by the CSV column names) into a DataFrame parsed like load_invoices.
+    '''
+    # Values are read as strings, like the CSV columns, so e.g. numeric vendor IDs match
+    df = pd.DataFrame([{column: None if record.get(column) in (None, '') else str(record[column]) for column in columns}
+                       for record in records], columns=columns)
+    df['AMOUNT'] = pd.to_numeric(df['AMOUNT'], errors='coerce')
+    df['INVOICE_DATE'] = pd.to_datetime(df['INVOICE_DATE'], errors='coerce', format='mixed')
+    return df
+
+class InvoiceIndex:
+    '''
+    Embeddings and blocking keys of an invoice extract, loaded for single-invoice lookups.
+
+    Embeddings are memory-mapped, so opening an index is fast, and can be stored as float16
+    or int8 to fit more invoices in memory.
+    '''
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+        self.df = load_invoices(os.path.join(index_dir, 'invoices.csv'))
+        if len(self.df) != self.manifest['rows'] or doc_nos_hash(self.df) != self.manifest['doc_nos_hash']:
+            raise ValueError(f"Invoices in {index_dir} do not match the index manifest; rebuild the index")
+        self.embeddings = EmbeddingStore.load(index_dir)
+        with np.load(os.path.join(index_dir, 'blocking.npz')) as data:
+            self.keys, self.offsets, self.rows = data['keys'], data['offsets'], data['rows']
+        self.doc_nos = self.df['DOC_NO'].astype(str).to_numpy()
+        self.threshold = self.manifest['threshold']
+        self.fingerprint_field_sets = self.manifest['fingerprint_field_sets']
+        self.fingerprints = fingerprint_keys(self.df, self.fingerprint_field_sets)
+        # Indexes built before MinHash vendor blocking used the name prefix
+        self.vendor_blocking = self.manifest.get('vendor_blocking', 'prefix')
+        self.vendor_names = None
+        if self.vendor_blocking == 'minhash':
+            self.vendor_names = VendorNameIndex(self.df['VENDOR_NAME'].to_numpy(), VendorNameLSH(**self.manifest['vendor_lsh']))
+
+    def blocked_rows(self, query_df):
+        '''
+        Rows sharing a blocking key with the query invoice, as a dict of rule to row indices.
+        '''
+        blocked = {}
+        keys = blocking_keys(query_df).iloc[0]
+        for rule in blocking_rules(self.vendor_blocking):
+            if rule == SIMILAR_VENDOR_NAME:
+                rows = self.vendor_names.rows_like(query_df['VENDOR_NAME'].iloc[0])
+                if len(rows):
+                    blocked[rule] = rows
+                continue
+            if pd.isna(keys[rule]):
+                continue
+            key = hash_keys(rule, [keys[rule]])[0]
+            position = np.searchsorted(self.keys, key)
+            if position < len(self.keys) and self.keys[position] == key:
+                blocked[rule] = self.rows[self.offsets[position]:self.offsets[position + 1]]
+        return blocked
+
+    def exact_match_rules(self, query_df, candidates):
+        '''
+        First fingerprint field set each candidate shares with the query invoice (None if none),
+        matching what fingerprint_pairs reports for the pair.
+        '''
+        rules = np.full(len(candidates), None, dtype=object)
+        query_keys = fingerprint_keys(query_df, self.fingerprint_field_sets)
+        for fields, keys, query_key in zip(self.fingerprint_field_sets, self.fingerprints, query_keys):
+            if query_key[0] is None:
+                continue
+            matched = (keys[candidates] == query_key[0]) & (rules == None)
+            rules[matched] = '+'.join(fields)
+        return rules
+
+    def lookup(self, query_df, model, device, threshold=None, neighbours=10):
+        '''
+        Find indexed invoices that are likely duplicates of one invoice.
+
+        Candidates are the invoices the batch pipeline's blocking rules would pair with the
+        invoice, plus its nearest neighbours by embedding; invoices with the same DOC_NO are
+        skipped. Candidates at or above the threshold are returned, and candidates matching an
+        exact-duplicate fingerprint are returned with similarity 1.0.
+
+        Args:
+            query_df: One-row DataFrame built with invoice_frame (DOC_NO may be missing for unposted invoices)
+            model: Loaded SBERT model
+            device: Device the model runs on
+            threshold: Similarity threshold (the one the index was built with if None)
+            neighbours: Number of nearest neighbours added to the blocking candidates (0 to disable)
+
+        Returns:
+            Tuple of (DataFrame in the scored pairs layout with INV1_ = the invoice, INV2_ = the
+            match, similarity, match_type, match_rule and candidate_source, sorted by similarity;
+            dict with the milliseconds spent per step and the number of candidates)
+        '''
+        timings = {}
+        start = time.perf_counter()
+        threshold = self.threshold if threshold is None else threshold
+
+        step_start = time.perf_counter()
+        query_embedding = model.encode([row_to_sentence(query_df.iloc[0])], convert_to_numpy=True,
+                                       normalize_embeddings=True, device=device,
+                                       show_progress_bar=False).astype(np.float32)[0]
+        timings['embedding_ms'] = (time.perf_counter() - step_start) * 1000
+
+        step_start = time.perf_counter()
+        sources = self.blocked_rows(query_df)
+        # Embeddings are normalized, so one matrix-vector product scores the invoice against every indexed one
+        similarities = self.embeddings.similarities_to(query_embedding)
+        if neighbours and len(similarities):
+            sources[NEAREST_NEIGHBOUR] = np.argpartition(-similarities, min(neighbours, len(similarities) - 1))[:neighbours]
+        candidates = np.unique(np.concatenate([rows.astype(np.int64) for rows in sources.values()])) if sources \
+            else np.zeros(0, dtype=np.int64)
+        query_doc_no = query_df['DOC_NO'].iloc[0]
+        if query_doc_no is not None:
+            candidates = candidates[self.doc_nos[candidates] != str(query_doc_no)]
+        timings['retrieval_ms'] = (time.perf_counter() - step_start) * 1000
+
+        step_start = time.perf_counter()
+        exact_rules = self.exact_match_rules(query_df, candidates)
+        is_exact = exact_rules != None
+        candidate_similarities = np.where(is_exact, 1.0, similarities[candidates]).astype(np.float32)
+        keep = (candidate_similarities >= threshold) | is_exact
+        kept = candidates[keep]
+
+        # Row 0 is the record, rows 1.. are the matches
+        combined_df = pd.concat([query_df, self.df.iloc[kept]], ignore_index=True)
+        pairs = np.column_stack([np.zeros(len(kept), dtype=np.int64), np.arange(1, len(kept) + 1)])
+        matches_df = build_pair_frame(combined_df, pairs, candidate_similarities[keep])
+        if matches_df.empty:
+            matches_df = pd.DataFrame(columns=[f'INV1_{col}' for col in self.df.columns] +
+                                              [f'INV2_{col}' for col in self.df.columns] + ['similarity'])
+        matches_df['match_type'] = np.where(is_exact[keep], 'exact', 'sbert')
+        matches_df['match_rule'] = exact_rules[keep]
+        matches_df['candidate_source'] = ['+'.join(rule for rule, rows in sources.items() if row in rows) for row in kept]
+        matches_df = matches_df.sort_values('similarity', ascending=False, kind='stable').reset_index(drop=True)
+        timings['scoring_ms'] = (time.perf_counter() - step_start) * 1000
+        timings['candidates'] = len(candidates)
+        timings['total_ms'] = (time.perf_counter() - start) * 1000
+        return matches_df, timings
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the invoice index used for single-invoice duplicate lookups')
+    parser.add_argument('--input', type=str, required=True, help='Path to input CSV file')
+    parser.add_argument('--index-dir', type=str, required=True, help='Directory to write the index to')
+    parser.add_argument('--model', type=str, default='invoice_sbert', help='Path to model directory')
+    parser.add_argument('--threshold', type=str, default='best_threshold.txt', help='Path to threshold file')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='Sentences encoded per model call')
+    parser.add_argument('--embedding-format', type=str, choices=EMBEDDING_FORMATS, default='float32', help='Format the embeddings are stored in')
+    parser.add_argument('--pca-dims', type=int, default=None, help='Reduce embeddings to this many PCA dimensions')
+    parser.add_argument('--vendor-blocking', type=str, choices=VENDOR_BLOCKING_METHODS, default='minhash',
+                        help='Vendor name blocking of the batch pipeline to mirror (see predict_pairs.py)')
+
+    args = parser.parse_args()
+    build_index(args.input, args.index_dir, args.model, args.threshold, args.chunk_size,
+                embedding_format=args.embedding_format, pca_dims=args.pca_dims, vendor_blocking=args.vendor_blocking)
@@ -0,0 +1,129 @@
+import numpy as np
+
+# Character n-grams within words, so re-keyed values with typos still share most n-grams
+LEXICAL_NGRAM_RANGE = (3, 5)
+PAIR_CHUNK_SIZE = 65536
+CALIBRATION_SAMPLE_SIZE = 5000
+
+class LexicalScorer:
+    '''
+    TF-IDF character n-gram vectors of invoice sentences, with cosine similarities of pairs
+    computed as row-wise products of the sparse vectors.
+    '''
+
+    def __init__(self, sentences, ngram_range=LEXICAL_NGRAM_RANGE):
+        '''
+        Args:
+            sentences: One row_to_sentence string per invoice, in the row order pairs refer to
+            ngram_range: Range of character n-gram lengths
+        '''
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        vectorizer = TfidfVectorizer(analyzer='char_wb', ngram_range=ngram_range, sublinear_tf=True,
+                                     lowercase=True, dtype=np.float32)
+        # Rows are L2-normalized, so the dot product of two rows is their cosine
+        self.vectors = vectorizer.fit_transform(sentences).tocsr()
+
+    def pair_similarities(self, rows1, rows2, chunk_size=PAIR_CHUNK_SIZE):
+        '''
+        Cosine similarities of pairs of rows.
+
+        Returns:
+            float32 array of similarities
+        '''
+        similarities = np.empty(len(rows1), dtype=np.float32)
+        for start in range(0, len(rows1), chunk_size):
+            end = start + chunk_size
+            products = self.vectors[rows1[start:end]].multiply(self.vectors[rows2[start:end]])
+            similarities[start:end] = np.asarray(products.sum(axis=1)).ravel()
+        return similarities
+
+def parse_lexical_band(value):
+    '''
+    Parse a --lexical-band argument: "LOW:HIGH" or "auto"; None or empty disables the cascade.
+    '''
+    if not value or value == 'auto':
+        return value or None
+    low, high = (float(edge) for edge in value.split(':'))
+    if not 0.0 <= low <= high <= 1.0:
+        raise ValueError(f"Lexical band must satisfy 0 <= LOW <= HIGH <= 1, got {value}")
+    return low, high
+
+def split_by_band(similarities, band):
+    '''
+    Decide pairs by their lexical similarity.
+
+    Args:
+        similarities: Lexical similarities of the candidate pairs
+        band: (low, high) uncertainty band
+
+    Returns:
+        Tuple of boolean masks (rejected: below low, accepted: at or above high, uncertain: in between)
+    '''
+    low, high = band
+    rejected = similarities < low
+    accepted = similarities >= high
+    return rejected, accepted, ~(rejected | accepted)
+
+def calibrate_band(lexical, semantic, threshold, tolerance=0.01, weights=None):
+    '''
+    Choose the narrowest uncertainty band for which the lexical decisions agree with the
+    SBERT threshold decisions on all but a tolerated share, estimated on a sample of pairs.
+
+    At most tolerance * (number of SBERT-flagged pairs) decisions may change, half of them
+    flagged pairs rejected below the band, half unflagged pairs accepted above it.
+
+    Args:
+        lexical: Lexical similarities of the sample pairs
+        semantic: SBERT similarities of the same pairs
+        threshold: SBERT similarity threshold
+        tolerance: Tolerated share of changed decisions, relative to the flagged pairs
+        weights: Number of pairs each sample pair stands for (see sample_pairs); 1 if None
+
+    Returns:
+        (low, high) band, or None if the sample has no flagged pairs to calibrate on
+    '''
+    weights = np.ones(len(lexical)) if weights is None else np.asarray(weights, dtype=np.float64)
+    flagged = semantic >= threshold
+    if not flagged.any():
+        return None
+    lost_budget = added_budget = tolerance * weights[flagged].sum() / 2
+
+    # Rejecting below low loses the flagged pairs with lower lexical scores
+    order = np.argsort(lexical[flagged], kind='stable')
+    flagged_scores, lost = lexical[flagged][order], np.cumsum(weights[flagged][order])
+    low = float(flagged_scores[min(np.searchsorted(lost, lost_budget, side='right'), len(order) - 1)])
+    # Accepting from high on adds the unflagged pairs with higher lexical scores
+    order = np.argsort(-lexical[~flagged], kind='stable')
+    unflagged_scores, added = lexical[~flagged][order], np.cumsum(weights[~flagged][order])
+    accepted = np.searchsorted(added, added_budget, side='right')
+    if accepted < len(order):
+        high = float(np.nextafter(unflagged_scores[accepted], np.float32(np.inf)))
+    else:
+        high = float(unflagged_scores[-1]) if len(order) else low
+    return low, max(low, high)
+
+def sample_pairs(lexical, sample_size=CALIBRATION_SAMPLE_SIZE, bins=20, seed=42):
+    '''
+    Sample pairs for calibration, stratified by lexical similarity.
+
+    Duplicates are a small share of the candidate pairs and sit at high lexical scores, so a
+    uniform sample would hold few of them. Each of the equal-width score bins gets an equal
+    share of the sample instead; sparse bins are sampled completely.
+
+    Returns:
+        Tuple of (sorted positions of the sampled pairs, number of pairs each one stands for)
+    '''
+    rng = np.random.default_rng(seed)
+    bin_of_pair = np.minimum((np.clip(lexical, 0.0, 1.0) * bins).astype(np.int64), bins - 1)
+    per_bin = max(1, sample_size // bins)
+    positions, weights = [], []
+    for pair_bin in range(bins):
+        members = np.flatnonzero(bin_of_pair == pair_bin)
+        if len(members) == 0:
+            continue
+        chosen = members if len(members) <= per_bin else rng.choice(members, per_bin, replace=False)
+        positions.append(chosen)
+        weights.append(np.full(len(chosen), len(members) / len(chosen)))
+    positions, weights = np.concatenate(positions), np.concatenate(weights)
+    order = np.argsort(positions)
+    return positions[order], weights[order]
@@ -1,11 +1,80 @@
 import os
 import pandas as pd
 import numpy as np
-from sentence_transformers import SentenceTransformer
-import torch
 import argparse
-from tqdm import tqdm
-import gc
+import json
+import time
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from embedding_store import EmbeddingStore, EMBEDDING_FORMATS, PAIR_CHUNK_SIZE, threshold_agreement
+from vendor_blocking import VendorNameLSH, VENDOR_BLOCKING_METHODS, vendor_name_pairs
+from lexical_cascade import LexicalScorer, parse_lexical_band, split_by_band, calibrate_band, sample_pairs
+from field_scoring import FieldEmbeddingCache, FieldPairScorer, FieldScoreModel, FIELD_CALIBRATION_SAMPLE_SIZE
+from batch_sizing import AdaptiveBatchSizer, MIN_BATCH_SIZE, parse_memory_size
+
+SCORING_MODES = ('sentence', 'fields')
+# How a pair was flagged, in the order of the codes saved with candidate scores
+MATCH_TYPES = ('sbert', 'exact', 'lexical', 'fields')
+# Memory per pair in a scoring batch: index gathers, DOC_NO comparison, similarities and masks
+SCORING_BYTES_PER_PAIR = 64
+
+# Field sets whose normalized values identify an exact duplicate without SBERT or the LLM
+FINGERPRINT_FIELD_SETS = [
+    ['VENDOR_ID', 'AMOUNT', 'CURRENCY', 'INVOICE_DATE', 'DESCRIPTION'],
+    ['VENDOR_NAME', 'AMOUNT', 'CURRENCY', 'INVOICE_DATE', 'DESCRIPTION'],
+    ['VENDOR_ID', 'PURCHASE_ORDER', 'AMOUNT', 'CURRENCY', 'INVOICE_DATE'],
+]
+
+class ProgressReporter:
+    '''
+    Emit throttled PROGRESS:SBERT_STAGE events with rate and ETA for one pipeline stage.
+
+    Each event is printed as a single line so the backend can stream it to the UI
+    while the script is still running.
+    '''
+
+    def __init__(self, stage, total=None, interval=1.0, enabled=True):
+        self.stage = stage
+        self.total = total
+        self.interval = interval
+        self.enabled = enabled
+        self.start_time = time.perf_counter()
+        self.last_emit = None
+
+    def update(self, done, force=False, **extra):
+        '''
+        Report the number of completed items, at most once per interval unless forced.
+
+        Args:
+            done: Number of items completed so far
+            force: Emit even if the interval has not elapsed
+            **extra: Additional fields to include in the event
+        '''
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if not force and self.last_emit is not None and now - self.last_emit < self.interval:
+            return
+        self.last_emit = now
+
+        elapsed = now - self.start_time
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total and rate > 0:
+            eta = round(max(self.total - done, 0) / rate, 1)
+
+        event = {'stage': self.stage, 'done': int(done), 'total': self.total,
+                 'rate': round(rate, 1), 'eta': eta, 'elapsed': round(elapsed, 1)}
+        event.update(extra)
+        print(f"PROGRESS:SBERT_STAGE:{json.dumps(event)}", flush=True)
+
+    def finish(self, done=None, **extra):
+        '''
+        Emit the final event for this stage.
+        '''
+        self.update(self.total if done is None else done, force=True, **extra)
 
 def row_to_sentence(row):
     '''
@@ -50,66 +119,21 @@ def row_to_sentence(row):
 
     return template
 
-def predict_duplicates(df, model_path, threshold_path, output_path='duplicates.csv', batch_size=250000, output_csv_path=None):
+def generate_candidate_pairs(df, progress_interval=1.0, report_progress=True, vendor_blocking='minhash'):
     '''
-    Predict duplicates in a dataframe using the trained model.
+    Generate candidate pairs using the same blocking strategy as in training.
 
     Args:
-        df: DataFrame containing invoice data
-        model_path: Path to the saved model
-        threshold_path: Path to the saved threshold
-        output_path: Path to save the duplicates CSV
-        batch_size: Number of pairs to process in each batch
-        output_csv_path: Path to save the output CSV of scored pairs
-    '''
-    # Load model and threshold
-    print(f"Loading model from {model_path}")
-    model = SentenceTransformer(model_path)
-
-    # Use GPU if available
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model = model.to(device)
-
-    with open(threshold_path, 'r') as f:
-        threshold = float(f.read().strip())
-
-    print(f"Using similarity threshold: {threshold}")
-
-    # Create sentences for all invoices
-    print(f"Processing {len(df)} invoices")
-
-    # Create a map of DOC_NO to index for faster lookups
-    doc_no_to_idx = {doc_no: idx for idx, doc_no in enumerate(df['DOC_NO'])}
-    
-    # Create a set to track unique document numbers to prevent self-matching
-    unique_doc_numbers = set(df['DOC_NO'])
-    print(f"Number of unique document numbers: {len(unique_doc_numbers)}")
-
-    # Filter out exact duplicates (where all column values are identical)
-    print("Filtering out exact duplicates from the dataset...")
-    original_count = len(df)
-    df = df.drop_duplicates(keep='first')
-    exact_duplicate_count = original_count - len(df)
-    
-    if exact_duplicate_count > 0:
-        print(f"Removed {exact_duplicate_count} exact duplicate rows (all columns have identical values)")
-        print(f"Dataset size reduced from {original_count} to {len(df)} rows")
-        
-        # Reset the index to ensure continuous indices after removing duplicates
-        df = df.reset_index(drop=True)
-        
-        # Update the DOC_NO to index mapping with the new indices
-        doc_no_to_idx = {doc_no: idx for idx, doc_no in enumerate(df['DOC_NO'])}
-    else:
-        print("No exact duplicates found in the dataset")
+        df: DataFrame containing invoice data with a continuous index
+        progress_interval: Minimum seconds between progress events
+        report_progress: Emit PROGRESS:SBERT_STAGE events (disabled inside partition workers)
+        vendor_blocking: 'minhash' pairs invoices of equal or similar vendor names (see
+            vendor_blocking.py); 'prefix' pairs invoices whose vendor names share the first 4
+            characters, as in training
 
-    # Create sentence cache with the updated indices
-    sentence_cache = {}
-    for idx, row in df.iterrows():
-        sentence = row_to_sentence(row)
-        sentence_cache[idx] = sentence
-
-    # Generate candidate pairs using the same blocking strategy as in training
+    Returns:
+        Sorted list of (idx1, idx2) tuples with idx1 < idx2
+    '''
     print("Generating candidate pairs with blocking strategy...")
 
     N = len(df)
@@ -118,11 +142,14 @@ def predict_duplicates(df, model_path, threshold_path, output_path='duplicates.c
 
     # Set for candidate pairs to avoid duplicates
     candidate_pairs = set()
+    progress = ProgressReporter('blocking', interval=progress_interval, enabled=report_progress)
+    num_rules = 5
 
     # 1. BLOCKING BY VENDOR_ID
     print("Blocking by VENDOR_ID...")
     vendor_groups = df.groupby('VENDOR_ID').indices
     for vendor_id, indices in vendor_groups.items():
+        progress.update(len(candidate_pairs), rule=1, rules=num_rules)
         if len(indices) < 2:
             continue
 
@@ -137,38 +164,50 @@ def predict_duplicates(df, model_path, threshold_path, output_path='duplicates.c
                 candidate_pairs.add((min(idx1, idx2), max(idx1, idx2)))
 
     print(f"After VENDOR_ID blocking: {len(candidate_pairs)} candidate pairs")
-
-    # 2. BLOCKING BY VENDOR_NAME PREFIX (first 4 chars)
-    print("Blocking by VENDOR_NAME prefix...")
-    vendor_name_prefix_groups = {}
-    for idx, vendor_name in enumerate(df['VENDOR_NAME']):
-        if pd.isna(vendor_name) or vendor_name == '':
-            continue
-
-        prefix = str(vendor_name)[:4] if len(str(vendor_name)) >= 4 else str(vendor_name)
-        if prefix not in vendor_name_prefix_groups:
-            vendor_name_prefix_groups[prefix] = []
-        vendor_name_prefix_groups[prefix].append(idx)
-
-    for prefix, indices in vendor_name_prefix_groups.items():
-        if len(indices) < 2:
-            continue
-
-        for i, idx1 in enumerate(indices):
-            doc1_no = df.iloc[idx1]['DOC_NO']
-            for idx2 in indices[i+1:]:
-                doc2_no = df.iloc[idx2]['DOC_NO']
-                # Skip if document numbers are the same (self-matching)
-                if doc1_no == doc2_no:
-                    continue
-                candidate_pairs.add((min(idx1, idx2), max(idx1, idx2)))
-
-    print(f"After VENDOR_NAME prefix blocking: {len(candidate_pairs)} candidate pairs")
+    progress.update(len(candidate_pairs), force=True, rule=1, rules=num_rules)
+
+    # 2. BLOCKING BY VENDOR_NAME
+    if vendor_blocking == 'minhash':
+        print("Blocking by similar VENDOR_NAME (MinHash-LSH over trigrams)...")
+        vendor_pairs, similar_names = vendor_name_pairs(df, VendorNameLSH())
+        candidate_pairs.update(zip(vendor_pairs[:, 0].tolist(), vendor_pairs[:, 1].tolist()))
+        print(f"Matched {similar_names} pairs of similar vendor names")
+        print(f"After VENDOR_NAME blocking: {len(candidate_pairs)} candidate pairs")
+    else:
+        # Vendor name prefix (first 4 chars)
+        print("Blocking by VENDOR_NAME prefix...")
+        vendor_name_prefix_groups = {}
+        for idx, vendor_name in enumerate(df['VENDOR_NAME']):
+            if pd.isna(vendor_name) or vendor_name == '':
+                continue
+
+            prefix = str(vendor_name)[:4] if len(str(vendor_name)) >= 4 else str(vendor_name)
+            if prefix not in vendor_name_prefix_groups:
+                vendor_name_prefix_groups[prefix] = []
+            vendor_name_prefix_groups[prefix].append(idx)
+
+        for prefix, indices in vendor_name_prefix_groups.items():
+            progress.update(len(candidate_pairs), rule=2, rules=num_rules)
+            if len(indices) < 2:
+                continue
+
+            for i, idx1 in enumerate(indices):
+                doc1_no = df.iloc[idx1]['DOC_NO']
+                for idx2 in indices[i+1:]:
+                    doc2_no = df.iloc[idx2]['DOC_NO']
+                    # Skip if document numbers are the same (self-matching)
+                    if doc1_no == doc2_no:
+                        continue
+                    candidate_pairs.add((min(idx1, idx2), max(idx1, idx2)))
+
+        print(f"After VENDOR_NAME prefix blocking: {len(candidate_pairs)} candidate pairs")
+    progress.update(len(candidate_pairs), force=True, rule=2, rules=num_rules)
 
     # 3. BLOCKING BY PURCHASE_ORDER
     print("Blocking by PURCHASE_ORDER...")
     po_groups = df.groupby('PURCHASE_ORDER').indices
     for po, indices in po_groups.items():
+        progress.update(len(candidate_pairs), rule=3, rules=num_rules)
         if pd.isna(po) or po == '' or len(indices) < 2:
             continue
 
@@ -182,11 +221,13 @@ def predict_duplicates(df, model_path, threshold_path, output_path='duplicates.c
                 candidate_pairs.add((min(idx1, idx2), max(idx1, idx2)))
 
     print(f"After PURCHASE_ORDER blocking: {len(candidate_pairs)} candidate pairs")
+    progress.update(len(candidate_pairs), force=True, rule=3, rules=num_rules)
 
     # 4. BLOCKING BY DESCRIPTION
     print("Blocking by DESCRIPTION...")
     desc_groups = df.groupby('DESCRIPTION').indices
     for desc, indices in desc_groups.items():
+        progress.update(len(candidate_pairs), rule=4, rules=num_rules)
         if pd.isna(desc) or desc == '' or len(indices) < 2:
             continue
 
@@ -200,11 +241,13 @@ def predict_duplicates(df, model_path, threshold_path, output_path='duplicates.c
                 candidate_pairs.add((min(idx1, idx2), max(idx1, idx2)))
 
     print(f"After DESCRIPTION blocking: {len(candidate_pairs)} candidate pairs")
+    progress.update(len(candidate_pairs), force=True, rule=4, rules=num_rules)
 
     # 5. BLOCKING BY AMOUNT AND CURRENCY
     print("Blocking by AMOUNT and CURRENCY...")
     amount_currency_groups = df.groupby(['AMOUNT', 'CURRENCY']).indices
     for (amount, currency), indices in amount_currency_groups.items():
+        progress.update(len(candidate_pairs), rule=5, rules=num_rules)
         if pd.isna(amount) or pd.isna(currency) or len(indices) < 2:
             continue
 
@@ -217,146 +260,1014 @@ def predict_duplicates(df, model_path, threshold_path, output_path='duplicates.c
                     continue
                 candidate_pairs.add((min(idx1, idx2), max(idx1, idx2)))
 
-    # Convert set to list for easier processing
-    candidate_pairs = list(candidate_pairs)
+    progress.finish(len(candidate_pairs), rule=num_rules, rules=num_rules)
+
+    # Convert set to a sorted list so that batches are deterministic across runs
+    candidate_pairs = sorted(candidate_pairs)
 
     print(f"Generated {len(candidate_pairs)} candidate pairs after all blocking")
-    print(f"Reduction: {1 - len(candidate_pairs)/total_possible_pairs:.2%} of pairs filtered out")
+    if total_possible_pairs > 0:
+        print(f"Reduction: {1 - len(candidate_pairs)/total_possible_pairs:.2%} of pairs filtered out")
 
-    # Initialize batch processing
-    print("Processing candidate pairs in batches...")
-    duplicate_dfs = []
-    current_batch = []
+    return candidate_pairs
+
+def partition_labels(df, partition_by):
+    '''
+    Label each row with the partition it belongs to.
+
+    Args:
+        df: DataFrame containing invoice data
+        partition_by: List of columns forming the partition key, e.g. ['COMPANY_CODE', 'CURRENCY']
+
+    Returns:
+        int64 array with one partition number per row (rows with a missing key share a partition)
+    '''
+    return df.groupby(partition_by, dropna=False, sort=True).ngroup().to_numpy(dtype=np.int64)
+
+def block_partition(task):
+    '''
+    Run the blocking rules on one partition. Executed in a worker process.
+
+    Args:
+        task: Tuple of (partition DataFrame, global row indices of its rows, vendor blocking method)
+
+    Returns:
+        Array of shape (n, 2) with candidate pairs as global row indices
+    '''
+    partition_df, global_rows, vendor_blocking = task
+    local_pairs = generate_candidate_pairs(partition_df.reset_index(drop=True), report_progress=False,
+                                           vendor_blocking=vendor_blocking)
+    local_pairs = np.array(local_pairs, dtype=np.int64).reshape(-1, 2)
+    return global_rows[local_pairs]
+
+def cross_partition_vendor_pairs(df, labels):
+    '''
+    Candidate pairs of invoices with the same VENDOR_ID that fall into different partitions.
+
+    Args:
+        df: DataFrame containing invoice data with a continuous index
+        labels: Partition number of every row
+
+    Returns:
+        Array of shape (n, 2) with (idx1, idx2) row indices, idx1 < idx2
+    '''
+    doc_nos = df['DOC_NO'].to_numpy()
+    pairs = []
+    for vendor_id, indices in df.groupby('VENDOR_ID').indices.items():
+        if len(indices) < 2 or len(np.unique(labels[indices])) < 2:
+            continue
+        first, second = np.triu_indices(len(indices), k=1)
+        idx1, idx2 = indices[first], indices[second]
+        keep = (labels[idx1] != labels[idx2]) & (doc_nos[idx1] != doc_nos[idx2])
+        pairs.append(np.column_stack([idx1[keep], idx2[keep]]))
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    return np.vstack(pairs).astype(np.int64)
+
+def generate_partitioned_pairs(df, partition_by, workers, cross_partition_vendor=False, progress_interval=1.0,
+                               vendor_blocking='minhash'):
+    '''
+    Generate candidate pairs partition by partition across a process pool.
+
+    Args:
+        df: DataFrame containing invoice data with a continuous index
+        partition_by: List of partition key columns
+        workers: Number of worker processes
+        cross_partition_vendor: Also pair invoices of the same VENDOR_ID across partitions
+        progress_interval: Minimum seconds between progress events
+        vendor_blocking: Vendor name blocking method (see generate_candidate_pairs)
+
+    Returns:
+        Array of shape (n, 2) with (idx1, idx2) row indices, sorted like generate_candidate_pairs
+    '''
+    labels = partition_labels(df, partition_by)
+    partition_rows = [np.flatnonzero(labels == label) for label in np.unique(labels)]
+    # Largest partitions first so a big company code does not start last and dominate wall time
+    partition_rows.sort(key=len, reverse=True)
+    print(f"Blocking {len(partition_rows)} partitions by {', '.join(partition_by)} with {workers} workers")
+
+    progress = ProgressReporter('blocking', interval=progress_interval)
+    pair_arrays = [np.zeros((0, 2), dtype=np.int64)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        tasks = ((df.iloc[rows], rows, vendor_blocking) for rows in partition_rows)
+        for done, pairs in enumerate(executor.map(block_partition, tasks), start=1):
+            pair_arrays.append(pairs)
+            progress.update(sum(len(pairs) for pairs in pair_arrays), partition=done, partitions=len(partition_rows))
+
+    if cross_partition_vendor:
+        print("Blocking by VENDOR_ID across partitions...")
+        cross_pairs = cross_partition_vendor_pairs(df, labels)
+        print(f"Added {len(cross_pairs)} cross-partition VENDOR_ID pairs")
+        pair_arrays.append(cross_pairs)
+
+    # Partitions are disjoint and cross-partition pairs span two of them, so no pair occurs twice
+    pair_array = np.vstack(pair_arrays)
+    pair_array = pair_array[np.lexsort((pair_array[:, 1], pair_array[:, 0]))]
+    progress.finish(len(pair_array), partition=len(partition_rows), partitions=len(partition_rows))
+    print(f"Generated {len(pair_array)} candidate pairs after partitioned blocking")
+    return pair_array
+
+# State shared with scoring workers, set once per process by init_scoring_worker
+_scoring_state = {}
+
+def init_scoring_worker(embeddings_dir, embedding_index, doc_nos, threshold, keep_scores=False):
+    '''
+    Attach a scoring worker to the embedding store written by the parent process.
+    The vectors are memory-mapped, so all workers share one copy through the page cache.
+    '''
+    _scoring_state['embeddings'] = EmbeddingStore.load(embeddings_dir)
+    _scoring_state['embedding_index'] = embedding_index
+    _scoring_state['doc_nos'] = doc_nos
+    _scoring_state['threshold'] = threshold
+    _scoring_state['keep_scores'] = keep_scores
+
+def score_partition_batch(batch):
+    '''
+    Score one batch of candidate pairs in a worker process.
+
+    Returns:
+        Tuple of (pairs above the threshold, their similarities, float16 scores of all pairs
+        or None if the worker was not asked to keep them)
+    '''
+    pairs, similarities, all_similarities = score_candidate_batch(
+        batch, _scoring_state['doc_nos'], _scoring_state['embeddings'],
+        _scoring_state['embedding_index'], _scoring_state['threshold'])
+    return pairs, similarities, all_similarities.astype(np.float16) if _scoring_state['keep_scores'] else None
+
+def normalize_field(series, column):
+    '''
+    Normalize one column for fingerprinting: amounts to cents, dates to ISO format,
+    text case-folded with whitespace collapsed. Missing or empty values become NaN.
+    '''
+    if column == 'AMOUNT':
+        amounts = pd.to_numeric(series, errors='coerce').round(2)
+        return amounts.map(lambda amount: f"{amount:.2f}", na_action='ignore')
+    if column == 'INVOICE_DATE':
+        return pd.to_datetime(series, errors='coerce', format='mixed').dt.strftime('%Y-%m-%d')
+    text = series.astype('string').str.strip().str.casefold().str.replace(r'\s+', ' ', regex=True)
+    return text.mask(text == '')
+
+def fingerprint_pairs(df, field_sets=FINGERPRINT_FIELD_SETS):
+    '''
+    Find exact duplicates with a hash join on normalized fingerprints.
+
+    Rows agreeing on every field of a field set after normalization are paired; rows with a
+    missing value in a field set are not fingerprinted by that set. Runs in linear time
+    apart from the pairs inside each matching group.
+
+    Args:
+        df: DataFrame containing invoice data with a continuous index
+        field_sets: List of column lists
+
+    Returns:
+        Tuple of (array of shape (n, 2) with (idx1, idx2) row indices, idx1 < idx2,
+        list with the '+'-joined field set that matched each pair first)
+    '''
+    doc_nos = df['DOC_NO'].to_numpy()
+    matched = {}
+    for fields in field_sets:
+        missing_columns = [column for column in fields if column not in df.columns]
+        if missing_columns:
+            print(f"Skipping fingerprint {'+'.join(fields)}: missing columns {', '.join(missing_columns)}")
+            continue
+        normalized = pd.DataFrame({column: normalize_field(df[column], column) for column in fields})
+        normalized = normalized[normalized.notna().all(axis=1)]
+        rule = '+'.join(fields)
+        new_pairs = 0
+        for indices in normalized.groupby(fields, sort=False).indices.values():
+            if len(indices) < 2:
+                continue
+            rows = normalized.index.to_numpy()[indices]
+            first, second = np.triu_indices(len(rows), k=1)
+            for idx1, idx2 in zip(rows[first], rows[second]):
+                if doc_nos[idx1] == doc_nos[idx2]:
+                    continue
+                key = (min(idx1, idx2), max(idx1, idx2))
+                if key not in matched:
+                    matched[key] = rule
+                    new_pairs += 1
+        print(f"Fingerprint {rule}: {new_pairs} exact duplicate pairs")
+
+    keys = sorted(matched)
+    pairs = np.array(keys, dtype=np.int64).reshape(-1, 2)
+    return pairs, [matched[key] for key in keys]
+
+def save_array_atomic(path, array):
+    '''
+    Save a numpy array so that an interrupted write never leaves a truncated file.
+    '''
+    tmp_path = f"{path}.tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+def prepare_checkpoint_dir(checkpoint_dir, manifest):
+    '''
+    Validate a checkpoint directory against the current run and clear stale files.
+
+    Args:
+        checkpoint_dir: Directory holding SBERT checkpoints
+        manifest: Dict describing the inputs the checkpoints depend on
+
+    Returns:
+        True if existing checkpoints can be reused
+    '''
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            previous = json.load(f)
+        if previous == manifest:
+            print(f"Reusing checkpoints from {checkpoint_dir}")
+            return True
+        print("Checkpoint manifest does not match this run, discarding stale checkpoints")
+
+    for name in os.listdir(checkpoint_dir):
+        if name.endswith('.npy') or name == 'manifest.json':
+            os.remove(os.path.join(checkpoint_dir, name))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return False
+
+def doc_nos_hash(df):
+    '''
+    Fingerprint of the DOC_NO column, used to check that saved row indices still match an input.
+    '''
+    return int(pd.util.hash_pandas_object(df['DOC_NO'], index=False).sum() % (2**63))
+
+def drop_exact_duplicates(df):
+    '''
+    Remove rows whose column values are all identical to an earlier row.
+
+    Returns:
+        Tuple of (DataFrame with a continuous index, number of removed rows)
+    '''
+    deduplicated_df = df.drop_duplicates(keep='first')
+    removed = len(df) - len(deduplicated_df)
+    if removed > 0:
+        # Reset the index to ensure continuous indices after removing duplicates
+        deduplicated_df = deduplicated_df.reset_index(drop=True)
+    return deduplicated_df, removed
+
+def save_candidate_scores(scores_path, pair_array, scores, df, threshold, match_types=None, match_rules=None,
+                          lexical_rejected=0, lexical_scores=None):
+    '''
+    Save the score of every candidate pair so the threshold can be changed without re-encoding.
+
+    Pairs are stored as int32 row indices into the deduplicated input, scores as float16, the
+    match_type as an int8 code into MATCH_TYPES and the match_rule as an int16 index into the
+    stored rule names (-1 for none), i.e. 13 bytes per candidate pair.
 
-    # Process pairs in batches
-    for pair_idx, (idx1, idx2) in enumerate(tqdm(candidate_pairs)):
-        current_batch.append((idx1, idx2))
+    Args:
+        match_types: match_type of every pair; 'sbert' for all pairs if None
+        match_rules: match_rule of every pair (None where there is none); no rules if None
+        lexical_rejected: Number of candidate pairs the lexical cascade rejected without a
+            score; the scores then only cover thresholds from threshold up
+        lexical_scores: Lexical scores of the 'lexical' pairs, in their order, stored as float16
+    '''
+    type_codes = np.zeros(len(pair_array), dtype=np.int8)
+    if match_types is not None:
+        type_codes = pd.Categorical(match_types, categories=MATCH_TYPES).codes.astype(np.int8)
+    rule_codes, rule_names = np.full(len(pair_array), -1, dtype=np.int16), []
+    if match_rules is not None:
+        rule_codes, rule_names = pd.factorize(pd.Series(match_rules, dtype=object))
+        rule_codes = rule_codes.astype(np.int16)
+    tmp_path = f"{scores_path}.tmp.npz"
+    np.savez(tmp_path, pairs=pair_array.astype(np.int32), scores=scores.astype(np.float16),
+             match_types=type_codes, match_rules=rule_codes, rule_names=np.array(list(rule_names), dtype=str),
+             lexical_rejected=lexical_rejected,
+             lexical_scores=np.zeros(0, dtype=np.float16) if lexical_scores is None else lexical_scores.astype(np.float16),
+             rows=len(df), doc_nos_hash=doc_nos_hash(df), threshold=threshold)
+    os.replace(tmp_path, scores_path)
+    print(f"Saved {len(pair_array)} candidate scores to {scores_path}")
+
+def load_candidate_scores(scores_path, df=None, thresholds=None):
+    '''
+    Load candidate scores written by save_candidate_scores.
+
+    Args:
+        scores_path: Path to the .npz file
+        df: Optional deduplicated invoice DataFrame the scores must belong to
+        thresholds: Optional thresholds the scores will be cut at. Below the scoring threshold,
+            pairs the lexical cascade rejected would be missing, so such thresholds are refused.
+
+    Returns:
+        Dict with 'pairs' (int32, shape (n, 2)), 'scores' (float16), 'match_types' and
+        'match_rules' (object arrays, None for no rule), 'lexical_similarity' (float32, NaN
+        except for lexical pairs), the 'threshold' used at scoring time
+        and the number of 'lexical_rejected' pairs. Files written before match types were
+        stored read as all 'sbert'.
+    '''
+    with np.load(scores_path) as data:
+        scores = {'pairs': data['pairs'], 'scores': data['scores'], 'threshold': float(data['threshold']),
+                  'rows': int(data['rows']), 'doc_nos_hash': int(data['doc_nos_hash'])}
+        type_codes = data['match_types'] if 'match_types' in data else np.zeros(len(scores['scores']), dtype=np.int8)
+        rule_codes = data['match_rules'] if 'match_rules' in data else np.full(len(scores['scores']), -1, dtype=np.int16)
+        rule_names = data['rule_names'] if 'rule_names' in data else np.zeros(0, dtype=str)
+        scores['lexical_rejected'] = int(data['lexical_rejected']) if 'lexical_rejected' in data else 0
+        lexical_scores = data['lexical_scores'] if 'lexical_scores' in data else np.zeros(0, dtype=np.float16)
+    scores['match_types'] = np.array(MATCH_TYPES, dtype=object)[type_codes]
+    scores['lexical_similarity'] = np.full(len(type_codes), np.nan, dtype=np.float32)
+    scores['lexical_similarity'][type_codes == MATCH_TYPES.index('lexical')] = lexical_scores
+    scores['match_rules'] = np.append(rule_names.astype(object), None)[rule_codes]
+    if df is not None and (scores['rows'] != len(df) or scores['doc_nos_hash'] != doc_nos_hash(df)):
+        raise ValueError(f"Candidate scores in {scores_path} were computed for a different input file")
+    if thresholds is not None:
+        check_rethreshold(scores, thresholds)
+    return scores
+
+def check_rethreshold(candidate_scores, thresholds):
+    '''
+    Raise ValueError if candidate scores cannot be cut at one of thresholds: below the scoring
+    threshold when the lexical cascade rejected pairs without scoring them.
+    '''
+    threshold = candidate_scores['threshold']
+    if candidate_scores['lexical_rejected'] and np.min(thresholds) < threshold - 1e-9:
+        raise ValueError(f"The lexical cascade rejected {candidate_scores['lexical_rejected']} candidate pairs without "
+                         f"scoring them, so thresholds below {threshold} would miss pairs; use thresholds from "
+                         f"{threshold} up or rerun without --lexical-band")
+
+def load_invoices(input_path):
+    '''
+    Load a semicolon-separated SAP invoice extract.
+
+    Args:
+        input_path: Path to the input CSV file
+
+    Returns:
+        DataFrame with AMOUNT and INVOICE_DATE converted
+    '''
+    df = pd.read_csv(input_path, dtype=str, sep=';')
+
+    # Convert numeric and date columns
+    df['AMOUNT'] = pd.to_numeric(df['AMOUNT'], errors='coerce')
+    df['INVOICE_DATE'] = pd.to_datetime(df['INVOICE_DATE'], errors='coerce', format='mixed')
+
+    return df
+
+def ensure_safetensors_weights(model_path):
+    '''
+    Make sure the model weights are available as model.safetensors.
+
+    safetensors files are memory-mapped when loaded, so the weights are paged in on
+    demand instead of being read and unpickled in full like pytorch_model.bin. A .bin
+    checkpoint is converted once; if the model directory is read-only the .bin is used.
+    '''
+    safetensors_path = os.path.join(model_path, 'model.safetensors')
+    bin_path = os.path.join(model_path, 'pytorch_model.bin')
+    if os.path.exists(safetensors_path) or not os.path.exists(bin_path):
+        return
+
+    import torch
+    from safetensors.torch import save_file
+
+    print(f"Converting {bin_path} to safetensors for memory-mapped loading...")
+    try:
+        state_dict = torch.load(bin_path, map_location='cpu', mmap=True, weights_only=True)
+        # safetensors does not store views; tied weights are saved as separate copies
+        state_dict = {name: tensor.contiguous().clone() for name, tensor in state_dict.items()}
+        tmp_path = f"{safetensors_path}.tmp"
+        save_file(state_dict, tmp_path, metadata={'format': 'pt'})
+        os.replace(tmp_path, safetensors_path)
+    except Exception as e:
+        print(f"Could not convert weights to safetensors, loading {bin_path} instead: {e}")
+
+def load_model(model_path):
+    '''
+    Load the SBERT model onto the best available device.
+
+    torch and sentence_transformers are imported here rather than at module level,
+    so runs that can reuse checkpointed embeddings never pay for importing them.
+
+    Args:
+        model_path: Path to the saved model
+
+    Returns:
+        Tuple of (model, device)
+    '''
+    import_start = time.perf_counter()
+    import torch
+    torch_time = time.perf_counter() - import_start
+    from sentence_transformers import SentenceTransformer
+    import_time = time.perf_counter() - import_start
+    print(f"Imported torch in {torch_time:.2f}s and sentence_transformers in {import_time - torch_time:.2f}s")
+
+    load_start = time.perf_counter()
+    if os.path.isdir(model_path):
+        ensure_safetensors_weights(model_path)
+    print(f"Loading model from {model_path}")
+    model = SentenceTransformer(model_path)
+
+    # Use GPU if available
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = model.to(device)
+    print(f"Model loaded in {time.perf_counter() - load_start:.2f}s")
+
+    return model, device
+
+def predict_duplicates(df, model_path, threshold_path, output_path='duplicates.csv', batch_size=250000, output_csv_path=None,
+                       model=None, device=None, stage_timings=None, progress_interval=1.0, checkpoint_dir=None,
+                       partition_by=None, workers=1, cross_partition_vendor=False, scores_path=None,
+                       fingerprint_field_sets=FINGERPRINT_FIELD_SETS, embedding_format='float32', pca_dims=None,
+                       quantization_report=None, vendor_blocking='minhash', lexical_band=None, lexical_tolerance=0.01,
+                       scoring_mode='sentence', field_cache_dir=None, memory_limit=None, adaptive_batches=True):
+    '''
+    Predict duplicates in a dataframe using the trained model.
+
+    Args:
+        df: DataFrame containing invoice data
+        model_path: Path to the saved model
+        threshold_path: Path to the saved threshold
+        output_path: Path to save the duplicates CSV
+        batch_size: Number of pairs in the first scoring batch; with adaptive_batches later
+            batches are sized from memory and throughput (see batch_sizing.py)
+        output_csv_path: Path to save the output CSV of scored pairs
+        model: Already loaded SBERT model (loaded from model_path if None)
+        device: Device the preloaded model runs on
+        stage_timings: Optional dict that receives the seconds spent per stage
+            ('fingerprint', 'blocking', 'encoding', 'scoring', 'output'), the candidate pair count
+            and the number of exact fingerprint matches
+        progress_interval: Minimum seconds between PROGRESS:SBERT_STAGE events
+        checkpoint_dir: Directory for candidate pair and embedding checkpoints; work already
+            saved there by an interrupted run with the same input is skipped
+        partition_by: Optional list of columns (e.g. ['COMPANY_CODE', 'CURRENCY']); blocking then
+            only pairs invoices within the same partition and runs one partition per worker
+        workers: Number of processes for partitioned blocking and for scoring; encoding always
+            runs once in this process with the single loaded model
+        cross_partition_vendor: With partition_by, also pair invoices of the same VENDOR_ID
+            across partitions
+        scores_path: Optional .npz path to save the score of every candidate pair, above the
+            threshold or not (see threshold_sweep.py)
+        fingerprint_field_sets: Field sets for the exact-match fast path; pairs matching one
+            after normalization are emitted with similarity 1.0 and match_type 'exact' and are
+            neither encoded nor scored. An empty list disables the fast path.
+        embedding_format: 'float32', 'float16' or 'int8'; embeddings are held and scored in
+            this format (see embedding_store.py)
+        pca_dims: Optional number of PCA dimensions to reduce the embeddings to before scoring
+        quantization_report: Optional dict that receives the bytes per invoice and how the
+            threshold decision on the candidate pairs differs from float32 scoring
+        vendor_blocking: 'minhash' (similar vendor names) or 'prefix' (first 4 characters of
+            the vendor name) blocking, see generate_candidate_pairs
+        lexical_band: Optional (low, high) band on the TF-IDF character n-gram cosine of the
+            invoice sentences, or 'auto' to calibrate it against SBERT on a sample of pairs.
+            Candidate pairs below the band are rejected and pairs at or above it are flagged
+            with similarity 1.0 (as exact matches), match_type 'lexical' and their TF-IDF
+            cosine in a lexical_similarity column, both without SBERT; only the
+            pairs in the band, and the invoices they contain, are encoded and scored. Saved
+            candidate scores then hold lexically flagged pairs as 1.0 and leave rejected ones out,
+            so they cannot be re-thresholded below threshold.
+        lexical_tolerance: With lexical_band='auto', the share of the SBERT decisions on the
+            sample that the lexical decisions may change
+        scoring_mode: 'sentence' encodes every invoice in a candidate pair as one sentence;
+            'fields' encodes each distinct vendor name and description once, cached in
+            field_cache_dir across runs, and scores pairs from field similarities calibrated
+            to the threshold (see score_pairs_by_fields). embedding_format, pca_dims and
+            workers only apply to sentence scoring.
+        field_cache_dir: Field embedding cache directory for scoring_mode='fields'
+        memory_limit: Optional ceiling in bytes on this process's resident memory. Before
+            every scoring batch, resident memory plus the batch's estimated memory is kept
+            under it, with batches below the usual minimum if needed; MemoryError is raised
+            when not even one pair fits. Encoding and the output frame are not limited.
+        adaptive_batches: Size scoring batches from available memory and observed throughput;
+            False scores batches of batch_size pairs, lowered only to fit memory_limit. With
+            workers, the memory budget is split between the workers once and the batch size
+            then stays fixed.
+    '''
+    if stage_timings is None:
+        stage_timings = {}
+    for stage in ('fingerprint', 'blocking', 'lexical', 'encoding', 'scoring', 'output'):
+        stage_timings.setdefault(stage, 0.0)
+
+    if partition_by:
+        missing_columns = [column for column in partition_by if column not in df.columns]
+        if missing_columns:
+            raise ValueError(f"Partition columns not found in input: {', '.join(missing_columns)}")
+
+    # Load threshold (the model is only loaded once there is something to encode)
+    with open(threshold_path, 'r') as f:
+        threshold = float(f.read().strip())
+
+    print(f"Using similarity threshold: {threshold}")
+
+    # Create sentences for all invoices
+    print(f"Processing {len(df)} invoices")
+
+    # Create a map of DOC_NO to index for faster lookups
+    doc_no_to_idx = {doc_no: idx for idx, doc_no in enumerate(df['DOC_NO'])}
+    
+    # Create a set to track unique document numbers to prevent self-matching
+    unique_doc_numbers = set(df['DOC_NO'])
+    print(f"Number of unique document numbers: {len(unique_doc_numbers)}")
+
+    # Filter out exact duplicates (where all column values are identical)
+    print("Filtering out exact duplicates from the dataset...")
+    original_count = len(df)
+    df, exact_duplicate_count = drop_exact_duplicates(df)
+    
+    if exact_duplicate_count > 0:
+        print(f"Removed {exact_duplicate_count} exact duplicate rows (all columns have identical values)")
+        print(f"Dataset size reduced from {original_count} to {len(df)} rows")
+        
+        # Update the DOC_NO to index mapping with the new indices
+        doc_no_to_idx = {doc_no: idx for idx, doc_no in enumerate(df['DOC_NO'])}
+    else:
+        print("No exact duplicates found in the dataset")
 
-        # Process batch when it reaches the desired size or final batch
-        if len(current_batch) >= batch_size or pair_idx == len(candidate_pairs) - 1:
-            batch_result = process_candidate_batch(current_batch, df, model, device, sentence_cache, threshold)
-            if not batch_result.empty:
-                duplicate_dfs.append(batch_result)
-            current_batch = []
+    # Create sentence cache with the updated indices
+    sentence_cache = {}
+    for idx, row in df.iterrows():
+        sentence = row_to_sentence(row)
+        sentence_cache[idx] = sentence
 
-            # Free memory
-            gc.collect()
+    resume_checkpoints = False
+    if checkpoint_dir:
+        manifest = {'rows': len(df), 'model': os.path.abspath(model_path),
+                    'doc_nos_hash': doc_nos_hash(df),
+                    'partition_by': list(partition_by) if partition_by else None,
+                    'cross_partition_vendor': bool(partition_by and cross_partition_vendor),
+                    'vendor_blocking': vendor_blocking,
+                    # The cascade decides which invoices are encoded
+                    'lexical_band': list(lexical_band) if isinstance(lexical_band, tuple) else lexical_band,
+                    'lexical_tolerance': lexical_tolerance if lexical_band == 'auto' else None,
+                    'scoring_mode': scoring_mode,
+                    # Fingerprint matches are not encoded, so they change which rows the embedding chunks hold
+                    'fingerprint_field_sets': [list(fields) for fields in fingerprint_field_sets or []]}
+        resume_checkpoints = prepare_checkpoint_dir(checkpoint_dir, manifest)
+
+    blocking_start = time.perf_counter()
+    pairs_checkpoint = os.path.join(checkpoint_dir, 'candidate_pairs.npy') if checkpoint_dir else None
+    if resume_checkpoints and os.path.exists(pairs_checkpoint):
+        pair_array = np.load(pairs_checkpoint)
+        print(f"Loaded {len(pair_array)} candidate pairs from checkpoint")
+    elif partition_by:
+        pair_array = generate_partitioned_pairs(df, partition_by, workers, cross_partition_vendor, progress_interval,
+                                                vendor_blocking)
+        if pairs_checkpoint:
+            save_array_atomic(pairs_checkpoint, pair_array)
+    else:
+        candidate_pairs = generate_candidate_pairs(df, progress_interval, vendor_blocking=vendor_blocking)
+        pair_array = np.array(candidate_pairs, dtype=np.int64).reshape(-1, 2)
+        if pairs_checkpoint:
+            save_array_atomic(pairs_checkpoint, pair_array)
+    stage_timings['blocking'] += time.perf_counter() - blocking_start
+
+    # Exact-match fast path: normalized fingerprint matches skip encoding and scoring
+    fingerprint_start = time.perf_counter()
+    exact_pairs, exact_rules = fingerprint_pairs(df, fingerprint_field_sets or [])
+    if len(exact_pairs):
+        num_rows = np.int64(len(df))
+        exact_codes = exact_pairs[:, 0] * num_rows + exact_pairs[:, 1]
+        pair_codes = pair_array[:, 0].astype(np.int64) * num_rows + pair_array[:, 1]
+        pair_array = pair_array[~np.isin(pair_codes, exact_codes)]
+        print(f"{len(exact_pairs)} exact duplicate pairs bypass SBERT; {len(pair_array)} candidate pairs left to score")
+    stage_timings['fingerprint'] += time.perf_counter() - fingerprint_start
+    stage_timings['exact_pairs'] = len(exact_pairs)
+    stage_timings['candidate_pairs'] = len(pair_array)
+
+    # Lexical cascade: pairs outside the uncertainty band are decided without SBERT
+    lexical_pairs = np.zeros((0, 2), dtype=np.int64)
+    lexical_scores = np.zeros(0, dtype=np.float32)
+    lexical_rejected = 0
+    if lexical_band and len(pair_array):
+        lexical_start = time.perf_counter()
+        lexical_rows = np.unique(pair_array)
+        lexical_index = np.full(len(df), -1, dtype=np.int64)
+        lexical_index[lexical_rows] = np.arange(len(lexical_rows))
+        scorer = LexicalScorer([sentence_cache[int(idx)] for idx in lexical_rows])
+        lexical = scorer.pair_similarities(lexical_index[pair_array[:, 0]], lexical_index[pair_array[:, 1]])
+        band = lexical_band
+        if lexical_band == 'auto':
+            if model is None:
+                model, device = load_model(model_path)
+            sample_positions, sample_weights = sample_pairs(lexical)
+            sample = pair_array[sample_positions]
+            sample_rows = np.unique(sample)
+            sample_index = np.full(len(df), -1, dtype=np.int64)
+            sample_index[sample_rows] = np.arange(len(sample_rows))
+            sample_embeddings = model.encode([sentence_cache[int(idx)] for idx in sample_rows], convert_to_numpy=True,
+                                             normalize_embeddings=True, device=device,
+                                             show_progress_bar=False).astype(np.float32)
+            semantic = EmbeddingStore.from_float32(sample_embeddings).pair_similarities(
+                sample_index[sample[:, 0]], sample_index[sample[:, 1]])
+            band = calibrate_band(lexical[sample_positions], semantic, threshold, lexical_tolerance, sample_weights)
+            if band is None:
+                print(f"No pair of the {len(sample)} sampled is above the threshold; scoring all pairs with SBERT")
+            else:
+                print(f"Calibrated lexical band on {len(sample)} sampled pairs: {band[0]:.4f} to {band[1]:.4f}")
+        if band is not None:
+            rejected, accepted, uncertain = split_by_band(lexical, band)
+            lexical_pairs, lexical_scores = pair_array[accepted], lexical[accepted]
+            pair_array = pair_array[uncertain]
+            lexical_rejected = int(rejected.sum())
+            stage_timings['lexical_rejected'] = lexical_rejected
+            stage_timings['lexical_accepted'] = int(accepted.sum())
+            print(f"Lexical cascade rejected {int(rejected.sum())} and flagged {int(accepted.sum())} pairs; "
+                  f"{len(pair_array)} in the band {band[0]:.4f} to {band[1]:.4f} go to SBERT")
+        stage_timings['lexical'] += time.perf_counter() - lexical_start
+
+    score_sink = [] if scores_path else None
+    if scoring_mode == 'fields':
+        duplicate_dfs = score_pairs_by_fields(df, pair_array, sentence_cache, model, device, model_path, threshold,
+                                              field_cache_dir, batch_size, progress_interval, stage_timings, score_sink,
+                                              memory_limit, adaptive_batches)
+    else:
+        # Encode every invoice that takes part in at least one candidate pair exactly once
+        encoding_start = time.perf_counter()
+        encoded_rows = np.unique(pair_array)
+        embedding_index = np.full(len(df), -1, dtype=np.int64)
+        embedding_index[encoded_rows] = np.arange(len(encoded_rows))
+        stage_timings['encoded_invoices'] = len(encoded_rows)
+        print(f"Encoding {len(encoded_rows)} invoices that appear in candidate pairs...")
+        embeddings = encode_sentences(model, device, [sentence_cache[int(idx)] for idx in encoded_rows],
+                                      progress_interval=progress_interval, checkpoint_dir=checkpoint_dir,
+                                      model_path=model_path)
+        store = EmbeddingStore.from_float32(embeddings, embedding_format, pca_dims)
+        if quantization_report is not None:
+            reference_scores = EmbeddingStore.from_float32(embeddings).pair_similarities(
+                embedding_index[pair_array[:, 0]], embedding_index[pair_array[:, 1]])
+            quantization_report.update({'format': store.embedding_format, 'pca_dims': pca_dims,
+                                        'bytes_per_invoice': store.bytes_per_vector,
+                                        'float32_bytes_per_invoice': embeddings.shape[1] * 4 if embeddings.size else 0})
+            quantization_report.update(threshold_agreement(reference_scores, store.pair_similarities(
+                embedding_index[pair_array[:, 0]], embedding_index[pair_array[:, 1]]), threshold))
+            print(f"Quantization changes the decision on {quantization_report['lost']} of "
+                  f"{quantization_report['flagged_float32']} flagged pairs and adds {quantization_report['added']} "
+                  f"(max score error {quantization_report['max_abs_error']:.4f})")
+        if store.embedding_format != 'float32' or store.components is not None:
+            print(f"Scoring with {store.describe()} ({store.nbytes / 2**20:.1f} MiB instead of {embeddings.nbytes / 2**20:.1f} MiB)")
+        # Only the store is kept for scoring
+        del embeddings
+        stage_timings['encoding'] += time.perf_counter() - encoding_start
+
+        # The kernel gathers both vectors of PAIR_CHUNK_SIZE pairs, converted to float32 if stored smaller
+        gathered_bytes = store.bytes_per_vector + (4 * store.vectors.shape[1] if store.embedding_format != 'float32' else 0)
+        sizer = scoring_batch_sizer(df, batch_size, SCORING_BYTES_PER_PAIR, PAIR_CHUNK_SIZE * 2 * gathered_bytes,
+                                    memory_limit, adaptive_batches, workers)
+        if workers > 1 and len(pair_array) > 0:
+            print(f"Scoring candidate pairs with {workers} workers...")
+            duplicate_dfs = score_pairs_parallel(pair_array, df, store, embedding_index, threshold,
+                                                 sizer.next_size(),
+                                                 workers, progress_interval, stage_timings, score_sink)
+        else:
+            # Initialize batch processing
+            print("Scoring candidate pairs in batches...")
+            duplicate_dfs = []
+            flagged_pairs = 0
+            progress = ProgressReporter('scoring', total=len(pair_array), interval=progress_interval)
+
+            # Process pairs in batches sized by the sizer
+            batch_start = 0
+            while batch_start < len(pair_array):
+                batch = pair_array[batch_start:batch_start + sizer.next_size()]
+                batch_timer = time.perf_counter()
+                batch_result = process_candidate_batch(batch, df, store, embedding_index, threshold, stage_timings,
+                                                       score_sink)
+                if not batch_result.empty:
+                    duplicate_dfs.append(batch_result)
+                    flagged_pairs += len(batch_result)
+                sizer.record(len(batch), len(batch_result), time.perf_counter() - batch_timer)
+                batch_start += len(batch)
+                progress.update(batch_start, flagged=flagged_pairs)
+            progress.finish(flagged=flagged_pairs)
+        stage_timings['batch_sizes'] = sizer.sizes
+
+    if scores_path:
+        all_scores = np.concatenate(score_sink) if score_sink else np.zeros(0, dtype=np.float16)
+        # Exact matches are stored with score 1.0 so re-thresholding keeps them
+        match_types = np.repeat(['exact', 'lexical', 'fields' if scoring_mode == 'fields' else 'sbert'],
+                                [len(exact_pairs), len(lexical_pairs), len(pair_array)])
+        save_candidate_scores(scores_path, np.vstack([exact_pairs, lexical_pairs, pair_array]),
+                              np.concatenate([np.ones(len(exact_pairs) + len(lexical_pairs), dtype=np.float16), all_scores]),
+                              df, threshold, match_types, list(exact_rules) + [None] * (len(lexical_pairs) + len(pair_array)),
+                              lexical_rejected, lexical_scores)
+
+    if len(lexical_pairs):
+        # The similarity column holds SBERT-scale scores only, so the lexical score gets its own
+        lexical_df = build_pair_frame(df, lexical_pairs, np.ones(len(lexical_pairs), dtype=np.float32))
+        lexical_df['match_type'] = 'lexical'
+        lexical_df['match_rule'] = None
+        lexical_df['lexical_similarity'] = lexical_scores.astype(np.float64)
+        duplicate_dfs.insert(0, lexical_df)
+
+    if len(exact_pairs):
+        exact_df = build_pair_frame(df, exact_pairs, np.ones(len(exact_pairs), dtype=np.float32))
+        exact_df['match_type'] = 'exact'
+        exact_df['match_rule'] = exact_rules
+        duplicate_dfs.insert(0, exact_df)
 
     # Combine all batches
+    output_start = time.perf_counter()
     if duplicate_dfs:
         final_duplicates_df = pd.concat(duplicate_dfs, ignore_index=True)
+        if 'match_type' in final_duplicates_df.columns:
+            final_duplicates_df['match_type'] = final_duplicates_df['match_type'].fillna('sbert')
+        else:
+            final_duplicates_df['match_type'] = 'sbert'
+            final_duplicates_df['match_rule'] = None
 
-        # Sort by similarity score
-        final_duplicates_df = final_duplicates_df.sort_values('similarity', ascending=False)
+        # Sort by similarity score (stable, so exact matches stay ahead of SBERT scores of 1.0)
+        final_duplicates_df = final_duplicates_df.sort_values('similarity', ascending=False, kind='stable')
 
         print(f"Found {len(final_duplicates_df)} potential duplicates")
         if output_csv_path:
             final_duplicates_df.to_csv(output_csv_path, index=False)
             print(f"Saved scored pairs to {output_csv_path}")
+        stage_timings['output'] += time.perf_counter() - output_start
         return final_duplicates_df
     else:
         print("No duplicates found")
         # Create empty DataFrame with proper column structure
         empty_df = pd.DataFrame(columns=['similarity'] +
                                [f'INV1_{col}' for col in df.columns] +
-                               [f'INV2_{col}' for col in df.columns])
+                               [f'INV2_{col}' for col in df.columns] +
+                               ['match_type', 'match_rule'])
         if output_csv_path:
             empty_df.to_csv(output_csv_path, index=False)
             print(f"Saved empty DataFrame to {output_csv_path}")
+        stage_timings['output'] += time.perf_counter() - output_start
         return empty_df
 
-def process_candidate_batch(batch, df, model, device, sentence_cache, threshold):
+def encode_sentences(model, device, sentences, chunk_size=10000, progress_interval=1.0,
+                     checkpoint_dir=None, model_path=None):
     '''
-    Process a batch of candidate pairs and return duplicates.
+    Encode sentences in chunks and report progress after each chunk.
 
     Args:
-        batch: List of (idx1, idx2) tuples
-        df: DataFrame containing invoice data
-        model: Trained SBERT model
+        model: Trained SBERT model (loaded from model_path on first use if None)
         device: Device to run model on
-        sentence_cache: Dictionary mapping indices to sentence representations
+        sentences: List of sentence representations
+        chunk_size: Number of sentences passed to the model per call
+        progress_interval: Minimum seconds between progress events
+        checkpoint_dir: Directory where each encoded chunk is saved and reloaded from
+        model_path: Path to the saved model, used when model is None
+
+    Returns:
+        float32 array of L2-normalized embeddings, one row per sentence
+    '''
+    progress = ProgressReporter('encoding', total=len(sentences), interval=progress_interval)
+    chunks = []
+    resumed = 0
+    for chunk_no, start in enumerate(range(0, len(sentences), chunk_size)):
+        chunk = sentences[start:start + chunk_size]
+        chunk_path = None
+        if checkpoint_dir:
+            chunk_path = os.path.join(checkpoint_dir, f"embeddings_{chunk_size}_{chunk_no:05d}.npy")
+            if os.path.exists(chunk_path):
+                chunk_embeddings = np.load(chunk_path)
+                if len(chunk_embeddings) == len(chunk):
+                    chunks.append(chunk_embeddings)
+                    resumed += len(chunk)
+                    progress.update(start + len(chunk), resumed=resumed)
+                    continue
+
+        if model is None:
+            model, device = load_model(model_path)
+        chunk_embeddings = model.encode(chunk, convert_to_numpy=True, normalize_embeddings=True,
+                                        device=device, show_progress_bar=False).astype(np.float32)
+        if chunk_path:
+            save_array_atomic(chunk_path, chunk_embeddings)
+        chunks.append(chunk_embeddings)
+        progress.update(start + len(chunk), resumed=resumed)
+    progress.finish(resumed=resumed)
+
+    if resumed:
+        print(f"Reused {resumed} embeddings from checkpoint")
+    if not chunks:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.vstack(chunks)
+
+def score_candidate_batch(batch, doc_nos, embeddings, embedding_index, threshold):
+    '''
+    Compute similarities for a batch of candidate pairs and keep those above the threshold.
+
+    Args:
+        batch: Array of shape (n, 2) with (idx1, idx2) row indices
+        doc_nos: Array of the DOC_NO of every DataFrame row
+        embeddings: EmbeddingStore with the encoded invoices
+        embedding_index: Array mapping a DataFrame row to its row in embeddings
+        threshold: Similarity threshold
+
+    Returns:
+        Tuple of (pairs above the threshold, their float32 similarities, similarities of all pairs)
+    '''
+    idx1 = batch[:, 0]
+    idx2 = batch[:, 1]
+
+    # Extra check to ensure we're not comparing an invoice with itself
+    self_matches = doc_nos[idx1] == doc_nos[idx2]
+    for doc_no in doc_nos[idx1[self_matches]]:
+        print(f"Warning: Skipping self-comparison for document {doc_no}")
+
+    similarities = embeddings.pair_similarities(embedding_index[idx1], embedding_index[idx2])
+    keep = (similarities >= threshold) & ~self_matches
+    return batch[keep], similarities[keep], similarities
+
+def build_pair_frame(df, pairs, similarities):
+    '''
+    Build the scored pairs DataFrame for pairs of row indices.
+
+    Returns:
+        DataFrame with INV1_ columns, then INV2_ columns, then similarity (empty if there are no pairs)
+    '''
+    if len(pairs) == 0:
+        return pd.DataFrame()
+    inv1_df = df.iloc[pairs[:, 0]].reset_index(drop=True).add_prefix('INV1_')
+    inv2_df = df.iloc[pairs[:, 1]].reset_index(drop=True).add_prefix('INV2_')
+    duplicates_df = pd.concat([inv1_df, inv2_df], axis=1)
+    duplicates_df['similarity'] = similarities.astype(np.float64)
+    return duplicates_df
+
+def process_candidate_batch(batch, df, embeddings, embedding_index, threshold, stage_timings=None, score_sink=None):
+    '''
+    Score a batch of candidate pairs and return duplicates.
+
+    Args:
+        batch: Array of shape (n, 2) with (idx1, idx2) row indices
+        df: DataFrame containing invoice data
+        embeddings: EmbeddingStore with the encoded invoices
+        embedding_index: Array mapping a DataFrame row to its row in embeddings
         threshold: Similarity threshold
+        stage_timings: Optional dict accumulating 'scoring' seconds
+        score_sink: Optional list that receives the float16 scores of all pairs in the batch
 
     Returns:
         DataFrame of duplicates
     '''
-    # Get sentences for encoding
-    batch_indices = set()
-    for idx1, idx2 in batch:
-        batch_indices.add(idx1)
-        batch_indices.add(idx2)
+    scoring_start = time.perf_counter()
+    pairs, similarities, all_similarities = score_candidate_batch(batch, df['DOC_NO'].to_numpy(), embeddings,
+                                                                  embedding_index, threshold)
+    if score_sink is not None:
+        score_sink.append(all_similarities.astype(np.float16))
+    duplicates_df = build_pair_frame(df, pairs, similarities)
 
-    batch_indices = list(batch_indices)
-    
-    # Safely get sentences, using int conversion to avoid numpy int64 issues
-    batch_sentences = []
-    for idx in batch_indices:
-        # Convert numpy.int64 to Python int if needed
-        idx = int(idx)
-        if idx in sentence_cache:
-            batch_sentences.append(sentence_cache[idx])
-        else:
-            # If the index isn't in the cache (which shouldn't happen with reset_index), 
-            # generate the sentence on the fly
-            batch_sentences.append(row_to_sentence(df.iloc[idx]))
-            # Add to cache for future use
-            sentence_cache[idx] = batch_sentences[-1]
-
-    # Create index mapping for this batch
-    batch_idx_map = {idx: i for i, idx in enumerate(batch_indices)}
-
-    # Encode sentences
-    embeddings = model.encode(batch_sentences, convert_to_tensor=True, device=device)
-
-    # Compute similarities and find duplicates
-    duplicates = []
-    for idx1, idx2 in batch:
-        # Extra check to ensure we're not comparing an invoice with itself
-        doc1_no = df.iloc[idx1]['DOC_NO']
-        doc2_no = df.iloc[idx2]['DOC_NO']
-        if doc1_no == doc2_no:
-            print(f"Warning: Skipping self-comparison for document {doc1_no}")
-            continue
-            
-        emb_idx1 = batch_idx_map[idx1]
-        emb_idx2 = batch_idx_map[idx2]
+    if stage_timings is not None:
+        stage_timings['scoring'] = stage_timings.get('scoring', 0.0) + time.perf_counter() - scoring_start
 
-        emb1 = embeddings[emb_idx1]
-        emb2 = embeddings[emb_idx2]
+    return duplicates_df
 
-        similarity = torch.dot(emb1, emb2) / (torch.norm(emb1) * torch.norm(emb2))
-        similarity = similarity.item()
+def score_pairs_parallel(pair_array, df, embeddings, embedding_index, threshold, batch_size, workers,
+                         progress_interval=1.0, stage_timings=None, score_sink=None):
+    '''
+    Score candidate pairs across a process pool.
 
-        if similarity >= threshold:
-            record = {'similarity': similarity}
+    The embedding store is written once to a temporary directory that every worker
+    memory-maps; workers return only the pairs above the threshold and the
+    DataFrame rows are assembled in this process.
 
-            # Add columns for first invoice with prefix INV1_
-            for col in df.columns:
-                record[f'INV1_{col}'] = df.iloc[idx1][col]
+    Returns:
+        List of duplicate DataFrames, one per batch with matches
+    '''
+    scoring_start = time.perf_counter()
+    # Several batches per worker keep all cores busy until the end
+    batch_size = max(1, min(batch_size, -(-len(pair_array) // (workers * 4))))
+    batches = [pair_array[start:start + batch_size] for start in range(0, len(pair_array), batch_size)]
 
-            # Add columns for second invoice with prefix INV2_
-            for col in df.columns:
-                record[f'INV2_{col}'] = df.iloc[idx2][col]
+    shared_dir = tempfile.mkdtemp(prefix='payguard_embeddings_')
+    embeddings.save(shared_dir)
 
-            duplicates.append(record)
+    duplicate_dfs = []
+    flagged_pairs = 0
+    scored = 0
+    progress = ProgressReporter('scoring', total=len(pair_array), interval=progress_interval)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_scoring_worker,
+                                 initargs=(shared_dir, embedding_index, df['DOC_NO'].to_numpy(), threshold,
+                                           score_sink is not None)) as executor:
+            # map yields in submission order, so collected scores line up with pair_array
+            for batch, (pairs, similarities, batch_scores) in zip(batches, executor.map(score_partition_batch, batches)):
+                scored += len(batch)
+                if score_sink is not None:
+                    score_sink.append(batch_scores)
+                if len(pairs):
+                    duplicate_dfs.append(build_pair_frame(df, pairs, similarities))
+                    flagged_pairs += len(pairs)
+                progress.update(scored, flagged=flagged_pairs, workers=workers)
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    progress.finish(flagged=flagged_pairs, workers=workers)
+
+    if stage_timings is not None:
+        stage_timings['scoring'] = stage_timings.get('scoring', 0.0) + time.perf_counter() - scoring_start
+    return duplicate_dfs
+
+def scoring_batch_sizer(df, batch_size, bytes_per_pair, fixed_bytes, memory_limit=None, adaptive=True, workers=1):
+    '''
+    AdaptiveBatchSizer for scoring candidate pairs of df.
 
-    if duplicates:
-        # Create dataframe from duplicates
-        duplicates_df = pd.DataFrame(duplicates)
+    A flagged pair becomes one output row with the columns of both invoices, and is copied
+    once more when the batches are concatenated. With several workers each holds a batch,
+    so every worker gets an equal share of the memory budget.
+    '''
+    row_bytes = 4 * df.memory_usage(deep=True).sum() / max(1, len(df))
+    return AdaptiveBatchSizer(bytes_per_pair * workers, fixed_bytes * workers, row_bytes * workers, initial_size=batch_size,
+                              min_size=min(batch_size, MIN_BATCH_SIZE), memory_limit=memory_limit, adaptive=adaptive)
 
-        # Reorder columns to have all INV1_ columns first, then INV2_, then similarity
-        inv1_cols = [col for col in duplicates_df.columns if col.startswith('INV1_')]
-        inv2_cols = [col for col in duplicates_df.columns if col.startswith('INV2_')]
+def score_pairs_by_fields(df, pair_array, sentence_cache, model, device, model_path, threshold, field_cache_dir,
+                          batch_size=250000, progress_interval=1.0, stage_timings=None, score_sink=None,
+                          memory_limit=None, adaptive_batches=True):
+    '''
+    Score candidate pairs from per-field embeddings instead of one embedding per invoice.
 
-        # New column order with similarity at the end
-        new_col_order = inv1_cols + inv2_cols + ['similarity']
+    Every distinct vendor name and description is encoded once and kept in a
+    FieldEmbeddingCache, so encoder calls grow with the distinct values, and later runs only
+    encode values they have not seen. The pair score combines the field similarities with
+    amount, date and code comparisons (see field_scoring.py). It is fitted once per model
+    and threshold on a sample of pairs that are also encoded as full sentences, so that it
+    flags the pairs SBERT would at the same threshold.
 
-        # Reorder DataFrame columns
-        duplicates_df = duplicates_df[new_col_order]
+    Args:
+        df: DataFrame containing invoice data
+        pair_array: Array of shape (n, 2) with the candidate pairs to score
+        sentence_cache: Dict of row index to row_to_sentence, for the calibration sample
+        model: Loaded SBERT model, or None to load it from model_path when needed
+        device: Device the model runs on
+        model_path: Path to the saved model
+        threshold: SBERT similarity threshold
+        field_cache_dir: Directory of the field embedding cache (next to the model if None)
+        batch_size: Number of pairs in the first scoring batch
+        progress_interval: Minimum seconds between progress events
+        stage_timings: Optional dict accumulating 'encoding' and 'scoring' seconds and the
+            number of newly encoded field values ('encoded_fields')
+        score_sink: Optional list that receives the float16 scores of all pairs
+        memory_limit: Optional ceiling in bytes on resident memory before each batch plus the
+            batch's estimated memory; MemoryError if not even one pair fits (see AdaptiveBatchSizer)
+        adaptive_batches: Size batches from memory and throughput instead of using batch_size
 
-        return duplicates_df
-    else:
-        return pd.DataFrame()
+    Returns:
+        List of DataFrames of the pairs at or above the threshold, with match_type 'fields'
+    '''
+    if stage_timings is None:
+        stage_timings = {}
+    encoding_start = time.perf_counter()
+    if field_cache_dir is None:
+        field_cache_dir = os.path.join(os.path.dirname(os.path.abspath(model_path)), 'field_cache')
+    cache = FieldEmbeddingCache(field_cache_dir, model_path)
+    scorer = FieldPairScorer(df)
+    distinct_texts = scorer.distinct_texts()
+    missing = cache.missing(distinct_texts)
+    print(f"Encoding {len(missing)} of {len(distinct_texts)} distinct field values "
+          f"({len(distinct_texts) - len(missing)} cached in {cache.directory})")
+    if missing:
+        if model is None:
+            model, device = load_model(model_path)
+        cache.add(missing, encode_sentences(model, device, missing, progress_interval=progress_interval))
+        cache.save()
+    scorer.load_vectors(cache)
+    stage_timings['encoded_fields'] = len(missing)
+
+    score_model = FieldScoreModel.load(cache.calibration_path(threshold), threshold)
+    if score_model is None and len(pair_array):
+        # Calibrate on pairs stratified by their mean feature, so the rare duplicates are well represented
+        mean_features = np.concatenate([
+            scorer.features(pair_array[start:start + batch_size, 0], pair_array[start:start + batch_size, 1]).mean(axis=1)
+            for start in range(0, len(pair_array), batch_size)])
+        sample_positions, sample_weights = sample_pairs(mean_features, FIELD_CALIBRATION_SAMPLE_SIZE)
+        sample = pair_array[sample_positions]
+        sample_rows = np.unique(sample)
+        sample_index = np.full(len(df), -1, dtype=np.int64)
+        sample_index[sample_rows] = np.arange(len(sample_rows))
+        print(f"Calibrating the field score on {len(sample)} pairs ({len(sample_rows)} invoices encoded as sentences)...")
+        if model is None:
+            model, device = load_model(model_path)
+        sample_embeddings = encode_sentences(model, device, [sentence_cache[int(idx)] for idx in sample_rows],
+                                             progress_interval=progress_interval)
+        semantic = EmbeddingStore.from_float32(sample_embeddings).pair_similarities(
+            sample_index[sample[:, 0]], sample_index[sample[:, 1]])
+        score_model = FieldScoreModel.fit(scorer.features(sample[:, 0], sample[:, 1]), semantic, threshold, sample_weights)
+        score_model.save(cache.calibration_path(threshold))
+        stage_timings['encoded_invoices'] = len(sample_rows)
+        print(f"Field score disagrees with SBERT on {score_model.agreement['lost']} of "
+              f"{score_model.agreement['flagged_sbert']} flagged sample pairs and adds {score_model.agreement['added']}")
+    stage_timings['encoding'] += time.perf_counter() - encoding_start
+
+    scoring_start = time.perf_counter()
+    print("Scoring candidate pairs from field embeddings...")
+    doc_nos = df['DOC_NO'].to_numpy()
+    duplicate_dfs = []
+    flagged_pairs = 0
+    progress = ProgressReporter('scoring', total=len(pair_array), interval=progress_interval)
+    sizer = scoring_batch_sizer(df, batch_size, *scorer.batch_memory(), memory_limit, adaptive_batches)
+    batch_start = 0
+    while batch_start < len(pair_array):
+        batch = pair_array[batch_start:batch_start + sizer.next_size()]
+        batch_timer = time.perf_counter()
+        scores = score_model.score(scorer.features(batch[:, 0], batch[:, 1]))
+        if score_sink is not None:
+            score_sink.append(scores.astype(np.float16))
+        keep = (scores >= threshold) & (doc_nos[batch[:, 0]] != doc_nos[batch[:, 1]])
+        if keep.any():
+            batch_df = build_pair_frame(df, batch[keep], scores[keep])
+            batch_df['match_type'] = 'fields'
+            batch_df['match_rule'] = None
+            duplicate_dfs.append(batch_df)
+            flagged_pairs += int(keep.sum())
+        sizer.record(len(batch), int(keep.sum()), time.perf_counter() - batch_timer)
+        batch_start += len(batch)
+        progress.update(batch_start, flagged=flagged_pairs)
+    progress.finish(flagged=flagged_pairs)
+    stage_timings['batch_sizes'] = sizer.sizes
+    stage_timings['scoring'] += time.perf_counter() - scoring_start
+    return duplicate_dfs
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Predict invoice duplicates')
@@ -366,6 +1277,32 @@ if __name__ == "__main__":
     parser.add_argument('--output', type=str, default='duplicates.csv', help='Path to output CSV file for duplicates (legacy, primarily for direct script execution)')
     parser.add_argument('--batch-size', type=int, default=250000, help='Batch size for processing')
     parser.add_argument("--output_csv", help="Path to save the output CSV of scored pairs.")
+    parser.add_argument('--progress-interval', type=float, default=1.0, help='Minimum seconds between progress events')
+    parser.add_argument('--checkpoint-dir', type=str, default=None, help='Directory to save and resume blocking and encoding checkpoints')
+    parser.add_argument('--partition-by', type=str, default=None, help='Comma-separated columns to partition blocking by, e.g. COMPANY_CODE,CURRENCY')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for partitioned blocking and scoring (0 = all cores)')
+    parser.add_argument('--fingerprint-fields', type=str, action='append', default=None,
+                        help='Comma-separated field set for the exact-match fast path; repeat for several sets (replaces the defaults)')
+    parser.add_argument('--no-fingerprints', action='store_true', help='Disable the exact-match fast path')
+    parser.add_argument('--scores-output', type=str, default=None, help='Path to save the scores of all candidate pairs (.npz) for threshold_sweep.py')
+    parser.add_argument('--cross-partition-vendor', action='store_true', help='With --partition-by, also pair invoices of the same VENDOR_ID across partitions')
+    parser.add_argument('--embedding-format', type=str, choices=EMBEDDING_FORMATS, default='float32', help='Format embeddings are held and scored in')
+    parser.add_argument('--pca-dims', type=int, default=None, help='Reduce embeddings to this many PCA dimensions before scoring')
+    parser.add_argument('--vendor-blocking', type=str, choices=VENDOR_BLOCKING_METHODS, default='minhash',
+                        help='Block on similar vendor names (MinHash-LSH over trigrams) or on the first 4 characters of the vendor name')
+    parser.add_argument('--lexical-band', type=str, default=None,
+                        help="LOW:HIGH band of TF-IDF character n-gram similarity; pairs outside it are decided without SBERT. 'auto' calibrates it on a sample")
+    parser.add_argument('--lexical-tolerance', type=float, default=0.01,
+                        help='With --lexical-band auto, share of SBERT decisions on the sample the cascade may change')
+    parser.add_argument('--scoring-mode', type=str, choices=SCORING_MODES, default='sentence',
+                        help='Encode whole invoice sentences, or each distinct vendor name and description once (cached across runs)')
+    parser.add_argument('--field-cache', type=str, default=None,
+                        help='Field embedding cache directory for --scoring-mode fields (default: field_cache next to the model)')
+    parser.add_argument('--memory-limit', type=str, default=None,
+                        help='Ceiling on process memory that every scoring batch must fit under (stops if none fits), e.g. 4G or 512M')
+    parser.add_argument('--fixed-batch-size', action='store_true',
+                        help='Score batches of exactly --batch-size pairs instead of sizing them from memory and throughput')
+    parser.add_argument('--quantization-report', type=str, default=None, help='Path to save (JSON) how --embedding-format/--pca-dims change the flagged pairs versus float32')
 
     args = parser.parse_args()
 
@@ -374,14 +1311,39 @@ if __name__ == "__main__":
 
     # Load data
     print(f"Loading data from {args.input}")
-    df = pd.read_csv(args.input, dtype=str, sep=';')
+    df = load_invoices(args.input)
 
-    # Convert numeric and date columns
-    df['AMOUNT'] = pd.to_numeric(df['AMOUNT'], errors='coerce')
-    df['INVOICE_DATE'] = pd.to_datetime(df['INVOICE_DATE'], errors='coerce', format='mixed')
+    partition_by = [column.strip() for column in args.partition_by.split(',') if column.strip()] if args.partition_by else None
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+
+    if args.no_fingerprints:
+        fingerprint_field_sets = []
+    elif args.fingerprint_fields:
+        fingerprint_field_sets = [[column.strip() for column in fields.split(',') if column.strip()]
+                                  for fields in args.fingerprint_fields]
+    else:
+        fingerprint_field_sets = FINGERPRINT_FIELD_SETS
+
+    quantization_report = {} if args.quantization_report else None
+    lexical_band = parse_lexical_band(args.lexical_band)
 
     # Predict duplicates
-    result_df = predict_duplicates(df, args.model, args.threshold, args.output, args.batch_size, args.output_csv)
+    result_df = predict_duplicates(df, args.model, args.threshold, args.output, args.batch_size, args.output_csv,
+                                   progress_interval=args.progress_interval, checkpoint_dir=args.checkpoint_dir,
+                                   partition_by=partition_by, workers=workers,
+                                   cross_partition_vendor=args.cross_partition_vendor, scores_path=args.scores_output,
+                                   fingerprint_field_sets=fingerprint_field_sets, embedding_format=args.embedding_format,
+                                   pca_dims=args.pca_dims, quantization_report=quantization_report,
+                                   vendor_blocking=args.vendor_blocking, lexical_band=lexical_band,
+                                   lexical_tolerance=args.lexical_tolerance, scoring_mode=args.scoring_mode,
+                                   field_cache_dir=args.field_cache,
+                                   memory_limit=parse_memory_size(args.memory_limit) if args.memory_limit else None,
+                                   adaptive_batches=not args.fixed_batch_size)
+
+    if args.quantization_report:
+        with open(args.quantization_report, 'w') as f:
+            json.dump(quantization_report, f, indent=2)
+        print(f"Saved quantization report to {args.quantization_report}")
 
     # If --output_csv is not given, and the script is run directly,
     # it might still be useful to print to console or save to the default args.output.
@@ -0,0 +1,205 @@
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from predict_pairs import load_invoices, drop_exact_duplicates, load_candidate_scores, check_rethreshold, build_pair_frame
+
+def parse_thresholds(spec):
+    '''
+    Parse a threshold list ("0.7,0.8,0.9") or range ("0.5:0.99:0.01", end inclusive).
+
+    Args:
+        spec: Threshold specification string
+
+    Returns:
+        Sorted float array of thresholds
+    '''
+    if ':' in spec:
+        start, stop, step = (float(part) for part in spec.split(':'))
+        thresholds = np.arange(start, stop + step / 2, step)
+    else:
+        thresholds = np.array([float(part) for part in spec.split(',') if part.strip()])
+    return np.round(np.sort(thresholds), 6)
+
+def float16_threshold(threshold):
+    '''
+    Round thresholds the way the stored float16 scores were rounded. Rounding is monotonic,
+    so every pair predict_pairs.py flagged at a threshold is still flagged here.
+    '''
+    return np.asarray(threshold, dtype=np.float16).astype(np.float32)
+
+def candidate_labels(doc_nos, pairs, labels_df):
+    '''
+    Match labeled pairs against the candidate pairs.
+
+    Args:
+        doc_nos: Array of the DOC_NO of every deduplicated input row
+        pairs: Candidate pairs as row indices
+        labels_df: DataFrame with INV1_DOC_NO, INV2_DOC_NO and LABEL (1 = duplicate, 0 = not)
+
+    Returns:
+        Tuple of (label per candidate pair: 1, 0 or -1 for unlabeled,
+        number of labeled duplicates that blocking never produced as a candidate)
+    '''
+    def pair_keys(first, second):
+        first, second = np.asarray(first, dtype=str), np.asarray(second, dtype=str)
+        # Pairs are unordered, so key them by (smaller, larger) document number
+        in_order = first <= second
+        smaller, larger = np.where(in_order, first, second), np.where(in_order, second, first)
+        return pd.Series(np.char.add(np.char.add(smaller, '|'), larger))
+
+    label_keys = pair_keys(labels_df['INV1_DOC_NO'], labels_df['INV2_DOC_NO'])
+    label_values = pd.Series(labels_df['LABEL'].astype(int).to_numpy(), index=label_keys)
+    label_values = label_values[~label_values.index.duplicated(keep='last')]
+
+    candidate_keys = pair_keys(doc_nos[pairs[:, 0]], doc_nos[pairs[:, 1]])
+    labels = candidate_keys.map(label_values).fillna(-1).astype(int).to_numpy()
+
+    missed = int((label_values == 1).sum() - (labels == 1).sum())
+    return labels, missed
+
+def sweep(scores, thresholds, labels=None, missed_positives=0, labeled_only=False):
+    '''
+    Count flagged pairs and, with labels, precision and recall at every threshold.
+
+    Args:
+        scores: Float array with the score of every candidate pair
+        thresholds: Thresholds to evaluate
+        labels: Optional label per candidate pair (1, 0 or -1 for unlabeled)
+        missed_positives: Labeled duplicates that are not candidates; they count against recall
+        labeled_only: Ignore unlabeled pairs for precision instead of treating them as non-duplicates
+
+    Returns:
+        DataFrame with one row per threshold
+    '''
+    scores = scores.astype(np.float32)
+    order = np.argsort(-scores, kind='stable')
+    sorted_scores = scores[order]
+    # Number of pairs with score >= threshold, for every threshold at once
+    flagged = np.searchsorted(-sorted_scores, -float16_threshold(thresholds), side='right')
+
+    results = pd.DataFrame({'threshold': thresholds, 'pairs': flagged})
+    if labels is None:
+        return results
+
+    sorted_labels = labels[order]
+    true_positives = np.concatenate([[0], np.cumsum(sorted_labels == 1)])[flagged]
+    if labeled_only:
+        false_positives = np.concatenate([[0], np.cumsum(sorted_labels == 0)])[flagged]
+    else:
+        false_positives = flagged - true_positives
+    total_positives = int((labels == 1).sum()) + missed_positives
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(true_positives + false_positives > 0,
+                             true_positives / (true_positives + false_positives), 1.0)
+        recall = true_positives / total_positives if total_positives else np.ones(len(thresholds))
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+    results['true_positives'] = true_positives
+    results['false_positives'] = false_positives
+    results['false_negatives'] = total_positives - true_positives
+    results['precision'] = precision
+    results['recall'] = recall
+    results['f1'] = f1
+    return results
+
+def write_result_set(df, candidate_scores, threshold, output_csv_path):
+    '''
+    Write the scored pairs CSV that predict_pairs.py would have produced at another threshold,
+    with the match_type and match_rule of every pair, so exact matches keep their fast path.
+
+    Args:
+        df: Deduplicated invoice DataFrame the scores belong to
+        candidate_scores: Dict returned by load_candidate_scores
+        threshold: New similarity threshold
+        output_csv_path: Path of the CSV to write
+
+    Returns:
+        Number of pairs written
+
+    Raises:
+        ValueError: If the lexical cascade left pairs unscored that threshold would need
+    '''
+    check_rethreshold(candidate_scores, [threshold])
+    pairs = candidate_scores['pairs'].astype(np.int64)
+    scores = candidate_scores['scores'].astype(np.float32)
+    doc_nos = df['DOC_NO'].to_numpy()
+    keep = (scores >= float16_threshold(threshold)) & (doc_nos[pairs[:, 0]] != doc_nos[pairs[:, 1]])
+    result_df = build_pair_frame(df, pairs[keep], scores[keep])
+    if result_df.empty:
+        result_df = pd.DataFrame(columns=['similarity'] + [f'INV1_{col}' for col in df.columns] +
+                                         [f'INV2_{col}' for col in df.columns] + ['match_type', 'match_rule'])
+    else:
+        result_df['match_type'] = candidate_scores['match_types'][keep]
+        result_df['match_rule'] = candidate_scores['match_rules'][keep]
+        if (result_df['match_type'] == 'lexical').any():
+            result_df['lexical_similarity'] = candidate_scores['lexical_similarity'][keep].astype(np.float64)
+        # Stable, so exact matches stay ahead of other scores of 1.0 as in predict_pairs.py
+        result_df = result_df.sort_values('similarity', ascending=False, kind='stable')
+    result_df.to_csv(output_csv_path, index=False)
+    print(f"Saved {len(result_df)} pairs at threshold {threshold} to {output_csv_path}")
+    return len(result_df)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Re-threshold saved candidate scores without re-running SBERT')
+    parser.add_argument('--scores', type=str, required=True, help='Candidate scores saved with predict_pairs.py --scores-output')
+    parser.add_argument('--input', type=str, default=None, help='Input CSV the scores were computed for (needed for --labels and --output_csv)')
+    parser.add_argument('--labels', type=str, default=None, help='CSV with INV1_DOC_NO, INV2_DOC_NO and LABEL columns')
+    parser.add_argument('--labeled-only', action='store_true', help='Ignore unlabeled pairs for precision instead of counting them as false positives')
+    parser.add_argument('--thresholds', type=str, default='0.50:0.99:0.01', help='Thresholds as start:stop:step or a comma-separated list')
+    parser.add_argument('--report', type=str, default=None, help='Path to save the sweep as CSV or JSON')
+    parser.add_argument('--threshold', type=float, default=None, help='Threshold for --output_csv (best F1 with --labels if omitted)')
+    parser.add_argument('--output_csv', type=str, default=None, help='Path to write the scored pairs at --threshold')
+    parser.add_argument('--save-threshold', type=str, default=None, help='Write the chosen threshold to this file, e.g. best_threshold.txt')
+
+    args = parser.parse_args()
+
+    df = None
+    if args.input:
+        df, _ = drop_exact_duplicates(load_invoices(args.input))
+    thresholds = parse_thresholds(args.thresholds)
+    candidate_scores = load_candidate_scores(args.scores, df,
+                                             thresholds if args.threshold is None else np.append(thresholds, args.threshold))
+    print(f"Loaded {len(candidate_scores['scores'])} candidate scores "
+          f"(scored at threshold {candidate_scores['threshold']})")
+
+    labels, missed = None, 0
+    if args.labels:
+        if df is None:
+            parser.error('--labels requires --input to map document numbers')
+        labels_df = pd.read_csv(args.labels, dtype={'INV1_DOC_NO': str, 'INV2_DOC_NO': str})
+        labels, missed = candidate_labels(df['DOC_NO'].astype(str).to_numpy(), candidate_scores['pairs'], labels_df)
+        print(f"Matched {(labels >= 0).sum()} labeled pairs to candidates; "
+              f"{missed} labeled duplicates were never candidates")
+
+    results = sweep(candidate_scores['scores'], thresholds, labels, missed, args.labeled_only)
+    print(results.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+    if args.report:
+        if args.report.endswith('.json'):
+            with open(args.report, 'w') as f:
+                json.dump(results.to_dict(orient='records'), f, indent=2)
+        else:
+            results.to_csv(args.report, index=False)
+        print(f"Saved sweep to {args.report}")
+
+    threshold = args.threshold
+    if threshold is None and labels is not None:
+        best = results.loc[results['f1'].idxmax()]
+        threshold = float(best['threshold'])
+        print(f"Best F1 {best['f1']:.3f} at threshold {threshold} "
+              f"(precision {best['precision']:.3f}, recall {best['recall']:.3f})")
+
+    if args.output_csv:
+        if df is None or threshold is None:
+            parser.error('--output_csv requires --input and either --threshold or --labels')
+        write_result_set(df, candidate_scores, threshold, args.output_csv)
+
+    if args.save_threshold:
+        if threshold is None:
+            parser.error('--save-threshold requires --threshold or --labels')
+        with open(args.save_threshold, 'w') as f:
+            f.write(f"{round(threshold, 4)}")
+        print(f"Saved threshold {threshold} to {args.save_threshold}")